@@ -0,0 +1,256 @@
+"""
+Local stand-in for the AWS APIs the updater calls, for benchmarking.
+
+FakeAWS serves synthetic accounts over HTTP:
+
+- STS AssumeRole, returning credentials whose access key ID names the
+  account, so later IAM calls signed with them are served from it
+- the federation getSigninToken endpoint, at /federation
+- IAM ListRoles, ListUsers, ListPolicies and ListGroups, paginated
+- IAM GenerateServiceLastAccessedDetails and GetServiceLastAccessedDetails,
+  with jobs that take `job_seconds` (give or take half) to complete
+
+Every request waits `latency` seconds before it is answered. A random
+`throttle_rate` fraction of Access Advisor calls, and any beyond
+`rate_limit` calls per second for an account, fail with Throttling.
+
+Point IAM_ENDPOINT_URL and STS_ENDPOINT_URL at `url`, and FEDERATION_URL
+at `url + '/federation'`.
+"""
+import BaseHTTPServer
+import collections
+import datetime
+import itertools
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape
+
+
+PAGE_SIZE = 100
+ACCESS_KEY_PREFIX = 'ASIAFAKE'
+SERVICES = ['s3', 'ec2', 'iam', 'sts', 'sqs', 'sns', 'dynamodb', 'lambda', 'kms', 'cloudwatch']
+
+
+class ThrottlingError(Exception):
+    pass
+
+
+class FakeAWS(object):
+    def __init__(self, num_accounts=10, roles=50, users=10, policies=5, groups=5, services=5,
+                 job_seconds=2.0, latency=0.0, throttle_rate=0.0, rate_limit=None, first_account=100000000000):
+        self.account_numbers = ['{:012d}'.format(first_account + index) for index in range(num_accounts)]
+        self.counts = dict(role=roles, user=users, policy=policies, group=groups)
+        self.services = SERVICES[:services]
+        self.job_seconds = job_seconds
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+
+        self.requests = collections.Counter()
+        self.throttled = 0
+        # (account number, ARN, completion time) keyed by job ID, shaped like a UUID
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        # (second, calls in that second) keyed by account number
+        self._rates = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def arns(self, account_number, kind):
+        return ['arn:aws:iam::{}:{}/{}{:05d}'.format(account_number, kind, kind, index)
+                for index in range(self.counts[kind])]
+
+    def arn_count(self):
+        return len(self.account_numbers) * sum(self.counts.values())
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self, port=0):
+        """
+        Serves requests from a background thread.
+        """
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Actions, each returning the contents of its result element.
+
+    def assume_role(self, account_number, params):
+        role_account = params['RoleArn'].split(':')[4]
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        return ('<Credentials><AccessKeyId>{key}</AccessKeyId><SecretAccessKey>fake</SecretAccessKey>'
+                '<SessionToken>fake</SessionToken><Expiration>{expiration}</Expiration></Credentials>'
+                '<AssumedRoleUser><Arn>{arn}</Arn><AssumedRoleId>AROAFAKE:aardvark</AssumedRoleId>'
+                '</AssumedRoleUser>').format(key=ACCESS_KEY_PREFIX + role_account, arn=escape(params['RoleArn']),
+                                             expiration=_timestamp(expiration))
+
+    def list_roles(self, account_number, params):
+        return self._list(account_number, params, 'role', 'Roles', 'RoleName', 'RoleId')
+
+    def list_users(self, account_number, params):
+        return self._list(account_number, params, 'user', 'Users', 'UserName', 'UserId')
+
+    def list_policies(self, account_number, params):
+        return self._list(account_number, params, 'policy', 'Policies', 'PolicyName', 'PolicyId')
+
+    def list_groups(self, account_number, params):
+        return self._list(account_number, params, 'group', 'Groups', 'GroupName', 'GroupId')
+
+    def generate_service_last_accessed_details(self, account_number, params):
+        self._limit(account_number)
+        seconds = self.job_seconds * random.uniform(0.5, 1.5)
+        with self._lock:
+            job_id = '00000000-0000-4000-8000-{:012d}'.format(next(self._job_ids))
+            self._jobs[job_id] = (account_number, params['Arn'], time.time() + seconds)
+        return '<JobId>{}</JobId>'.format(job_id)
+
+    def get_service_last_accessed_details(self, account_number, params):
+        self._limit(account_number)
+        with self._lock:
+            _, arn, completes = self._jobs[params['JobId']]
+        created = _timestamp(datetime.datetime.utcnow())
+        if time.time() < completes:
+            return ('<JobStatus>IN_PROGRESS</JobStatus><JobCreationDate>{0}</JobCreationDate>'
+                    '<JobCompletionDate>{0}</JobCompletionDate><ServicesLastAccessed/>').format(created)
+
+        with self._lock:
+            del self._jobs[params['JobId']]
+        services = ''.join(
+            '<member><ServiceName>{name}</ServiceName><ServiceNamespace>{namespace}</ServiceNamespace>'
+            '<LastAuthenticated>{last}</LastAuthenticated><LastAuthenticatedEntity>{arn}</LastAuthenticatedEntity>'
+            '<TotalAuthenticatedEntities>1</TotalAuthenticatedEntities></member>'.format(
+                name=namespace.upper(), namespace=namespace, arn=escape(arn),
+                last=_timestamp(datetime.datetime.utcnow() - datetime.timedelta(days=index)))
+            for index, namespace in enumerate(self.services))
+        return ('<JobStatus>COMPLETED</JobStatus><JobCreationDate>{0}</JobCreationDate>'
+                '<JobCompletionDate>{0}</JobCompletionDate><IsTruncated>false</IsTruncated>'
+                '<ServicesLastAccessed>{1}</ServicesLastAccessed>').format(created, services)
+
+    def signin_token(self, session):
+        return json.dumps(dict(SigninToken='fake-token-' + json.loads(session)['sessionId']))
+
+    def _list(self, account_number, params, kind, element, name_element, id_element):
+        arns = self.arns(account_number, kind)
+        start = int(params.get('Marker') or 0)
+        end = min(len(arns), start + int(params.get('MaxItems') or PAGE_SIZE))
+        members = ''.join(
+            '<member><Path>/</Path><{name}>{short}</{name}><{id}>{short}</{id}><Arn>{arn}</Arn>'
+            '<CreateDate>2017-01-01T00:00:00Z</CreateDate></member>'.format(
+                name=name_element, id=id_element, short=arn.split('/')[-1], arn=arn)
+            for arn in arns[start:end])
+        truncated = end < len(arns)
+        return '<{element}>{members}</{element}><IsTruncated>{truncated}</IsTruncated>{marker}'.format(
+            element=element, members=members, truncated='true' if truncated else 'false',
+            marker='<Marker>{}</Marker>'.format(end) if truncated else '')
+
+    def _limit(self, account_number):
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise ThrottlingError()
+        if not self.rate_limit:
+            return
+        second = int(time.time())
+        with self._lock:
+            window, calls = self._rates.get(account_number, (second, 0))
+            if window != second:
+                window, calls = second, 0
+            self._rates[account_number] = (window, calls + 1)
+        if calls >= self.rate_limit:
+            raise ThrottlingError()
+
+
+ACTIONS = {
+    'AssumeRole': FakeAWS.assume_role,
+    'ListRoles': FakeAWS.list_roles,
+    'ListUsers': FakeAWS.list_users,
+    'ListPolicies': FakeAWS.list_policies,
+    'ListGroups': FakeAWS.list_groups,
+    'GenerateServiceLastAccessedDetails': FakeAWS.generate_service_last_accessed_details,
+    'GetServiceLastAccessedDetails': FakeAWS.get_service_last_accessed_details,
+}
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        time.sleep(fake.latency)
+        if url.path != '/federation' or params.get('Action') != 'getSigninToken':
+            self._respond(404, 'text/plain', 'Not found')
+            return
+        fake.requests['getSigninToken'] += 1
+        self._respond(200, 'application/json', fake.signin_token(params['Session']))
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        params = dict(urlparse.parse_qsl(body))
+        action = params.get('Action')
+        time.sleep(fake.latency)
+
+        if action not in ACTIONS:
+            self._error(400, 'InvalidAction', 'Unknown action {}'.format(action))
+            return
+
+        fake.requests[action] += 1
+        try:
+            result = ACTIONS[action](fake, self._account_number(fake), params)
+        except ThrottlingError:
+            with fake._lock:
+                fake.throttled += 1
+            self._error(400, 'Throttling', 'Rate exceeded')
+            return
+        except KeyError as e:
+            self._error(400, 'NoSuchEntity', 'Missing {}'.format(e))
+            return
+
+        self._respond(200, 'text/xml', '<{0}Response><{0}Result>{1}</{0}Result><ResponseMetadata><RequestId>fake'
+                                       '</RequestId></ResponseMetadata></{0}Response>'.format(action, result))
+
+    def _account_number(self, fake):
+        """
+        :return: the account named by the access key the request was signed with
+        """
+        match = re.search(r'Credential={}(\d{{12}})/'.format(ACCESS_KEY_PREFIX), self.headers.get('Authorization', ''))
+        return match.group(1) if match else fake.account_numbers[0]
+
+    def _error(self, status, code, message):
+        self._respond(status, 'text/xml',
+                      '<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>{}</Message></Error>'
+                      '<RequestId>fake</RequestId></ErrorResponse>'.format(code, message))
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _timestamp(utc):
+    return utc.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -1,28 +1,30 @@
-import json
+import datetime
+import multiprocessing
 import os
-import Queue
 import re
+import shutil
+import tempfile
 import threading
+import time
 
 import better_exceptions # noqa
-from bunch import Bunch
 from distutils.spawn import find_executable
 from flask import current_app
 from flask_script import Manager, Command, Option
-from swag_client.backend import SWAGManager
-from swag_client.exceptions import InvalidSWAGDataException
-from swag_client.util import parse_swag_config_options
 
 from aardvark import create_app, db
 from aardvark.updater import AccountToUpdate
+from aardvark.updater import engine, metrics, ratelimit
+from aardvark.updater.accounts import get_directory
+from aardvark.updater.checkpoint import Checkpoint
+from aardvark.updater.leases import LeaseQueue
+from aardvark.updater.persister import Persister
+from aardvark.updater.scheduler import Scheduler
+from aardvark.updater.sharding import ChunkSizer, chunk_arns
+from aardvark.updater.workqueue import AccountQueue
 
 manager = Manager(create_app)
 
-ACCOUNT_QUEUE = Queue.Queue()
-DB_LOCK = threading.Lock()
-QUEUE_LOCK = threading.Lock()
-UPDATE_DONE = False
-
 SWAG_REPO_URL = 'https://github.com/Netflix-Skunkworks/swag-client'
 
 PHANTOMJS_EXECUTABLE = 'phantomjs'
@@ -34,70 +36,185 @@ DEFAULT_SWAG_BUCKET = 'swag-data'
 DEFAULT_AARDVARK_ROLE = 'Aardvark'
 DEFAULT_NUM_THREADS = 5  # testing shows problems with more than 6 threads
 
+UPDATE_MODES = ['thread', 'async', 'process']
 
-class UpdateAccountThread(threading.Thread):
-    global ACCOUNT_QUEUE, DB_LOCK, QUEUE_LOCK, UPDATE_DONE
+DEFAULT_PROCESS_TIMEOUT = 3600  # seconds
+
+QUEUE_DEPTH_HELP = 'Accounts or chunks of accounts waiting to be updated.'
+PERSIST_QUEUE_DEPTH_HELP = 'Collected ARNs waiting to be persisted.'
+
+# The app owned by an update worker process. See _init_update_process().
+PROCESS_APP = None
 
-    def __init__(self, thread_ID):
+
+class UpdateAccountThread(threading.Thread):
+    def __init__(self, thread_ID, account_queue, persister, sizer, checkpoint):
         self.thread_ID = thread_ID
+        self.account_queue = account_queue
+        self.persister = persister
+        self.sizer = sizer
+        self.checkpoint = checkpoint
         threading.Thread.__init__(self)
+        self.daemon = True
         self.app = current_app._get_current_object()
 
     def run(self):
-        while not UPDATE_DONE:
+        while True:
+            item, attempt = self.account_queue.get()
+            if item is None:  # queue closed
+                return
+
+            self.app.logger.info("Thread #{} updating {} (attempt {})".format(
+                                 self.thread_ID, _describe_item(item), attempt + 1))
+
+            # Failures from an earlier attempt at the item don't count against this one.
+            key = _item_key(item)
+            self.persister.failed.pop(key, None)
+
+            def emit(arn, services, key=key):
+                self.persister.put(arn, services, key)
+
+            try:
+                self.checkpoint.started(item, attempt)
+                arn_count, seconds, chunks = _update_item(self.app, item, emit, self.sizer.size())
+                if chunks:
+                    self.checkpoint.split(item, chunks)
+                for chunk in chunks:
+                    self.account_queue.put(chunk)
+                if chunks:
+                    self.app.logger.info("Thread #{} split account {} into {} chunks".format(
+                                         self.thread_ID, item[0], len(chunks)))
+                    continue
+
+                self.sizer.record(arn_count, seconds)
+                # The item is only done once the writer has persisted its data.
+                self.persister.call(lambda item=item: self._persisted(item))
+                self.app.logger.info("Thread #{} finished collecting {}".format(self.thread_ID, _describe_item(item)))
+            except Exception as e:
+                retrying = self.account_queue.retry(item, attempt, e)
+                _checkpoint_failure(self.checkpoint, item, retrying, e)
+                self.app.logger.error("Thread #{} failed to update {}{}: {}".format(
+                                      self.thread_ID, _describe_item(item), ', will retry' if retrying else '', e))
+            finally:
+                self.account_queue.task_done()
+
+    def _persisted(self, item):
+        error = self.persister.failed.get(_item_key(item))
+        if error:
+            self.checkpoint.failed(item, error)
+        else:
+            self.checkpoint.finished(item)
 
-            QUEUE_LOCK.acquire()
 
-            if not ACCOUNT_QUEUE.empty():
-                (account_num, role_name, arns) = ACCOUNT_QUEUE.get()
+def _checkpoint_failure(checkpoint, item, retrying, error):
+    if retrying:
+        metrics.inc('retries')
+        checkpoint.retrying(item, error)
+    else:
+        metrics.inc('failures')
+        checkpoint.failed(item, error)
 
-                self.app.logger.info("Thread #{} updating account {} with {} arns".format(
-                                     self.thread_ID, account_num, 'all' if arns[0] == 'all' else len(arns)))
 
-                QUEUE_LOCK.release()
+def _update_item(app, item, emit, chunk_size):
+    """
+    Collects a queued account or chunk of an account, passing each ARN's
+    services to emit. An account with more ARNs than chunk_size is split
+    into chunks to be queued in its place rather than collected. Chunks
+    carry their ARNs, so collecting them doesn't enumerate the account.
+
+    :param item: (account number, role name, ARNs, chunk) where chunk is
+                 None for a whole account
+    :param chunk_size: ARNs per chunk, or None not to split accounts
+    :return: number of ARNs collected, seconds taken and the chunk items
+    :raises RuntimeError: if the collector failed
+    """
+    account_num, role_name, arns, chunk = item
+    account = AccountToUpdate(app, account_num, role_name, arns)
+
+    if chunk is None:
+        arns = account._get_arns()
+        arn_chunks = chunk_arns(arns, chunk_size) if chunk_size else [arns]
+        if len(arn_chunks) > 1:
+            return 0, 0, [(account_num, role_name, arn_chunk, '{}/{}'.format(index + 1, len(arn_chunks)))
+                          for index, arn_chunk in enumerate(arn_chunks)]
+    else:
+        arns = account._get_chunk_arns()
 
-                account = AccountToUpdate(self.app, account_num, role_name, arns)
-                ret_code, aa_data = account.update_account()
+    collected = []
 
-                if ret_code != 0:  # retrieve wasn't successful, put back on queue
-                    QUEUE_LOCK.acquire()
-                    ACCOUNT_QUEUE.put((account_num, role_name, arns))
-                    QUEUE_LOCK.release()
+    def collect(arn, services):
+        collected.append(arn)
+        emit(arn, services)
 
-                self.app.logger.info("Thread #{} persisting data for account {}".format(self.thread_ID, account_num))
+    start = time.time()
+    ret_code, _ = account.update_arns(arns, emit=collect)
+    if ret_code != 0:
+        raise RuntimeError('collector exited with {}'.format(ret_code))
+    return len(collected), time.time() - start, []
 
-                DB_LOCK.acquire()
-                persist_aa_data(self.app, aa_data)
-                DB_LOCK.release()
 
-            else:
-                QUEUE_LOCK.release()
+def _item_key(item):
+    """
+    :return: (account number, chunk) identifying a queued item, where chunk
+             is None for a whole account
+    """
+    return item[0], item[3]
+
+
+def _describe_item(item):
+    account_num, _, arns, chunk = item
+    if chunk:
+        return 'account {} chunk {} with {} arns'.format(account_num, chunk, len(arns))
+    return 'account {} with {} arns'.format(account_num, 'all' if arns[0] == 'all' else len(arns))
 
 
 def persist_aa_data(app, aa_data):
     """
-    Reads access advisor JSON file & persists to our database
+    Persists access advisor data, keyed by ARN, to our database
     """
-    from aardvark.model import AWSIAMObject, AdvisorData
-
-    aa = json.loads(aa_data)
+    from aardvark.model import AWSIAMObject, AdvisorData, DataGeneration, upsert_supported
 
     with app.app_context():
-        arn_cache = {}
-        for arn, data in aa.items():
-            if arn in arn_cache:
-                item = arn_cache[arn]
-            else:
-                item = AWSIAMObject.get_or_create(arn)
-                arn_cache[arn] = item
-            for service in data:
-                AdvisorData.create_or_update(item.id,
-                                             service['lastAuthenticated'],
-                                             service['serviceName'],
-                                             service['serviceNamespace'],
-                                             service['lastAuthenticatedEntity'],
-                                             service['totalAuthenticatedEntities'])
+        if not aa_data:
+            return
+        start = time.time()
+        if not upsert_supported():
+            _persist_aa_data_rows(aa_data)
+            metrics.persisted(aa_data.keys(), time.time() - start)
+            return
+
+        item_ids = AWSIAMObject.upsert_arns(aa_data.keys(), datetime.datetime.utcnow())
+        AdvisorData.upsert([
+            dict(item_id=item_ids[arn],
+                 lastAuthenticated=service['lastAuthenticated'],
+                 serviceName=service['serviceName'],
+                 serviceNamespace=service['serviceNamespace'],
+                 lastAuthenticatedEntity=service['lastAuthenticatedEntity'],
+                 totalAuthenticatedEntities=service['totalAuthenticatedEntities'])
+            for arn, data in aa_data.items() for service in data])
+        DataGeneration.bump()
         db.session.commit()
+        metrics.persisted(aa_data.keys(), time.time() - start)
+
+
+def _persist_aa_data_rows(aa_data):
+    """
+    Persists access advisor data a row at a time, for databases without
+    INSERT ... ON CONFLICT.
+    """
+    from aardvark.model import AWSIAMObject, AdvisorData, DataGeneration
+
+    for arn, data in aa_data.items():
+        item = AWSIAMObject.get_or_create(arn)
+        for service in data:
+            AdvisorData.create_or_update(item.id,
+                                         service['lastAuthenticated'],
+                                         service['serviceName'],
+                                         service['serviceNamespace'],
+                                         service['lastAuthenticatedEntity'],
+                                         service['totalAuthenticatedEntities'])
+    DataGeneration.bump()
+    db.session.commit()
 
 
 @manager.command
@@ -255,36 +372,469 @@ def config(aardvark_role_param, bucket_param, db_uri_param, num_threads_param, p
 
 @manager.option('-a', '--accounts', dest='accounts', type=unicode, default='all')
 @manager.option('-r', '--arns', dest='arns', type=unicode, default='all')
-def update(accounts, arns):
+@manager.option('-m', '--mode', dest='mode', type=unicode, default='thread', choices=UPDATE_MODES)
+@manager.option('-w', '--workers', dest='workers', type=int)
+@manager.option('--max-age', dest='max_age', type=float)
+@manager.option('--resume', dest='resume', action='store_true', default=False)
+@manager.option('--lease', dest='lease', action='store_true', default=False)
+@manager.option('--join', dest='join', action='store_true', default=False)
+def update(accounts, arns, mode, workers, max_age, resume, lease, join):
     """
     Asks AWS for new Access Advisor information.
+
+    In thread mode (the default) each of `workers` threads (NUM_THREADS by
+    default) collects one account at a time and feeds a single writer
+    thread. In process mode each of
+    `workers` processes (one per CPU by default) does the same with its own
+    database engine and session. In async mode all accounts are updated as
+    coroutines in a single event loop.
+
+    With a max age (in hours, or the UPDATE_MAX_AGE config value) only
+    accounts and ARNs whose data is older than that are updated, stalest
+    first.
+
+    Each run is checkpointed in the database as it goes. With --resume the
+    latest run that didn't finish picks up where it left off, skipping
+    ARNs updated since it started; the other options then don't apply.
+
+    With --lease, workers claim accounts from the run's tasks in the
+    database rather than from an in-memory queue, so other nodes can work
+    on the same run by starting `update --join`, which joins the latest
+    unfinished run, as long as it was started with --lease. Leases work in
+    thread and process modes.
+
+    Collection metrics are served at METRICS_PORT while the run goes, and
+    written to METRICS_FILE once it is done, if either is set.
     """
-    accounts = _prep_accounts(accounts)
-    arns = arns.split(',')
     app = create_app()
+    lease = lease or join
+    if lease and mode == 'async':
+        raise RuntimeError('--lease and --join work in thread and process modes')
+
+    if join:
+        checkpoint, items = Checkpoint.join(app), []
+        if not checkpoint:
+            app.logger.info('No unfinished update run to join')
+            return
+    elif resume:
+        checkpoint, items = Checkpoint.resume(app)
+        if not checkpoint:
+            app.logger.info('No unfinished update run to resume')
+            return
+        app.config['UPDATE_RESUME_SINCE'] = checkpoint.started_at
+    else:
+        accounts = _prep_accounts(accounts)
+        arns = arns.split(',')
+        role_name = app.config.get('ROLENAME')
+
+        if max_age:
+            app.config['UPDATE_MAX_AGE'] = max_age
+        if app.config.get('UPDATE_MAX_AGE'):
+            accounts = _stale_accounts(app, accounts, app.config['UPDATE_MAX_AGE'])
+
+        checkpoint, items = Checkpoint.start(app, accounts, role_name, arns, leased=lease)
 
-    global ACCOUNT_QUEUE, QUEUE_LOCK, UPDATE_DONE
+    if lease:
+        # A task claimed after another node died working on it skips the
+        # ARNs that node persisted.
+        app.config['UPDATE_RESUME_SINCE'] = checkpoint.started_at
+
+    metrics.start(app)
+    try:
+        if mode == 'async':
+            _update_async(app, items, checkpoint)
+        elif mode == 'process':
+            _update_processes(app, _account_queue(app, items, checkpoint, lease), checkpoint,
+                              workers or multiprocessing.cpu_count())
+        else:
+            _update_threads(app, _account_queue(app, items, checkpoint, lease), checkpoint,
+                            workers or app.config.get('NUM_THREADS') or 5)
+    finally:
+        metrics.finish(app)
 
+
+@manager.option('-a', '--accounts', dest='accounts', type=unicode, default='all')
+@manager.option('-w', '--workers', dest='workers', type=int)
+def scheduler(accounts, workers):
+    """
+    Runs until interrupted, updating each account on its own cadence.
+
+    Accounts come due SCHEDULER_CADENCE hours (24 by default) apart, at
+    times spread across the day, and are updated by `workers` threads
+    (NUM_THREADS by default) feeding a single writer thread, as in thread
+    mode updates.
+    """
+    app = create_app()
     role_name = app.config.get('ROLENAME')
-    num_threads = app.config.get('NUM_THREADS') or 5
+    num_threads = workers or app.config.get('NUM_THREADS') or 5
+    account_numbers = _prep_accounts(accounts)
+
+    account_queue = AccountQueue.from_config(app.config)
+    sizer = ChunkSizer.from_config(app.config)
+    persister = Persister(app, persist_aa_data)
+    persister.start()
+    metrics.start(app)
+    metrics.gauge('queue_depth', QUEUE_DEPTH_HELP, account_queue.depth)
+    metrics.gauge('persist_queue_depth', PERSIST_QUEUE_DEPTH_HELP, persister.depth)
+    schedule = Scheduler(app, account_numbers, role_name, account_queue, persister)
 
-    if num_threads > 6:
-        current_app.logger.warn('Greater than 6 threads seems to cause problems')
+    for thread_num in range(num_threads):
+        UpdateAccountThread(thread_num + 1, account_queue, persister, sizer, schedule).start()
 
-    QUEUE_LOCK.acquire()
-    for account_number in accounts:
-        ACCOUNT_QUEUE.put((account_number, role_name, arns))
-    QUEUE_LOCK.release()
+    app.logger.info('Scheduling updates of {} accounts with {} threads'.format(len(account_numbers), num_threads))
+    try:
+        schedule.run(lambda: _prep_accounts(accounts))
+    except KeyboardInterrupt:
+        schedule.stop()
+    finally:
+        account_queue.close()
+        persister.close()
+        metrics.finish(app)
+
+
+@manager.option('-n', '--num-accounts', dest='num_accounts', type=int, default=10)
+@manager.option('--roles', dest='roles', type=int, default=50)
+@manager.option('--job-seconds', dest='job_seconds', type=float, default=2.0)
+@manager.option('--latency', dest='latency', type=float, default=0.0)
+@manager.option('--throttle-rate', dest='throttle_rate', type=float, default=0.0)
+@manager.option('--rate-limit', dest='rate_limit', type=int)
+@manager.option('-m', '--mode', dest='mode', type=unicode, default='thread', choices=UPDATE_MODES)
+@manager.option('-w', '--workers', dest='workers', type=int)
+def bench_collect(num_accounts, roles, job_seconds, latency, throttle_rate, rate_limit, mode, workers):
+    """
+    Measures collector throughput against a local stand-in for AWS.
+
+    Serves `num_accounts` synthetic accounts of `roles` roles each (plus a
+    few users, policies and groups) from FakeAWS, runs a full update of
+    them in the given mode into a scratch SQLite database, and reports
+    ARNs persisted per second. Access Advisor jobs take `job_seconds` to
+    complete, every AWS call takes `latency` seconds, and `throttle_rate`
+    of Access Advisor calls, plus any beyond `rate_limit` per second for an
+    account, are throttled.
+    """
+    from aardvark.fakeaws import FakeAWS
+    from aardvark.model import AWSIAMObject
+
+    fake = FakeAWS(num_accounts=num_accounts, roles=roles, job_seconds=job_seconds, latency=latency,
+                   throttle_rate=throttle_rate, rate_limit=rate_limit).start()
+    tmpdir = tempfile.mkdtemp()
+    # The STS client signs its calls, so it needs some credentials to sign with.
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(name, 'fake')
+
+    bench_config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(os.path.join(tmpdir, 'bench.db')),
+        'IAM_ENDPOINT_URL': fake.url,
+        'STS_ENDPOINT_URL': fake.url,
+        'FEDERATION_URL': fake.url + '/federation',
+        'COLLECTOR': 'iam',
+    }
+    app = create_app()
+    app.config.update(bench_config)
+    try:
+        with app.app_context():
+            db.create_all()
+
+        checkpoint, items = Checkpoint.start(app, fake.account_numbers, app.config.get('ROLENAME') or
+                                             DEFAULT_AARDVARK_ROLE, ['all'])
+        # Update threads work for the current app.
+        with app.app_context():
+            metrics.start(app)
+            start = time.time()
+            if mode == 'async':
+                _update_async(app, items, checkpoint)
+            elif mode == 'process':
+                _update_processes(app, _account_queue(app, items, checkpoint, False), checkpoint,
+                                  workers or multiprocessing.cpu_count(), bench_config)
+            else:
+                _update_threads(app, _account_queue(app, items, checkpoint, False), checkpoint,
+                                workers or app.config.get('NUM_THREADS') or DEFAULT_NUM_THREADS)
+            seconds = time.time() - start
+            metrics.finish(app)
+
+            arn_count = AWSIAMObject.query.count()
+    finally:
+        fake.stop()
+        shutil.rmtree(tmpdir)
+
+    report = ['Updated {} of {} ARNs in {} accounts in {:.1f} seconds: {:.1f} ARNs/sec'.format(
+              arn_count, fake.arn_count(), num_accounts, seconds, arn_count / seconds),
+              'AWS calls: {}'.format(', '.join('{} {}'.format(action, count)
+                                               for action, count in sorted(fake.requests.items()))),
+              'Throttled calls: {}'.format(fake.throttled),
+              'Seconds by phase: {}'.format(', '.join('{} {:.1f} ({} times)'.format(phase, total, count)
+                                                      for phase, (count, total) in metrics.METRICS.phases()))]
+    for line in report:
+        app.logger.info(line)
+        print(line)
+
+
+def _account_queue(app, items, checkpoint, lease):
+    """
+    :return: the queue workers take items from, either in memory or shared
+             with other nodes through leases
+    """
+    if lease:
+        account_queue = LeaseQueue(app, checkpoint)
+    else:
+        account_queue = AccountQueue.from_config(app.config)
+        for item, attempt in items:
+            account_queue.put(item, attempt)
+
+    metrics.gauge('queue_depth', QUEUE_DEPTH_HELP, account_queue.depth)
+    return account_queue
+
+
+def _update_threads(app, account_queue, checkpoint, num_threads):
+    """
+    Updates accounts in threads that feed a single writer thread.
+    """
+    if num_threads > 6 and app.config.get('COLLECTOR') == 'phantomjs':
+        app.logger.warn('Greater than 6 threads seems to cause problems')
+
+    sizer = ChunkSizer.from_config(app.config)
+
+    # Collection threads feed a single writer, which batches their results
+    # into as few commits as it can.
+    persister = Persister(app, persist_aa_data)
+    persister.start()
+    metrics.gauge('persist_queue_depth', PERSIST_QUEUE_DEPTH_HELP, persister.depth)
 
     threads = []
     for thread_num in range(num_threads):
-        thread = UpdateAccountThread(thread_num + 1)
+        thread = UpdateAccountThread(thread_num + 1, account_queue, persister, sizer, checkpoint)
         thread.start()
         threads.append(thread)
 
-    while not ACCOUNT_QUEUE.empty():
-        pass
-    UPDATE_DONE = True
+    account_queue.join()
+    account_queue.close()
+    for thread in threads:
+        thread.join()
+    persister.close()
+    checkpoint.close()
+    app.logger.info('Persisted {} arns in {} batches'.format(persister.count, persister.batches))
+
+    failed = _failed_items(account_queue)
+    collect_failed = set(_item_key(item) for item, _, _ in account_queue.failed)
+    failed.extend((_failed_name(key), 1, e) for key, e in sorted(persister.failed.items())
+                  if key not in collect_failed)
+    _log_failed_accounts(app, failed)
+
+
+def _update_async(app, items, checkpoint):
+    """
+    Updates accounts as coroutines in the collection engine's event loop.
+
+    Coroutines aren't retried, so each item's task is marked done or failed
+    once the loop has finished. If the run dies first, resuming it skips
+    the ARNs that were persisted.
+    """
+    for item, attempt in items:
+        checkpoint.started(item, attempt)
+
+    update_engine = engine.Engine(app)
+    chunk_size = ChunkSizer.from_config(app.config).size()
+    failed = update_engine.run(
+        (account_number, engine.update_account(AccountToUpdate(app, account_number, role_name, arns),
+                                               persist_aa_data, chunk_size))
+        for (account_number, role_name, arns, _), _ in items)
+
+    # Failures are keyed by account, which covers every chunk of it.
+    for item, _ in items:
+        if item[0] in failed:
+            checkpoint.failed(item, failed[item[0]])
+        else:
+            checkpoint.finished(item)
+    checkpoint.close()
+
+    _log_failed_accounts(app, [(account_number, 1, e) for account_number, e in failed.items()])
+
+
+def _update_processes(app, account_queue, checkpoint, num_workers, process_config=None):
+    """
+    Updates accounts in a pool of worker processes.
+
+    Each process collects and persists whole accounts with its own app,
+    engine and session, so JSON decoding and ORM work are spread across
+    CPUs and no lock is held around persistence. The parent process only
+    schedules accounts, retries failures, tallies results and keeps the
+    checkpoint.
+
+    A worker process that dies takes its item with it, and the pool never
+    returns a result for it, so an item without a result after
+    UPDATE_PROCESS_TIMEOUT seconds is failed rather than waited on forever.
+
+    :param process_config: config values the worker processes' apps need
+                           beyond this run's
+    """
+    sizer = ChunkSizer.from_config(app.config)
+    timeout = app.config.get('UPDATE_PROCESS_TIMEOUT') or DEFAULT_PROCESS_TIMEOUT
+
+    arn_counts = {}
+    # Only take as many items from the queue as there are workers to run
+    # them. With leases, other nodes can then claim the rest, and leases
+    # aren't left to expire while their items wait in the pool's backlog.
+    slots = threading.BoundedSemaphore(num_workers)
+    # Items whose worker never returned a result
+    lost = []
+
+    def wait(item, attempt, async_result):
+        async_result.wait(timeout)
+        if not async_result.ready():
+            lost.append(item)
+            result = 0, 0, [], 'no result from worker process after {} seconds'.format(timeout), None
+        else:
+            try:
+                result = async_result.get()
+            except Exception as e:
+                result = 0, 0, [], str(e) or repr(e), None
+        finished(item, attempt, result)
+
+    def finished(item, attempt, result):
+        try:
+            arn_count, seconds, chunks, error, process_metrics = result
+            if process_metrics:
+                metrics.METRICS.merge(process_metrics)
+            if error:
+                retrying = account_queue.retry(item, attempt, error)
+                _checkpoint_failure(checkpoint, item, retrying, error)
+                app.logger.error("Failed to update {}{}: {}".format(
+                                 _describe_item(item), ', will retry' if retrying else '', error))
+            elif chunks:
+                checkpoint.split(item, chunks)
+                for chunk in chunks:
+                    account_queue.put(chunk)
+                app.logger.info("Split account {} into {} chunks".format(item[0], len(chunks)))
+            else:
+                sizer.record(arn_count, seconds)
+                arn_counts[item[0]] = arn_counts.get(item[0], 0) + arn_count
+                checkpoint.finished(item)
+        finally:
+            slots.release()
+            account_queue.task_done()
+
+    def dispatch():
+        while True:
+            slots.acquire()
+            item, attempt = account_queue.get()
+            if item is None:  # queue closed
+                slots.release()
+                return
+            checkpoint.started(item, attempt)
+            async_result = pool.apply_async(_update_account_process, (item, sizer.size()))
+            waiter = threading.Thread(target=wait, args=(item, attempt, async_result))
+            waiter.daemon = True
+            waiter.start()
+
+    config = {'UPDATE_MAX_AGE': app.config.get('UPDATE_MAX_AGE'),
+              'UPDATE_RESUME_SINCE': app.config.get('UPDATE_RESUME_SINCE')}
+    config.update(process_config or {})
+    # Each process has its own limiters, so they share the overall rate.
+    rate_limit = config.get('IAM_RATE_LIMIT') or app.config.get('IAM_RATE_LIMIT') or ratelimit.DEFAULT_RATE_LIMIT
+    config['IAM_RATE_LIMIT'] = float(rate_limit) / num_workers
+    pool = multiprocessing.Pool(num_workers, initializer=_init_update_process, initargs=(config,))
+    dispatcher = threading.Thread(target=dispatch)
+    dispatcher.daemon = True
+    dispatcher.start()
+
+    try:
+        account_queue.join()
+    finally:
+        account_queue.close()
+        if lost:
+            # Closing would leave the pool waiting for the lost items' results.
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+    checkpoint.close()
+
+    app.logger.info('Updated {} ARNs in {} account(s) with {} processes'.format(
+                    sum(arn_counts.values()), len(arn_counts), num_workers))
+    _log_failed_accounts(app, _failed_items(account_queue))
+
+
+def _init_update_process(config):
+    """
+    Gives an update worker process its own app, and with it its own
+    database engine, rather than sharing the parent's connections.
+
+    :param config: config values set for this run on the parent's app
+    """
+    global PROCESS_APP
+    PROCESS_APP = create_app()
+    PROCESS_APP.config.update(config)
+
+
+def _update_account_process(item, chunk_size):
+    """
+    Collects and persists one account, or chunk of an account, in an update
+    worker process.
+
+    :return: number of ARNs persisted, seconds taken, chunk items to queue
+             in place of the account, an error message if the update
+             failed, and the process's metrics since its last update
+    """
+    try:
+        with Persister(PROCESS_APP, persist_aa_data) as persister:
+            arn_count, seconds, chunks = _update_item(PROCESS_APP, item, persister.put, chunk_size)
+        if persister.error:
+            raise persister.error
+
+        result = arn_count, seconds, chunks, None
+    except Exception as e:
+        PROCESS_APP.logger.error('Failed to update {}: {}'.format(_describe_item(item), e))
+        result = 0, 0, [], str(e) or repr(e)
+    return result + (metrics.METRICS.drain(),)
+
+
+def _stale_accounts(app, accounts, max_age):
+    """
+    Drops accounts whose data is all newer than max_age hours and orders
+    the rest stalest first. Accounts we have no data for come first.
+    """
+    from aardvark.model import AWSIAMObject
+
+    with app.app_context():
+        oldest = AWSIAMObject.oldest_update_by_account()
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=max_age)
+    stale = [account for account in accounts if not oldest.get(account) or oldest[account] < cutoff]
+    app.logger.info('{} of {} accounts have data older than {} hours'.format(len(stale), len(accounts), max_age))
+
+    return sorted(stale, key=lambda account: oldest.get(account) or datetime.datetime.min)
+
+
+def _failed_items(account_queue):
+    """
+    :return: list of (account number, attempts, last error) for the queue's
+             failed items, with the chunk for chunks of accounts
+    """
+    return [(_failed_name(_item_key(item)), attempts, e) for item, attempts, e in account_queue.failed]
+
+
+def _failed_name(key):
+    """
+    :return: the account number of a failed item, with the chunk for chunks
+             of accounts
+    """
+    account_number, chunk = key
+    return '{} chunk {}'.format(account_number, chunk) if chunk else account_number
+
+
+def _log_failed_accounts(app, failed):
+    """
+    Logs a summary of accounts that could not be updated.
+
+    :param failed: list of (account number, attempts, last error)
+    """
+    if not failed:
+        app.logger.info('All accounts updated')
+        return
+
+    app.logger.error('{} account(s) failed permanently:'.format(len(failed)))
+    for account_number, attempts, e in failed:
+        app.logger.error('  {} after {} attempt(s): {}'.format(account_number, attempts, e))
 
 
 def _prep_accounts(account_names):
@@ -306,41 +856,19 @@ def _prep_accounts(account_names):
     if not account_names:
         return matching_accounts
 
-    try:
-        current_app.logger.info('getting bucket {}'.format(
-                                current_app.config.get('SWAG_BUCKET')))
-
-        swag = SWAGManager(**parse_swag_config_options(current_app.config.get('SWAG_OPTS')))
-
-        all_accounts = swag.get_all(current_app.config.get('SWAG_FILTER'))
-
-        service_enabled_requirement = current_app.config.get('SWAG_SERVICE_ENABLED_REQUIREMENT', None)
-        if service_enabled_requirement:
-            all_accounts = swag.get_service_enabled(service_enabled_requirement, accounts_list=all_accounts)
-
-    except (KeyError, InvalidSWAGDataException, Exception) as e:
-        current_app.logger.error('Account names passed but SWAG not configured or unavailable: {}'.format(e))
+    directory = get_directory(current_app)
 
     if 'all' in account_names:
-        return [account['id'] for account in all_accounts]
-
-    lookup = {account['name']: Bunch(account) for account in all_accounts}
-
-    for account in all_accounts:
-        # get the right key, depending on whether we're using swag v1 or v2
-        alias_key = 'aliases' if account['schemaVersion'] == '2' else 'alias'
-        for alias in account[alias_key]:
-            lookup[alias] = Bunch(account)
+        return list(directory.account_ids)
 
     for name in account_names:
-        if name not in lookup:
+        account_number = directory.lookup(name)
+        if not account_number:
             current_app.logger.warn('Could not find an account named %s'
                                     % name)
             continue
 
-        account_number = lookup[name].get('id', None)
-        if account_number:
-            matching_accounts.append(account_number)
+        matching_accounts.append(account_number)
 
     return matching_accounts
 
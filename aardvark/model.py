@@ -1,15 +1,57 @@
+import collections
 import datetime
+import sqlite3
 
 from flask import current_app
-from sqlalchemy import BigInteger, Column, Integer, Text, TIMESTAMP
+from sqlalchemy import BigInteger, Boolean, Column, func, Integer, Text, TIMESTAMP, text
+from sqlalchemy.dialects import postgresql
 import sqlalchemy.exc
 from sqlalchemy.orm import relationship
-from sqlalchemy.schema import ForeignKey
+from sqlalchemy.schema import ForeignKey, UniqueConstraint
 
 from aardvark import db
 from aardvark.utils.sqla_regex import String
 
 
+# Keeps IN (...) lists under SQLite's limit on bound parameters.
+IN_CLAUSE_CHUNK_SIZE = 500
+# Rows per multi-row INSERT on Postgres, well under its limit of 65535
+# bound parameters for the widest table we upsert.
+UPSERT_CHUNK_SIZE = 1000
+
+
+def upsert_supported():
+    """
+    :return: whether the database supports INSERT ... ON CONFLICT
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return dialect == 'postgresql'
+
+
+def skip_locked_supported():
+    """
+    :return: whether the database supports SELECT ... FOR UPDATE SKIP LOCKED
+    """
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _arn_account_number(arn):
+    """
+    :return: SQL expression for the account number in an IAM ARN, which
+             always follows ":iam::" and is 12 digits long
+    """
+    find = func.strpos if db.engine.dialect.name == 'postgresql' else func.instr
+    return func.substr(arn, find(arn, ':iam::') + len(':iam::'), 12)
+
+
+def _chunks(items, size=IN_CLAUSE_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 class AWSIAMObject(db.Model):
     """
     Meant to model AWS IAM Object Access Advisor.
@@ -38,12 +80,99 @@ class AWSIAMObject(db.Model):
             item.lastUpdated = datetime.datetime.utcnow()
         db.session.add(item)
 
-        # we only need a refresh if the object was created
+        # a new object needs flushing for its id, and is committed by the caller
         if added:
-            db.session.commit()
-            db.session.refresh(item)
+            db.session.flush()
         return item
 
+    @staticmethod
+    def upsert_arns(arns, last_updated):
+        """
+        Creates any of the ARNs we don't have yet and sets lastUpdated on all
+        of them, using INSERT ... ON CONFLICT so concurrent writers can't race.
+
+        On Postgres each chunk of ARNs is one multi-row statement, which
+        returns the ids as well. Elsewhere (SQLite) the rows are executed as a
+        batch, which costs nothing more since the database is in process.
+
+        :return: dictionary of item ids keyed by ARN
+        """
+        if db.engine.dialect.name == 'postgresql':
+            table = AWSIAMObject.__table__
+            ids = {}
+            for chunk in _chunks(arns, UPSERT_CHUNK_SIZE):
+                statement = postgresql.insert(table).values([dict(arn=arn, lastUpdated=last_updated)
+                                                             for arn in chunk])
+                statement = statement.on_conflict_do_update(
+                    index_elements=[table.c.arn], set_=dict(lastUpdated=statement.excluded.lastUpdated)) \
+                    .returning(table.c.id, table.c.arn)
+                ids.update((arn, item_id) for item_id, arn in db.session.execute(statement))
+            return ids
+
+        db.session.execute(text(
+            'INSERT INTO aws_iam_object (arn, "lastUpdated") VALUES (:arn, :lastUpdated) '
+            'ON CONFLICT (arn) DO UPDATE SET "lastUpdated" = excluded."lastUpdated"'
+        ), [dict(arn=arn, lastUpdated=last_updated) for arn in arns])
+
+        ids = {}
+        for chunk in _chunks(arns):
+            ids.update((arn, item_id) for item_id, arn in
+                       db.session.query(AWSIAMObject.id, AWSIAMObject.arn).filter(AWSIAMObject.arn.in_(chunk)))
+        return ids
+
+    @staticmethod
+    def last_updated_by_arn(account_number):
+        """
+        :return: dictionary of lastUpdated times for the ARNs we have in an account, keyed by ARN
+        """
+        pattern = 'arn:%:iam::{}:%'.format(account_number)
+        query = db.session.query(AWSIAMObject.arn, AWSIAMObject.lastUpdated).filter(AWSIAMObject.arn.like(pattern))
+        return dict(query)
+
+    @staticmethod
+    def delete_arns(arns):
+        """
+        Deletes ARNs along with their Access Advisor data, in bulk statements
+        a chunk of ARNs at a time.
+        """
+        for chunk in _chunks(arns):
+            item_ids = [item_id for item_id, in
+                        db.session.query(AWSIAMObject.id).filter(AWSIAMObject.arn.in_(chunk))]
+            if not item_ids:
+                continue
+            AdvisorData.query.filter(AdvisorData.item_id.in_(item_ids)).delete(synchronize_session=False)
+            AWSIAMObject.query.filter(AWSIAMObject.id.in_(item_ids)).delete(synchronize_session=False)
+        DataGeneration.bump()
+        db.session.commit()
+
+    @staticmethod
+    def oldest_update_by_account():
+        """
+        :return: dictionary of the oldest lastUpdated time of any ARN in each account, keyed by account number
+        """
+        return dict((account_number, oldest) for account_number, (oldest, _)
+                    in AWSIAMObject.update_stats_by_account().items())
+
+    @staticmethod
+    def arn_count_by_account():
+        """
+        :return: dictionary of the number of ARNs we have data for in each account, keyed by account number
+        """
+        return dict((account_number, count) for account_number, (_, count)
+                    in AWSIAMObject.update_stats_by_account().items())
+
+    @staticmethod
+    def update_stats_by_account():
+        """
+        Aggregates the ARNs of every account in one GROUP BY query.
+
+        :return: dictionary of (oldest lastUpdated time, number of ARNs), keyed by account number
+        """
+        account_number = _arn_account_number(AWSIAMObject.arn)
+        query = db.session.query(account_number, func.min(AWSIAMObject.lastUpdated), func.count(AWSIAMObject.id)) \
+            .group_by(account_number)
+        return dict((account_number, (oldest, count)) for account_number, oldest, count in query)
+
 
 class AdvisorData(db.Model):
     """
@@ -58,6 +187,7 @@ class AdvisorData(db.Model):
     }
     """
     __tablename__ = "advisor_data"
+    __table_args__ = (UniqueConstraint("item_id", "serviceNamespace"),)
     id = Column(Integer, primary_key=True)
     item_id = Column(Integer, ForeignKey("aws_iam_object.id"), nullable=False, index=True)
     lastAuthenticated = Column(BigInteger)
@@ -88,3 +218,145 @@ class AdvisorData(db.Model):
         if lastAuthenticated > item.lastAuthenticated:
             item.lastAuthenticated = lastAuthenticated
             db.session.add(item)
+
+    @staticmethod
+    def usage_by_item(item_ids):
+        """
+        Loads the Access Advisor data of many items in one query (per
+        IN_CLAUSE_CHUNK_SIZE items), as rows rather than ORM objects.
+
+        :return: dictionary of lists of AdvisorData rows, keyed by item id
+        """
+        columns = (AdvisorData.item_id, AdvisorData.lastAuthenticated, AdvisorData.serviceName,
+                   AdvisorData.serviceNamespace, AdvisorData.lastAuthenticatedEntity,
+                   AdvisorData.totalAuthenticatedEntities)
+        usage = collections.defaultdict(list)
+        for chunk in _chunks(item_ids):
+            for row in db.session.query(*columns).filter(AdvisorData.item_id.in_(chunk)):
+                usage[row.item_id].append(row)
+        return usage
+
+    @staticmethod
+    def upsert(rows):
+        """
+        Inserts Access Advisor data, or for services we already have, moves
+        lastAuthenticated forward if it is newer, in one batched statement.
+
+        On Postgres each chunk of rows is one multi-row statement. Elsewhere
+        (SQLite) the rows are executed as a batch.
+
+        :param rows: list of dictionaries of AdvisorData columns
+        """
+        if not rows:
+            return
+
+        if db.engine.dialect.name == 'postgresql':
+            # A statement can't update the same row twice, so keep the latest
+            # of any service repeated for an item.
+            latest = {}
+            for row in rows:
+                key = (row['item_id'], row['serviceNamespace'])
+                if key not in latest or row['lastAuthenticated'] > latest[key]['lastAuthenticated']:
+                    latest[key] = row
+
+            table = AdvisorData.__table__
+            for chunk in _chunks(latest.values(), UPSERT_CHUNK_SIZE):
+                statement = postgresql.insert(table).values(chunk)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[table.c.item_id, table.c.serviceNamespace],
+                    set_=dict(lastAuthenticated=statement.excluded.lastAuthenticated),
+                    where=statement.excluded.lastAuthenticated > table.c.lastAuthenticated)
+                db.session.execute(statement)
+            return
+
+        db.session.execute(text(
+            'INSERT INTO advisor_data (item_id, "lastAuthenticated", "serviceName", "serviceNamespace", '
+            '"lastAuthenticatedEntity", "totalAuthenticatedEntities") '
+            'VALUES (:item_id, :lastAuthenticated, :serviceName, :serviceNamespace, '
+            ':lastAuthenticatedEntity, :totalAuthenticatedEntities) '
+            'ON CONFLICT (item_id, "serviceNamespace") DO UPDATE '
+            'SET "lastAuthenticated" = excluded."lastAuthenticated" '
+            'WHERE excluded."lastAuthenticated" > advisor_data."lastAuthenticated"'
+        ), rows)
+
+
+class UpdateRun(db.Model):
+    """
+    An `aardvark update` run, kept so an interrupted run can be resumed.
+    """
+    __tablename__ = "update_run"
+    id = Column(Integer, primary_key=True)
+    started = Column(TIMESTAMP, nullable=False)
+    finished = Column(TIMESTAMP)
+    role_name = Column(String(128))
+    # Whether the run's tasks are claimed through leases, so other nodes can join it
+    leased = Column(Boolean, nullable=False, default=False)
+    tasks = relationship("UpdateTask", backref="run", cascade="all, delete, delete-orphan",
+                         foreign_keys="UpdateTask.run_id")
+
+    @staticmethod
+    def latest_unfinished():
+        return UpdateRun.query.filter(UpdateRun.finished.is_(None)).order_by(UpdateRun.id.desc()).first()
+
+
+class UpdateTask(db.Model):
+    """
+    An account, or chunk of an account's ARNs, to update in a run.
+
+    status is one of pending, in_flight, split (replaced by chunk tasks),
+    done or failed. Tasks claimed through leases are held by lease_owner
+    until lease_expires, and retried tasks wait until not_before.
+    """
+    __tablename__ = "update_task"
+    __table_args__ = (UniqueConstraint("run_id", "account_number", "chunk"),)
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("update_run.id"), nullable=False, index=True)
+    account_number = Column(String(32), nullable=False)
+    chunk = Column(String(32), nullable=False, default='')
+    arns = Column(Text, nullable=False)
+    status = Column(String(16), nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    updated = Column(TIMESTAMP)
+    lease_owner = Column(String(128))
+    lease_expires = Column(TIMESTAMP)
+    not_before = Column(TIMESTAMP)
+
+
+class DataGeneration(db.Model):
+    """
+    A counter bumped whenever Access Advisor data changes, in the same
+    transaction as the change, so the API can tell clients whether anything
+    has changed since they last asked. There is only ever the one row.
+    """
+    __tablename__ = "data_generation"
+    id = Column(Integer, primary_key=True)
+    generation = Column(BigInteger, nullable=False)
+    updated = Column(TIMESTAMP, nullable=False)
+
+    @staticmethod
+    def bump():
+        """
+        Moves the generation on. Doesn't commit.
+        """
+        now = datetime.datetime.utcnow()
+        if upsert_supported():
+            db.session.execute(text(
+                'INSERT INTO data_generation (id, generation, updated) VALUES (1, 1, :updated) '
+                'ON CONFLICT (id) DO UPDATE SET generation = data_generation.generation + 1, updated = :updated'
+            ), dict(updated=now))
+            return
+
+        result = db.session.execute(text(
+            'UPDATE data_generation SET generation = generation + 1, updated = :updated WHERE id = 1'
+        ), dict(updated=now))
+        if not result.rowcount:
+            db.session.add(DataGeneration(id=1, generation=1, updated=now))
+
+    @staticmethod
+    def current():
+        """
+        :return: the DataGeneration, or None if no data has been persisted
+                 since it was added
+        """
+        return DataGeneration.query.get(1)
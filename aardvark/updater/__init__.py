@@ -1,15 +1,19 @@
-import json
-import os
-import tempfile
-import urllib
+import datetime
+import threading
+import time
 
 from cloudaux.aws.iam import list_roles, list_users
-from cloudaux.aws.sts import boto3_cached_conn
-import requests
-import subprocess32
-from subprocess32 import CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
 
-federation_base_url = 'https://signin.aws.amazon.com/federation'
+from aardvark.updater import credentials, metrics
+from aardvark.updater.collectors import get_collector
+
+
+DEFAULT_ARN_CACHE_TTL = 900  # seconds
+
+# Enumerated ARNs, keyed by account number: (expiration time, frozenset of ARNs)
+ARN_CACHE = {}
+ARN_CACHE_LOCK = threading.Lock()
 
 
 class AccountToUpdate(object):
@@ -25,61 +29,79 @@ class AccountToUpdate(object):
             'region': self.current_app.config.get('REGION') or 'us-east-1'
         }
 
-    def update_account(self):
+    def update_account(self, emit=None):
         """
         Updates Access Advisor data for a given AWS account.
         1) Gets list of IAM Role ARNs in target account.
-        2) Gets IAM credentials in target account.
-        3) Exchanges IAM credentials for Signin Token.
-        4) Calls PhantomJS to do the dirty work.
-        5) Saves PhantomJS output to our DB.
+        2) Hands the ARNs to the configured collector backend, which
+        generates and retrieves Access Advisor data for each of them.
+
+        :param emit: optional function called with each ARN and its services
+                     as soon as they are collected
+        :return: Return code and Access Advisor data for given account, keyed
+                 by ARN. When `emit` is given, data goes to it instead and
+                 none is returned.
+        """
+        return self.update_arns(self._get_arns(), emit)
 
-        :return: Return code and JSON Access Advisor data for given account
+    def update_arns(self, arns, emit=None):
         """
-        arns = self._get_arns()
+        Hands ARNs of the account that have already been enumerated to the
+        configured collector backend.
 
+        :return: as for update_account()
+        """
         if not arns:
-            self.current_app.logger.warn("Zero ARNs collected. Exiting")
-            exit(-1)
-
-        creds = self._get_creds()
-        token = _get_signin_token(creds)
-        with tempfile.NamedTemporaryFile() as f:
-            ret_code = self._call_phantom(token, list(arns), f.name)
-            if ret_code == 0:
-                return ret_code, f.read()
-            else:
-                return ret_code, None
+            self.current_app.logger.warn("Zero ARNs collected for account {}.".format(self.account_number))
+            return 0, {}
 
-    def _get_arns(self):
+        collector = get_collector(self)
+        if emit:
+            with metrics.timed('collect', self.account_number):
+                return collector.collect(list(arns), emit), None
+
+        aa_data = {}
+        with metrics.timed('collect', self.account_number):
+            ret_code = collector.collect(list(arns), aa_data.__setitem__)
+        return ret_code, aa_data if ret_code == 0 else None
+
+    def iam_client(self):
         """
-        Gets a list of all Role ARNs in a given account, optionally limited by
-        class property ARN filter
-        :return: list of role ARNs
+        Gets an IAM client in the target account.
+
+        :return: boto3 IAM client
         """
-        client = boto3_cached_conn(
-            'iam', service_type='client', **self.conn_details)
+        return credentials.iam_client(self.current_app, self.account_number, self.role_name,
+                                      self.conn_details['region'])
 
-        account_arns = set()
+    def signin_token(self):
+        """
+        Gets a federation signin token for the target account.
 
-        for role in list_roles(**self.conn_details):
-            account_arns.add(role['Arn'])
+        :return: Signin Token
+        """
+        return credentials.get_signin_token(self.current_app, self.account_number, self.role_name)
 
-        for user in list_users(**self.conn_details):
-            account_arns.add(user['Arn'])
+    def _get_arns(self):
+        """
+        Gets a list of all Role, User, Group and local Policy ARNs in a given
+        account, optionally limited by class property ARN filter.
 
-        for page in client.get_paginator('list_policies').paginate(Scope='Local'):
-            for policy in page['Policies']:
-                account_arns.add(policy['Arn'])
+        When every ARN in the account is requested, ARNs we have data for that
+        no longer exist are pruned if PRUNE_DELETED_ARNS is set. When resuming
+        a run, ARNs updated since it started are skipped.
 
-        for page in client.get_paginator('list_groups').paginate():
-            for group in page['Groups']:
-                account_arns.add(group['Arn'])
+        :return: list of ARNs
+        """
+        account_arns, fresh = self._list_account_arns()
 
         result_arns = set()
         for arn in self.arn_list:
             if arn.lower() == 'all':
-                return account_arns
+                result_arns = account_arns
+                if fresh:
+                    self._prune_deleted_arns(account_arns)
+                break
 
             if arn not in account_arns:
                 self.current_app.logger.warn("Provided ARN {arn} not found in account.".format(arn=arn))
@@ -87,77 +109,131 @@ class AccountToUpdate(object):
 
             result_arns.add(arn)
 
-        return list(result_arns)
-
-    def _get_creds(self):
-        """
-        Assumes into the target account and obtains Access Key, Secret Key, and Token
-
-        :return: URL-encoded dictionary containing Access Key, Secret Key, and Token
-        """
-        client, credentials = boto3_cached_conn(
-            'iam', account_number=self.account_number, assume_role=self.role_name, return_credentials=True)
-
-        creds = json.dumps(dict(
-            sessionId=credentials['AccessKeyId'],
-            sessionKey=credentials['SecretAccessKey'],
-            sessionToken=credentials['SessionToken']
-        ))
-        creds = urllib.quote(creds, safe='')
-        return creds
-
-    def _call_phantom(self, token, arns, output_file):
-        """
-        shells out to phantomjs.
-        - Writes ARNs to a file that phantomjs will read as an input.
-        - Phantomjs exchanges the token for session cookies.
-        - Phantomjs then navigates to the IAM page and executes JavaScript
-        to call GenerateServiceLastAccessedDetails for each ARN.
-        - Every 10 seconds, Phantomjs calls GetServiceLastAccessedDetails
-        - Phantom saves output to a file that is used by `persist()`
-
-        :return: Exit code from phantomjs subprocess32
-        """
-
-        path = os.path.dirname(__file__)
-        console_js = os.path.join(path, 'awsconsole.js')
-
-        with tempfile.NamedTemporaryFile() as f:
-            json.dump(arns, f)
-            f.seek(0)
-            try:
-                p = subprocess32.Popen([
-                    self.current_app.config.get('PHANTOMJS'),
-                    console_js,
-                    token,
-                    f.name,
-                    output_file],
-                    stdout=subprocess32.PIPE, stderr=subprocess32.STDOUT)
-                output, errs = p.communicate(timeout=1200)  # 20 mins
-                self.current_app.logger.debug('Phantom Output: \n{}'.format(output))
-                self.current_app.logger.debug('Phantom Errors: \n{}'.format(errs))
-            except subprocess32.TimeoutExpired:
-                self.current_app.logger.error('PhantomJS timed out')
-                return 1  # return code 1 for timeout
-            except CalledProcessError:
-                self.current_app.logger.error('PhantomJS exited: {}'
-                                              ''.format(p.returncode))
-                return p.returncode
-            else:
-                self.current_app.logger.info('PhantomJS exited: 0')
-                return 0
-
-
-def _get_signin_token(creds):
-    """
-    Exchanges credentials dictionary for a signin token.
-
-    1) Creates URL using credentials dictionary.
-    2) Sends a GET request to that URL and parses the response looking for
-    a signin token.
-
-    :return: Signin Token
-    """
-    url = '{base}?Action=getSigninToken&Session={creds}'
-    url = url.format(base=federation_base_url, creds=creds)
-    return requests.get(url).json()['SigninToken']
+        resume_since = self.current_app.config.get('UPDATE_RESUME_SINCE')
+        if resume_since:
+            result_arns = self._not_updated_since(result_arns, resume_since)
+
+        max_age = self.current_app.config.get('UPDATE_MAX_AGE')
+        if max_age:
+            return self._stale_arns(result_arns, max_age)
+
+        return sorted(result_arns)
+
+    def _get_chunk_arns(self):
+        """
+        Gets the ARNs of a chunk of the account. They were enumerated when the
+        account was split, so the account isn't enumerated again. When
+        resuming a run, ARNs updated since it started are skipped.
+
+        :return: list of ARNs
+        """
+        resume_since = self.current_app.config.get('UPDATE_RESUME_SINCE')
+        if resume_since:
+            return sorted(self._not_updated_since(set(self.arn_list), resume_since))
+        return list(self.arn_list)
+
+    def _list_account_arns(self):
+        """
+        Lists the account's roles, users, local policies and groups
+        concurrently. Results are cached for ARN_CACHE_TTL seconds so retries
+        and repeated runs in the same process don't enumerate again.
+
+        :return: frozenset of ARNs, and whether they were just enumerated
+                 rather than taken from the cache
+        """
+        with ARN_CACHE_LOCK:
+            expiration, account_arns = ARN_CACHE.get(self.account_number, (0, None))
+        if expiration > time.time():
+            return account_arns, False
+
+        client = self.iam_client()
+        with metrics.timed('enumerate', self.account_number), \
+                ThreadPoolExecutor(max_workers=len(ARN_LISTINGS)) as executor:
+            listings = [executor.submit(listing, client) for listing in ARN_LISTINGS]
+            account_arns = frozenset(arn for listing in listings for arn in listing.result())
+
+        ttl = self.current_app.config.get('ARN_CACHE_TTL', DEFAULT_ARN_CACHE_TTL)
+        with ARN_CACHE_LOCK:
+            ARN_CACHE[self.account_number] = (time.time() + ttl, account_arns)
+        return account_arns, True
+
+    def _prune_deleted_arns(self, account_arns):
+        """
+        Compares the ARNs just enumerated with the ARNs we have data for in
+        the account, and removes those that no longer exist when
+        PRUNE_DELETED_ARNS is set.
+        """
+        from aardvark.model import AWSIAMObject
+
+        if not account_arns:  # Don't mistake a broken listing for an empty account.
+            return
+
+        with self.current_app.app_context():
+            deleted_arns = set(AWSIAMObject.last_updated_by_arn(self.account_number)) - account_arns
+            if not deleted_arns:
+                return
+
+            if not self.current_app.config.get('PRUNE_DELETED_ARNS'):
+                self.current_app.logger.info("{} ARNs in account {} no longer exist".format(
+                                             len(deleted_arns), self.account_number))
+                return
+
+            self.current_app.logger.info("Pruning {} deleted ARNs from account {}".format(
+                                         len(deleted_arns), self.account_number))
+            AWSIAMObject.delete_arns(deleted_arns)
+
+    def _not_updated_since(self, arns, since):
+        """
+        :return: set of the ARNs that haven't been updated since the given time
+        """
+        from aardvark.model import AWSIAMObject
+
+        with self.current_app.app_context():
+            last_updated = AWSIAMObject.last_updated_by_arn(self.account_number)
+
+        remaining = set(arn for arn in arns if not last_updated.get(arn) or last_updated[arn] < since)
+        self.current_app.logger.info("Skipping {} ARNs in account {} updated since {}".format(
+                                     len(arns) - len(remaining), self.account_number, since))
+        return remaining
+
+    def _stale_arns(self, arns, max_age):
+        """
+        Limits ARNs to those whose data is older than max_age hours, or that
+        we have no data for.
+
+        :return: list of stale ARNs, stalest first
+        """
+        from aardvark.model import AWSIAMObject
+
+        with self.current_app.app_context():
+            last_updated = AWSIAMObject.last_updated_by_arn(self.account_number)
+
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=max_age)
+        stale_arns = [arn for arn in arns if not last_updated.get(arn) or last_updated[arn] < cutoff]
+        self.current_app.logger.info("{} of {} ARNs in account {} are older than {} hours".format(
+                                     len(stale_arns), len(arns), self.account_number, max_age))
+
+        return sorted(stale_arns, key=lambda arn: last_updated.get(arn) or datetime.datetime.min)
+
+
+def _list_roles(client):
+    return [role['Arn'] for role in list_roles(force_client=client)]
+
+
+def _list_users(client):
+    return [user['Arn'] for user in list_users(force_client=client)]
+
+
+def _list_local_policies(client):
+    return [policy['Arn']
+            for page in client.get_paginator('list_policies').paginate(Scope='Local')
+            for policy in page['Policies']]
+
+
+def _list_groups(client):
+    return [group['Arn']
+            for page in client.get_paginator('list_groups').paginate()
+            for group in page['Groups']]
+
+
+ARN_LISTINGS = (_list_roles, _list_users, _list_local_policies, _list_groups)
@@ -0,0 +1,168 @@
+"""
+Cached directory of accounts from SWAG.
+
+Resolving account names used to fetch every account from SWAG each time.
+Instead the directory keeps the account numbers and an index of lower-cased
+names and aliases to account numbers, fetched at most every
+ACCOUNT_CACHE_TTL seconds:
+
+- Once the directory is older than its TTL it is refreshed in a background
+  thread, and lookups carry on with the stale directory meanwhile.
+- If SWAG can't be reached the stale directory keeps being used. Only when
+  there is no directory at all do lookups wait on SWAG, and if that fails
+  no names resolve.
+- With ACCOUNT_CACHE_FILE set the directory is also saved to that file, so
+  each `aardvark update` doesn't have to go back to SWAG, and SWAG being
+  down doesn't stop updates.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from swag_client.backend import SWAGManager
+from swag_client.util import parse_swag_config_options
+
+
+DEFAULT_TTL = 3600  # seconds
+
+_directory = None
+_lock = threading.Lock()
+
+
+class AccountDirectory(object):
+    def __init__(self, account_ids, index, fetched):
+        """
+        :param account_ids: every account number, in SWAG's order
+        :param index: dictionary of lower-cased names and aliases to account numbers
+        :param fetched: epoch seconds when the accounts were fetched from SWAG
+        """
+        self.account_ids = account_ids
+        self.index = index
+        self.fetched = fetched
+        self.refreshing = False
+
+    @classmethod
+    def from_swag(cls, accounts):
+        index = {}
+        for account in accounts:
+            # get the right key, depending on whether we're using swag v1 or v2
+            alias_key = 'aliases' if account['schemaVersion'] == '2' else 'alias'
+            for name in [account['name']] + list(account.get(alias_key) or []):
+                index[name.lower()] = account['id']
+        return cls([account['id'] for account in accounts], index, time.time())
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def lookup(self, name):
+        """
+        :return: the account number for a name or alias, or None
+        """
+        return self.index.get(name.lower())
+
+    def to_json(self):
+        return json.dumps(dict(account_ids=self.account_ids, index=self.index, fetched=self.fetched))
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data['account_ids'], data['index'], data['fetched'])
+
+
+EMPTY = AccountDirectory([], {}, 0)
+
+
+def get_directory(app):
+    """
+    :return: the account directory, refreshing it in the background if it
+             is older than ACCOUNT_CACHE_TTL
+    """
+    global _directory
+    ttl = app.config.get('ACCOUNT_CACHE_TTL', DEFAULT_TTL)
+
+    with _lock:
+        if _directory is None:
+            _directory = _load(app)
+        directory = _directory
+        if directory:
+            if directory.age() >= ttl and not directory.refreshing:
+                directory.refreshing = True
+                refresh = threading.Thread(target=_refresh, args=(app, directory))
+                refresh.daemon = True
+                refresh.start()
+            return directory
+
+    # Nothing to serve until SWAG answers.
+    return _refresh(app, None) or EMPTY
+
+
+def clear():
+    global _directory
+    with _lock:
+        _directory = None
+
+
+def _refresh(app, stale):
+    """
+    Fetches the accounts from SWAG and replaces the cached directory.
+
+    :return: the new directory, or the stale one if SWAG failed
+    """
+    global _directory
+    try:
+        directory = AccountDirectory.from_swag(_fetch_accounts(app))
+    except Exception as e:
+        if stale:
+            app.logger.warn('SWAG unavailable, using accounts from {:.0f} seconds ago: {}'.format(stale.age(), e))
+            stale.refreshing = False
+        else:
+            app.logger.error('Account names passed but SWAG not configured or unavailable: {}'.format(e))
+        return stale
+
+    with _lock:
+        _directory = directory
+    _save(app, directory)
+    return directory
+
+
+def _fetch_accounts(app):
+    app.logger.info('getting accounts from SWAG')
+    swag = SWAGManager(**parse_swag_config_options(app.config.get('SWAG_OPTS')))
+
+    accounts = swag.get_all(app.config.get('SWAG_FILTER'))
+
+    service_enabled_requirement = app.config.get('SWAG_SERVICE_ENABLED_REQUIREMENT', None)
+    if service_enabled_requirement:
+        accounts = swag.get_service_enabled(service_enabled_requirement, accounts_list=accounts)
+    return accounts
+
+
+def _load(app):
+    path = app.config.get('ACCOUNT_CACHE_FILE')
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as cache:
+            return AccountDirectory.from_json(cache.read())
+    except (IOError, ValueError, KeyError) as e:
+        app.logger.warn('Ignoring unreadable account cache {}: {}'.format(path, e))
+        return None
+
+
+def _save(app, directory):
+    """
+    Writes the directory to ACCOUNT_CACHE_FILE, replacing the file in one
+    step so concurrent readers never see part of it.
+    """
+    path = app.config.get('ACCOUNT_CACHE_FILE')
+    if not path:
+        return
+    try:
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(handle, 'w') as cache:
+            cache.write(directory.to_json())
+        os.rename(temp_path, path)
+    except (IOError, OSError) as e:
+        app.logger.warn('Failed to save account cache {}: {}'.format(path, e))
@@ -1,153 +1,329 @@
+// Long-lived Access Advisor worker.
+//
+// Reads jobs from stdin, one line of JSON per job:
+//
+//   {"token": "<signinToken>", "arns": ["arn:...", ...], "output": "<output_file>",
+//    "poll_first_delay": <seconds>, "poll_interval": <seconds>}
+//
+// For each job it logs into the account with the signin token and appends a
+// line of JSON to the output file for each ARN as its job completes, with
+// the seconds its Access Advisor job took. When
+// every ARN is done it appends {"done": true, "code": <exit code>} and reads
+// the next job. It exits when stdin is closed.
 var system = require('system');
 var fs = require('fs');
 var webPage = require('webpage');
 
-if (system.args.length != 4) {
-    console.log('Usage: access_adviser.js <signinToken> <arn_file> <output_file>');
-    phantom.exit(-1);
-}
-
 var iam_url = 'https://console.aws.amazon.com/iam/home?region=us-east-1';
 var federation_base_url = 'https://signin.aws.amazon.com/federation';
+var LOGIN_TIMEOUT = 60000; // 60 seconds
+var READY_CHECK_INTERVAL = 250;
 
-var signinToken = system.args[1];
-var arn_file = system.args[2];
-var OUTPUT_FILE = system.args[3];
-
-var arns = JSON.parse(fs.read(arn_file));
-
-var page = webPage.create();
-page.settings.userAgent = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36';
-page.settings.javascriptEnabled = true;
-page.settings.loadImages = false;  //Script is much faster with this field set to false
 phantom.cookiesEnabled = true;
 phantom.javascriptEnabled = true;
 
-page.onConsoleMessage = function(msg) {
-    console.log('>>> ' + msg);
+var page = null;
+var job = null;
+
+var writeLine = function(record) {
+    fs.write(job.output, JSON.stringify(record) + '\n', 'a');
 };
 
-page.onCallback = function(results) {
-  var json_results = JSON.stringify(results, null, 2);
-  fs.write(OUTPUT_FILE, json_results, 'w');
-  phantom.exit(0);
+var finishJob = function(code) {
+    writeLine({done: true, code: code});
+    job = null;
+    setTimeout(nextJob, 0);
 };
 
-page.onResourceReceived = function(resource) {
-    if(resource.url.indexOf("signin.aws.amazon.com") > -1)
-    {
-      statusCode = resource.status;
+var newPage = function() {
+    if (page) {
+        page.close();
     }
+    phantom.clearCookies();
+
+    page = webPage.create();
+    page.settings.userAgent = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36';
+    page.settings.javascriptEnabled = true;
+    page.settings.loadImages = false;  //Script is much faster with this field set to false
+
+    page.onConsoleMessage = function(msg) {
+        console.log('>>> ' + msg);
+    };
+
+    // Each completed ARN is appended to the output file as a line of JSON as
+    // soon as it arrives, so results can be consumed while we're still running.
+    page.onCallback = function(message) {
+        if (!job) {
+            return;
+        }
+        if (message.done) {
+            finishJob(0);
+            return;
+        }
+        writeLine({arn: message.arn, seconds: message.seconds, services: message.services});
+    };
+};
+
+// Calls onReady once the console has loaded far enough to make requests,
+// rather than waiting a fixed time after login.
+var waitForConsole = function(onReady, onTimeout) {
+    var deadline = Date.now() + LOGIN_TIMEOUT;
+    var check = function() {
+        var ready = page.evaluate(function() {
+            return !!(window.Csrf && window.Csrf.fromCookie);
+        });
+        if (ready) {
+            onReady();
+        } else if (Date.now() > deadline) {
+            onTimeout();
+        } else {
+            setTimeout(check, READY_CHECK_INTERVAL);
+        }
+    };
+    check();
 };
 
-var getSessionCookies = function(token) {
+var login = function(token, arns) {
     var url = federation_base_url + '?Action=login'
                                   + '&Issuer=tripleA'
                                   + '&Destination=' + encodeURIComponent(iam_url)
                                   + '&SigninToken='+token;
 
-    statusCode = 400; // default fail
+    var statusCode = 400; // default fail
+    page.onResourceReceived = function(resource) {
+        if(resource.url.indexOf("signin.aws.amazon.com") > -1)
+        {
+          statusCode = resource.status;
+        }
+    };
 
-    var onComplete = function(response) {
-        if(statusCode < 400) {
-            console.log('Successfully logged in')
-            page.includeJs(
-                "https://ajax.googleapis.com/ajax/libs/jquery/3.1.0/jquery.min.js",
-                function() {
-                    page.evaluate(advisor, arns);
-                }
-            );
-        } else {
+    page.open(url, function(response) {
+        if (response !== 'success' || statusCode >= 400) {
             console.log('Failed to log in')
             console.log('Account '+response+'. Sample ARN: '+arns[0]);
-            phantom.exit(-1);
+            finishJob(-1);
+            return;
         }
-    };
-    page.open(url, function(response) { setTimeout(onComplete, 20000, response) });
+
+        waitForConsole(function() {
+            console.log('Successfully logged in')
+            page.evaluate(advisor, arns, {firstDelay: job.poll_first_delay * 1000,
+                                          maxInterval: job.poll_interval * 1000});
+        }, function() {
+            console.log('Timed out waiting for the console. Sample ARN: '+arns[0]);
+            finishJob(-1);
+        });
+    });
 };
 
-getSessionCookies(signinToken);
+var nextJob = function() {
+    var line = system.stdin.readLine();
+    if (!line) {
+        phantom.exit(0);
+        return;
+    }
+
+    job = JSON.parse(line);
+    if (job.arns.length === 0) {
+        finishJob(0);
+        return;
+    }
+    newPage();
+    login(job.token, job.arns);
+};
 
-var advisor = function(arns) {
-    var PERIOD = 10000; // 10 seconds
-    var results = {};
+// Runs in the console page. Requests go through the browser's own
+// XMLHttpRequest, so nothing needs to be injected into the page.
+var advisor = function(arns, poll) {
+    var PERIOD = 10000; // 10 seconds, between retries of throttled jobs
+    var MIN_POLL_DELAY = 100;
+    var MAX_IN_FLIGHT = 20;
     var progress = {};
+    // {jobID, started, checks, due, checking} keyed by ARN
+    var jobs = {};
+
+    // Jobs are started a few at a time rather than all at once. The number
+    // in flight grows while the console accepts them and halves whenever it
+    // throttles us, and throttled ARNs go back on the queue.
+    var pending = arns.slice();
+    var inFlight = 0;
+    var limit = 4;
 
     XSRF_TOKEN = window.Csrf.fromCookie(null);
-    // XSRF_TOKEN = app.orcaCsrf.token;  
+    // XSRF_TOKEN = app.orcaCsrf.token;
 
     for (var idx in arns) {
         progress[arns[idx]] = "NOT_STARTED";
     }
 
-    var checkJob = function(jobID, arn) {
-        // console.log('Inside checkJob');
-        console.log("Checking Job Status for "+jobID+"     "+arn);
-        jQuery.ajax({
-            type: "POST",
-            url: "/iam/service/iamadminproxy/GetServiceLastAccessedDetails",
-            dataType: 'json',
-            data: '{ "jobID": "'+jobID+'" }',
-            beforeSend: function(xhr) {if (XSRF_TOKEN != 'NOT_DEFINED') {xhr.setRequestHeader('X-CSRF-Token', XSRF_TOKEN);} else {system.stderr.writeLine('NOT ADDING XSRF TOKEN');console.log('NOTADDINGCSRF');}},
-            success: function (data) {
+    var post = function(url, body, success, error) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('POST', url, true);
+        // The same headers jQuery.ajax sent when the console proxy was
+        // called through it.
+        xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded; charset=UTF-8');
+        xhr.setRequestHeader('Accept', 'application/json, text/javascript, */*; q=0.01');
+        xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+        if (XSRF_TOKEN != 'NOT_DEFINED') {
+            xhr.setRequestHeader('X-CSRF-Token', XSRF_TOKEN);
+        } else {
+            console.log('NOTADDINGCSRF');
+        }
+        xhr.onreadystatechange = function() {
+            if (xhr.readyState !== 4) {
+                return;
+            }
+            if (xhr.status >= 200 && xhr.status < 300) {
+                var data;
+                try {
+                    data = JSON.parse(xhr.responseText);
+                } catch (e) {
+                    error(xhr);
+                    return;
+                }
+                success(data);
+            } else {
+                error(xhr);
+            }
+        };
+        xhr.send(JSON.stringify(body));
+    };
+
+    var isThrottled = function(xhr) {
+        return xhr.status == 429 || (xhr.responseText || '').indexOf('Throttling') > -1;
+    };
+
+    // Jobs are checked by a single polling loop. Each job is first checked
+    // after a short delay, then at intervals that double up to a maximum.
+    var interval = function(checks) {
+        return Math.min(poll.maxInterval, poll.firstDelay * Math.pow(2, checks));
+    };
+
+    var finishJob = function(arn, status) {
+        progress[arn] = status;
+        delete jobs[arn];
+        schedulePoll(Date.now());
+    };
+
+    // Runs the polling loop at the given time, unless it is already due to
+    // run sooner.
+    var pollTimer = null;
+    var pollAt = null;
+    var schedulePoll = function(at) {
+        if (pollTimer !== null) {
+            if (pollAt <= at) {
+                return;
+            }
+            clearTimeout(pollTimer);
+        }
+        pollAt = at;
+        pollTimer = setTimeout(function() {
+            pollTimer = null;
+            pollJobs();
+        }, Math.max(MIN_POLL_DELAY, at - Date.now()));
+    };
+
+    var checkJob = function(arn) {
+        var job = jobs[arn];
+        job.checking = true;
+        console.log("Checking Job Status for "+job.jobID+"     "+arn);
+        post("/iam/service/iamadminproxy/GetServiceLastAccessedDetails", {jobID: job.jobID},
+            function (data) {
                 var status = data["jobStatus"];
+                job.checking = false;
                 if (status === 'IN_PROGRESS') {
                     console.log("Job Status for "+arn+" is still IN_PROGRESS");
-                    setTimeout(function() { checkJob(jobID, arn) }, PERIOD);
+                    job.checks++;
+                    job.due = Date.now() + interval(job.checks);
+                    schedulePoll(job.due);
                 } else if (status === 'FAILED') {
                     console.log("ERROR GETTING DETAILS on " + arn + ". Skipping...");
                     console.log(JSON.stringify(data));
-                    progress[arn] = "ERROR";
+                    finishJob(arn, "ERROR");
                 } else {
-                    console.log("Job Status for "+arn+" is "+status);
-                    results[arn] = data["servicesLastAccessed"]["serviceLastAccessedList"];
-                    progress[arn] = "COMPLETE";
+                    var seconds = (Date.now() - job.started) / 1000;
+                    console.log("Job Status for "+arn+" is "+status+" after "+seconds+"s");
+                    window.callPhantom({arn: arn, seconds: seconds,
+                                        services: data["servicesLastAccessed"]["serviceLastAccessedList"]});
+                    finishJob(arn, "COMPLETE");
                 }
             },
-            error: function(asdf) {
+            function(xhr) {
+                job.checking = false;
+                if (isThrottled(xhr)) {
+                    console.log("GetServiceLastAccessedDetails throttled for "+arn+". Retrying...");
+                    job.due = Date.now() + poll.maxInterval;
+                    schedulePoll(job.due);
+                    return;
+                }
                 console.log("GetServiceLastAccessedDetails ERROR "+arn+". Skipping...");
-                console.log(JSON.stringify(asdf));
-                progress[arn] = "ERROR";
-            }
-        });
+                console.log(xhr.status+" "+xhr.responseText);
+                finishJob(arn, "ERROR");
+            });
     };
 
-    var checkProgress = function() {
-        for (idx in arns) {
+    var pollJobs = function() {
+        var now = Date.now();
+        var next = now + poll.maxInterval;
+        for (var arn in jobs) {
+            var job = jobs[arn];
+            if (job.checking) {
+                continue;
+            }
+            if (job.due <= now) {
+                checkJob(arn);
+            } else {
+                next = Math.min(next, job.due);
+            }
+        }
+
+        for (var idx in arns) {
             if (progress[arns[idx]] != "COMPLETE" && progress[arns[idx]] != "ERROR") {
-                console.log("Object "+arns[idx]+" is not yet complete. "+progress[arns[idx]]);
-                setTimeout(function() { checkProgress() }, PERIOD);
+                schedulePoll(next);
                 return;
             }
         }
         console.log("COMPLETE");
-        // console.log("Printing Results: "+JSON.stringify(results, null, 2));
-        window.callPhantom(results);
+        window.callPhantom({done: true});
+    };
+
+    var startJobs = function() {
+        while (pending.length > 0 && inFlight < Math.floor(limit)) {
+            inFlight++;
+            generateReport(pending.shift());
+        }
     };
 
     var generateReport = function(arn) {
         console.log("Generating Report for "+arn);
-        jQuery.ajax({
-            type: "POST",
-            url: "/iam/service/iamadminproxy/GenerateServiceLastAccessedDetails",
-            dataType: 'json',
-            beforeSend: function(xhr) {if (XSRF_TOKEN != 'NOT_DEFINED') {xhr.setRequestHeader('X-CSRF-Token', XSRF_TOKEN);} else {system.stderr.writeLine('NOT ADDING XSRF TOKEN');}},
-            data: '{ "arn": "'+arn+'" }',
-            success: function (data) {
-                // console.log("Generate callback arn: "+arn+" jobid: "+data["jobID"]);
+        post("/iam/service/iamadminproxy/GenerateServiceLastAccessedDetails", {arn: arn},
+            function (data) {
                 progress[arn] = "IN_PROGRESS";
-                setTimeout(function() { checkJob(data["jobID"], arn) }, PERIOD);
+                var now = Date.now();
+                jobs[arn] = {jobID: data["jobID"], started: now, checks: 0, due: now + poll.firstDelay, checking: false};
+                schedulePoll(jobs[arn].due);
+                inFlight--;
+                limit = Math.min(MAX_IN_FLIGHT, limit + 1 / limit);
+                startJobs();
             },
-            error: function(asdf) {
+            function(xhr) {
+                inFlight--;
+                if (isThrottled(xhr)) {
+                    console.log("GenerateServiceLastAccessedDetails throttled for "+arn+". Requeueing...");
+                    limit = Math.max(1, limit / 2);
+                    pending.push(arn);
+                    setTimeout(startJobs, PERIOD);
+                    return;
+                }
                 console.log("ERROR GenerateServiceLastAccessedDetails "+arn+". Skipping...");
-                console.log(JSON.stringify(asdf));
+                console.log(xhr.status+" "+xhr.responseText);
                 progress[arn] = "ERROR";
-            }
-        });
+                startJobs();
+            });
     };
 
-    for (var idx in arns) {
-        generateReport(arns[idx]);
-    }
-    checkProgress();
+    startJobs();
+    pollJobs();
 };
+
+nextJob();
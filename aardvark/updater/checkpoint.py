@@ -0,0 +1,158 @@
+"""
+Checkpoints of update runs.
+
+Each run records every account, and chunk of an account, it has to update
+as a task in the database, along with its status and attempts so far. If
+the run dies, `aardvark update --resume` picks up the tasks that hadn't
+finished. Data is persisted as each ARN is collected, so ARNs updated since
+the run started are skipped when a task is picked up again.
+"""
+import datetime
+import json
+import threading
+
+from aardvark import db
+
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+SPLIT = 'split'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Checkpoint(object):
+    def __init__(self, app, run_id, started, role_name):
+        self.app = app
+        self.run_id = run_id
+        self.started_at = started
+        self.role_name = role_name
+        # Workers share one database; keep their small writes from contending.
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, app, accounts, role_name, arns, leased=False):
+        """
+        Records a new run.
+
+        :param leased: whether the run's tasks are claimed through leases,
+                       which lets other nodes join it
+
+        :return: the checkpoint, and the queue items for the run
+        """
+        from aardvark.model import UpdateRun, UpdateTask
+
+        with app.app_context():
+            run = UpdateRun(started=datetime.datetime.utcnow(), role_name=role_name, leased=leased)
+            db.session.add(run)
+            for account_number in accounts:
+                db.session.add(UpdateTask(run=run, account_number=account_number, chunk='', arns=json.dumps(arns),
+                                          status=PENDING, attempts=0, updated=run.started))
+            db.session.commit()
+            checkpoint = cls(app, run.id, run.started, role_name)
+
+        return checkpoint, [((account_number, role_name, arns, None), 0) for account_number in accounts]
+
+    @classmethod
+    def resume(cls, app):
+        """
+        Picks up the latest run that didn't finish. Tasks that were in flight
+        when it stopped are pending again, and tasks that failed get a fresh
+        set of attempts.
+
+        :return: the checkpoint and (queue item, attempts so far) pairs for
+                 its unfinished tasks, or (None, []) if every run finished
+        """
+        from aardvark.model import UpdateRun
+
+        with app.app_context():
+            run = UpdateRun.latest_unfinished()
+            if not run:
+                return None, []
+
+            checkpoint = cls(app, run.id, run.started, run.role_name)
+            items = []
+            for task in run.tasks:
+                if task.status not in (PENDING, IN_FLIGHT, FAILED):
+                    continue
+                attempts = 0 if task.status == FAILED else task.attempts
+                task.status = PENDING
+                items.append(((task.account_number, run.role_name, json.loads(task.arns), task.chunk or None),
+                              attempts))
+            db.session.commit()
+
+        app.logger.info('Resuming run {} from {} with {} unfinished tasks'.format(
+                        checkpoint.run_id, checkpoint.started_at, len(items)))
+        return checkpoint, items
+
+    @classmethod
+    def join(cls, app):
+        """
+        Joins the latest run that didn't finish, leaving its tasks as they
+        are for other nodes working on it.
+
+        :return: the checkpoint, or None if every run finished
+        :raises RuntimeError: if the run wasn't started with leases, since
+                              its node works from an in-memory queue and
+                              would update the same tasks again
+        """
+        from aardvark.model import UpdateRun
+
+        with app.app_context():
+            run = UpdateRun.latest_unfinished()
+            if not run:
+                return None
+            if not run.leased:
+                raise RuntimeError('Run {} was not started with --lease, so it cannot be joined'.format(run.id))
+            return cls(app, run.id, run.started, run.role_name)
+
+    def started(self, item, attempt):
+        self._update(item, status=IN_FLIGHT, attempts=attempt + 1)
+
+    def retrying(self, item, error):
+        self._update(item, status=PENDING, error=str(error))
+
+    def finished(self, item):
+        self._update(item, status=DONE, error=None)
+
+    def failed(self, item, error):
+        self._update(item, status=FAILED, error=str(error))
+
+    def split(self, item, chunks):
+        """
+        Replaces an account's task with tasks for its chunks.
+        """
+        from aardvark.model import UpdateTask
+
+        now = datetime.datetime.utcnow()
+        with self._lock, self.app.app_context():
+            for account_number, _, arns, chunk in chunks:
+                db.session.add(UpdateTask(run_id=self.run_id, account_number=account_number, chunk=chunk,
+                                          arns=json.dumps(arns), status=PENDING, attempts=0, updated=now))
+            self._task(item).update(dict(status=SPLIT, updated=now), synchronize_session=False)
+            db.session.commit()
+
+    def close(self):
+        """
+        Marks the run finished, so it won't be resumed.
+        """
+        from aardvark.model import UpdateRun
+
+        with self._lock, self.app.app_context():
+            UpdateRun.query.filter(UpdateRun.id == self.run_id).update(
+                dict(finished=datetime.datetime.utcnow()), synchronize_session=False)
+            db.session.commit()
+
+    def _update(self, item, **values):
+        values['updated'] = datetime.datetime.utcnow()
+        with self._lock, self.app.app_context():
+            self._task(item).update(values, synchronize_session=False)
+            db.session.commit()
+
+    def _task(self, item):
+        from aardvark.model import UpdateTask
+
+        account_number, _, _, chunk = item
+        return UpdateTask.query.filter(UpdateTask.run_id == self.run_id,
+                                       UpdateTask.account_number == account_number,
+                                       UpdateTask.chunk == (chunk or ''))
@@ -0,0 +1,315 @@
+"""
+Access Advisor collector backends.
+
+A collector is handed the ARNs of a single account and is responsible for
+generating and retrieving the Access Advisor (service last accessed) data
+for each of them. Each ARN's services are passed to an `emit(arn, services)`
+callback as soon as its job completes, in the format the AWS console uses:
+
+[
+  {
+    "totalAuthenticatedEntities": 1,
+    "lastAuthenticatedEntity": "arn:aws:iam::XXXXXXXX:role/name",
+    "serviceName": "Amazon Simple Systems Manager",
+    "lastAuthenticated": 1489176000000,
+    "serviceNamespace": "ssm"
+  }
+]
+
+The backend is selected with the COLLECTOR config value.
+"""
+import calendar
+import time
+
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from aardvark.updater import phantompool, ratelimit
+
+
+DEFAULT_COLLECTOR = 'iam'
+DEFAULT_POLL_INTERVAL = 10  # seconds, the longest wait between checks on a job
+DEFAULT_POLL_FIRST_DELAY = 1  # seconds
+POLL_BACKOFF_FACTOR = 2
+
+
+class Collector(object):
+    """
+    Base class for collector backends.
+    """
+    name = None
+
+    def __init__(self, account):
+        """
+        :param account: the AccountToUpdate being collected
+        """
+        self.account = account
+        self.current_app = account.current_app
+
+        config = self.current_app.config
+        self.poll_interval = config.get('IAM_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+        self.poll_first_delay = min(self.poll_interval, config.get('IAM_POLL_FIRST_DELAY', DEFAULT_POLL_FIRST_DELAY))
+
+    def collect(self, arns, emit):
+        """
+        Retrieves Access Advisor data for the given ARNs, passing each ARN and
+        its services to `emit` as they arrive.
+
+        :return: Return code
+        """
+        raise NotImplementedError
+
+
+class IAMCollector(Collector):
+    """
+    Calls GenerateServiceLastAccessedDetails and GetServiceLastAccessedDetails
+    directly through the IAM API. Calls are made concurrently, as fast as the
+    account's rate limiter allows.
+    """
+    name = 'iam'
+
+    def __init__(self, account):
+        super(IAMCollector, self).__init__(account)
+        self.limiter = ratelimit.limiter(self.current_app, account.account_number)
+        # ARNs whose data couldn't be retrieved in the current collection
+        self.failed_arns = set()
+
+    def collect(self, arns, emit):
+        """
+        ARNs whose data could not be retrieved don't stop the rest being
+        collected, but make the return code non-zero so the account is
+        retried or recorded as failed.
+
+        :return: 0 if every ARN's data was retrieved, otherwise 1
+        """
+        client = self.account.iam_client()
+        self.failed_arns = set()
+
+        with ThreadPoolExecutor(max_workers=self.limiter.concurrency.maximum) as executor:
+            job_ids = executor.map(lambda arn: self.generate_job(client, arn), arns)
+            poller = self.poller((arn, job_id) for arn, job_id in zip(arns, job_ids) if job_id)
+
+            while poller:
+                time.sleep(poller.wait_time())
+                due = poller.due()
+                checks = executor.map(lambda job: self.check_job(client, *job), due)
+                for (arn, _), (done, services) in zip(due, checks):
+                    poller.checked(arn, done)
+                    if done and services is not None:
+                        emit(arn, services)
+
+        log_job_times(self.current_app, self.account.account_number, poller.job_seconds)
+        return self.return_code(len(arns))
+
+    def return_code(self, arn_count):
+        """
+        :return: 0 if no ARN failed, otherwise 1, having logged the failures
+        """
+        if not self.failed_arns:
+            return 0
+        self.current_app.logger.error('Failed to collect {} of {} ARNs for account {}'.format(
+                                      len(self.failed_arns), arn_count, self.account.account_number))
+        return 1
+
+    def poller(self, jobs):
+        """
+        :param jobs: (ARN, job ID) pairs
+        :return: JobPoller scheduling checks on the jobs
+        """
+        return JobPoller(jobs, self.poll_first_delay, self.poll_interval)
+
+    def generate_job(self, client, arn):
+        """
+        Starts an Access Advisor job for an ARN.
+
+        :return: Job ID, or None if the job could not be started. ARNs
+                 that failed, other than ones that no longer exist, are
+                 added to `failed_arns`.
+        """
+        try:
+            return self.limiter.call(client.generate_service_last_accessed_details, Arn=arn)['JobId']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchEntity':
+                self.current_app.logger.warn('{} no longer exists'.format(arn))
+                return None
+            self.current_app.logger.error('GenerateServiceLastAccessedDetails failed for {}: {}'.format(arn, e))
+            self.failed_arns.add(arn)
+            return None
+
+    def check_job(self, client, arn, job_id):
+        """
+        Checks on an Access Advisor job.
+
+        :return: Whether the job is finished, and its services in console
+                 format (None unless it completed successfully). ARNs
+                 whose jobs failed are added to `failed_arns`.
+        """
+        try:
+            status, services = self._get_job(client, job_id, self.limiter)
+        except ClientError as e:
+            self.current_app.logger.error('GetServiceLastAccessedDetails failed for {}: {}'.format(arn, e))
+            self.failed_arns.add(arn)
+            return True, None
+
+        if status == 'IN_PROGRESS':
+            return False, None
+
+        if status != 'COMPLETED':
+            self.current_app.logger.error('Access Advisor job for {} ended with status {}'.format(arn, status))
+            self.failed_arns.add(arn)
+        return True, services
+
+    @staticmethod
+    def _get_job(client, job_id, limiter):
+        """
+        Gets the status of a job, and its results if it has completed.
+
+        :return: job status and list of services in console format
+        """
+        services = []
+        kwargs = dict(JobId=job_id)
+        while True:
+            response = limiter.call(client.get_service_last_accessed_details, **kwargs)
+            if response['JobStatus'] != 'COMPLETED':
+                return response['JobStatus'], None
+
+            services.extend(_console_format(service) for service in response['ServicesLastAccessed'])
+            if not response.get('IsTruncated'):
+                return response['JobStatus'], services
+            kwargs['Marker'] = response['Marker']
+
+
+class JobPoller(object):
+    """
+    Schedules checks on Access Advisor jobs. A job is first checked after a
+    short delay, then at intervals that double up to a maximum, so short jobs
+    finish quickly and long ones aren't checked needlessly often. The time
+    each job took, from being polled for to finishing, is recorded in
+    `job_seconds`.
+    """
+
+    def __init__(self, jobs, first_delay, max_interval):
+        self.first_delay = first_delay
+        self.max_interval = max_interval
+        self.job_seconds = {}
+
+        now = time.time()
+        # [job ID, time started, checks so far, time due] keyed by ARN
+        self._jobs = dict((arn, [job_id, now, 0, now + first_delay]) for arn, job_id in jobs)
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def interval(self, checks):
+        """
+        :return: seconds to wait after a job has been checked `checks` times
+        """
+        return min(self.max_interval, self.first_delay * POLL_BACKOFF_FACTOR ** checks)
+
+    def wait_time(self):
+        """
+        :return: seconds until the next job is due to be checked
+        """
+        return max(0, min(job[3] for job in self._jobs.values()) - time.time())
+
+    def due(self):
+        """
+        :return: (ARN, job ID) pairs for jobs due to be checked
+        """
+        now = time.time()
+        return [(arn, job[0]) for arn, job in self._jobs.items() if job[3] <= now]
+
+    def checked(self, arn, done):
+        now = time.time()
+        job = self._jobs[arn]
+        if done:
+            del self._jobs[arn]
+            self.job_seconds[arn] = now - job[1]
+            return
+
+        job[2] += 1
+        job[3] = now + self.interval(job[2])
+
+
+class PhantomJSCollector(Collector):
+    """
+    Logs into the AWS console with a federated signin token and has PhantomJS
+    drive the console's Access Advisor calls.
+    """
+    name = 'phantomjs'
+
+    def collect(self, arns, emit):
+        """
+        Hands the account to a worker from this process's PhantomJS pool.
+        - PhantomJS exchanges the token for session cookies.
+        - PhantomJS then navigates to the IAM page and executes JavaScript
+        to call GenerateServiceLastAccessedDetails for each ARN.
+        - PhantomJS polls GetServiceLastAccessedDetails for each job, first
+        after a short delay and then with backoff up to the poll interval
+        - PhantomJS appends a line of JSON to an output file for each ARN as
+        its job completes, which is read back and emitted while it runs.
+
+        :return: exit code for the account from PhantomJS
+        """
+        token = self.account.signin_token()
+        job_seconds = {}
+        job = dict(token=token, arns=arns, poll_first_delay=self.poll_first_delay, poll_interval=self.poll_interval)
+        ret_code = phantompool.get_pool(self.current_app).run(job, emit, job_seconds)
+        log_job_times(self.current_app, self.account.account_number, job_seconds)
+        self.current_app.logger.info('PhantomJS finished account {}: {}'.format(self.account.account_number, ret_code))
+        return ret_code
+
+
+COLLECTORS = {
+    IAMCollector.name: IAMCollector,
+    PhantomJSCollector.name: PhantomJSCollector,
+}
+
+
+def get_collector(account):
+    """
+    Builds the collector named by the COLLECTOR config value for an account.
+    """
+    name = account.current_app.config.get('COLLECTOR') or DEFAULT_COLLECTOR
+    try:
+        collector_class = COLLECTORS[name]
+    except KeyError:
+        raise ValueError('Unknown collector {}, expected one of {}'.format(name, ', '.join(sorted(COLLECTORS))))
+    return collector_class(account)
+
+
+def log_job_times(app, account_number, job_seconds):
+    """
+    Logs how long an account's Access Advisor jobs took, to help tune the
+    polling schedule.
+
+    :param job_seconds: dictionary of seconds taken, keyed by ARN
+    """
+    if not job_seconds:
+        return
+    seconds = sorted(job_seconds.values())
+    app.logger.info('Access Advisor jobs for account {}: {} finished, median {:.1f}s, 90th percentile {:.1f}s, '
+                    'max {:.1f}s'.format(account_number, len(seconds), seconds[len(seconds) // 2],
+                                         seconds[int(len(seconds) * 0.9)], seconds[-1]))
+    for arn, arn_seconds in sorted(job_seconds.items()):
+        app.logger.debug('Access Advisor job for {} took {:.1f}s'.format(arn, arn_seconds))
+
+
+def _console_format(service):
+    """
+    Converts a ServiceLastAccessed structure from the IAM API into the
+    format returned by the console.
+    """
+    last_authenticated = service.get('LastAuthenticated')
+    if last_authenticated:
+        last_authenticated = calendar.timegm(last_authenticated.utctimetuple()) * 1000
+    else:
+        last_authenticated = 0
+
+    return dict(
+        lastAuthenticated=last_authenticated,
+        serviceName=service['ServiceName'],
+        serviceNamespace=service['ServiceNamespace'],
+        lastAuthenticatedEntity=service.get('LastAuthenticatedEntity'),
+        totalAuthenticatedEntities=service.get('TotalAuthenticatedEntities', 0)
+    )
@@ -0,0 +1,172 @@
+"""
+Cached credentials, signin tokens and connections for target accounts.
+
+Assumed-role credentials are reused until shortly before they expire, and
+federation signin tokens for as long as they are valid, so retries and
+concurrent workers don't call STS or the federation endpoint for every
+attempt. IAM clients are kept per account for as long as their credentials
+last so their connection pools are reused, and federation requests go
+through a keep-alive `requests.Session` per thread.
+"""
+import datetime
+import json
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from dateutil.tz import tzutc
+import requests
+from requests.adapters import HTTPAdapter
+
+from aardvark.updater import metrics
+
+
+federation_base_url = 'https://signin.aws.amazon.com/federation'
+
+SESSION_NAME = 'aardvark'
+CREDENTIALS_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+SIGNIN_TOKEN_LIFETIME = 15 * 60  # seconds
+SIGNIN_TOKEN_REFRESH_MARGIN = 60  # seconds
+FEDERATION_TIMEOUT = 30  # seconds
+DEFAULT_HTTP_POOL_SIZE = 10
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# STS credentials keyed by (account number, role name)
+CREDENTIALS_CACHE = {}
+# (expiration time, credentials the token was made from, token) keyed by (account number, role name)
+SIGNIN_TOKEN_CACHE = {}
+# (credentials the client was made with, client) keyed by (account number, role name, region, endpoint)
+IAM_CLIENT_CACHE = {}
+# STS clients keyed by endpoint URL
+STS_CLIENTS = {}
+
+_cache_lock = threading.Lock()
+_key_locks = {}
+# boto3 sessions aren't safe to create concurrently.
+_session_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_credentials(app, account_number, role_name):
+    """
+    Assumes into the target account, reusing earlier credentials until they
+    are about to expire.
+
+    :return: STS credentials dictionary
+    """
+    key = (account_number, role_name)
+    with _key_lock(key):
+        credentials = CREDENTIALS_CACHE.get(key)
+        if credentials and credentials['Expiration'] > datetime.datetime.now(tzutc()) + CREDENTIALS_REFRESH_MARGIN:
+            return credentials
+
+        role_arn = 'arn:aws:iam::{}:role/{}'.format(account_number, role_name)
+        with metrics.timed('assume_role', account_number):
+            credentials = _sts_client(app).assume_role(RoleArn=role_arn, RoleSessionName=SESSION_NAME)['Credentials']
+        CREDENTIALS_CACHE[key] = credentials
+        return credentials
+
+
+def get_signin_token(app, account_number, role_name):
+    """
+    Exchanges credentials for a federation signin token, reusing an earlier
+    token while it is still valid.
+
+    :return: Signin Token
+    """
+    credentials = get_credentials(app, account_number, role_name)
+
+    key = (account_number, role_name)
+    with _key_lock(('signin',) + key):
+        expiration, token_credentials, token = SIGNIN_TOKEN_CACHE.get(key, (0, None, None))
+        if expiration > time.time() and token_credentials is credentials:
+            return token
+
+        session = json.dumps(dict(
+            sessionId=credentials['AccessKeyId'],
+            sessionKey=credentials['SecretAccessKey'],
+            sessionToken=credentials['SessionToken']
+        ))
+        with metrics.timed('signin', account_number):
+            response = http_session(app).get(
+                app.config.get('FEDERATION_URL') or federation_base_url,
+                params=dict(Action='getSigninToken', Session=session),
+                timeout=FEDERATION_TIMEOUT)
+            response.raise_for_status()
+            token = response.json()['SigninToken']
+
+        SIGNIN_TOKEN_CACHE[key] = (time.time() + SIGNIN_TOKEN_LIFETIME - SIGNIN_TOKEN_REFRESH_MARGIN,
+                                   credentials, token)
+        return token
+
+
+def iam_client(app, account_number, role_name, region):
+    """
+    Gets an IAM client in the target account, reusing the client (and its
+    connection pool) for as long as its credentials are current.
+
+    If IAM_ENDPOINT_URL is configured the client talks to that endpoint
+    instead. Without STS_ENDPOINT_URL as well, it uses the ambient
+    credentials rather than assuming into the account. This is meant for
+    running against local stubs of the AWS APIs.
+
+    :return: boto3 IAM client
+    """
+    endpoint_url = app.config.get('IAM_ENDPOINT_URL')
+    if endpoint_url and not app.config.get('STS_ENDPOINT_URL'):
+        credentials = None
+    else:
+        credentials = get_credentials(app, account_number, role_name)
+
+    key = (account_number, role_name, region, endpoint_url)
+    with _cache_lock:
+        client_credentials, client = IAM_CLIENT_CACHE.get(key, (None, None))
+    if client and client_credentials is credentials:
+        return client
+
+    kwargs = dict(region_name=region, endpoint_url=endpoint_url, config=Config(
+        max_pool_connections=app.config.get('IAM_MAX_POOL_CONNECTIONS') or DEFAULT_MAX_POOL_CONNECTIONS))
+    if credentials:
+        kwargs.update(aws_access_key_id=credentials['AccessKeyId'],
+                      aws_secret_access_key=credentials['SecretAccessKey'],
+                      aws_session_token=credentials['SessionToken'])
+    with _session_lock:
+        client = boto3.session.Session().client('iam', **kwargs)
+
+    with _cache_lock:
+        IAM_CLIENT_CACHE[key] = (credentials, client)
+    return client
+
+
+def http_session(app):
+    """
+    :return: this thread's keep-alive HTTP session
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        pool_size = app.config.get('HTTP_POOL_SIZE') or DEFAULT_HTTP_POOL_SIZE
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        session.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        _local.session = session
+    return session
+
+
+def _sts_client(app):
+    endpoint_url = app.config.get('STS_ENDPOINT_URL')
+    with _session_lock:
+        if endpoint_url not in STS_CLIENTS:
+            STS_CLIENTS[endpoint_url] = boto3.session.Session().client(
+                'sts', endpoint_url=endpoint_url, region_name=app.config.get('REGION') or 'us-east-1')
+        return STS_CLIENTS[endpoint_url]
+
+
+def _key_lock(key):
+    """
+    :return: the lock serializing refreshes of one cache entry, so concurrent
+             workers for the same account wait for one refresh rather than
+             all making the same call
+    """
+    with _cache_lock:
+        return _key_locks.setdefault(key, threading.Lock())
@@ -0,0 +1,279 @@
+"""
+Event loop collection engine.
+
+Collection is almost entirely waiting on AWS, so rather than dedicating an
+OS thread to each account, the engine runs every account as a coroutine in
+a single loop. Coroutines are plain generators that yield what they are
+waiting for:
+
+- `Call(fn, *args, **kwargs)` runs a blocking call (boto3, HTTP) on the
+  engine's I/O pool and sends its result back, or throws its exception.
+- `DBCall(fn, *args, **kwargs)` is the same, but runs on the single
+  database thread so writes are serialized.
+- `Sleep(seconds)` resumes the coroutine after a delay without holding a
+  thread.
+- A list of calls runs them concurrently and sends back a list of results,
+  with exceptions returned in place of results for calls that failed.
+
+Concurrency is limited globally (calls in flight and accounts in flight)
+and per account (calls in flight for a single account).
+"""
+import collections
+import heapq
+import itertools
+import Queue
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from aardvark.updater import metrics
+from aardvark.updater.collectors import IAMCollector, get_collector, log_job_times
+from aardvark.updater.sharding import chunk_arns
+
+
+DEFAULT_MAX_CALLS = 50
+DEFAULT_MAX_ACCOUNTS = 200
+DEFAULT_ACCOUNT_CONCURRENCY = 10
+
+
+class Call(object):
+    pool = 'io'
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+
+class DBCall(Call):
+    pool = 'db'
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class _Task(object):
+    def __init__(self, key, coro):
+        self.key = key
+        self.coro = coro
+        self.results = None
+        self.remaining = 0
+
+
+class Engine(object):
+    def __init__(self, app, max_calls=None, max_accounts=None, account_concurrency=None):
+        self.app = app
+        self.max_calls = max_calls or app.config.get('ASYNC_MAX_CALLS') or DEFAULT_MAX_CALLS
+        self.max_accounts = max_accounts or app.config.get('ASYNC_MAX_ACCOUNTS') or DEFAULT_MAX_ACCOUNTS
+        self.account_concurrency = (account_concurrency or app.config.get('ASYNC_ACCOUNT_CONCURRENCY') or
+                                    DEFAULT_ACCOUNT_CONCURRENCY)
+
+        self.failed = {}
+        self._ready = collections.deque()
+        self._waiting_calls = collections.deque()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._completed = Queue.Queue()
+        self._tasks = set()
+        self._in_flight = 0
+        self._in_flight_by_key = collections.Counter()
+
+    def run(self, coroutines):
+        """
+        Runs coroutines to completion.
+
+        :param coroutines: iterable of (key, generator) pairs. The key
+                           identifies the account for per-account limits.
+        :return: dictionary of keys whose coroutine raised, with the exception
+        """
+        queued = collections.deque(coroutines)
+        executors = {
+            'io': ThreadPoolExecutor(max_workers=self.max_calls),
+            'db': ThreadPoolExecutor(max_workers=1),
+        }
+        try:
+            while queued or self._tasks:
+                while queued and len(self._tasks) < self.max_accounts:
+                    task = _Task(*queued.popleft())
+                    self._tasks.add(task)
+                    self._ready.append((task, None, None))
+
+                while self._ready:
+                    self._step(*self._ready.popleft())
+
+                self._dispatch(executors)
+                self._wait()
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=False)
+
+        return self.failed
+
+    def _step(self, task, value, exc):
+        try:
+            if exc is not None:
+                yielded = task.coro.throw(exc)
+            else:
+                yielded = task.coro.send(value)
+        except StopIteration:
+            self._tasks.discard(task)
+            return
+        except Exception as e:
+            self.app.logger.error('Collection for {} failed: {}'.format(task.key, e))
+            self.failed[task.key] = e
+            self._tasks.discard(task)
+            return
+
+        if isinstance(yielded, Sleep):
+            heapq.heappush(self._timers, (time.time() + yielded.seconds, next(self._timer_seq), task))
+        elif isinstance(yielded, Call):
+            task.results = None
+            task.remaining = 1
+            self._waiting_calls.append((task, None, yielded))
+        else:
+            calls = list(yielded)
+            task.results = [None] * len(calls)
+            task.remaining = len(calls)
+            if not calls:
+                self._ready.append((task, [], None))
+            for index, call in enumerate(calls):
+                self._waiting_calls.append((task, index, call))
+
+    def _dispatch(self, executors):
+        deferred = collections.deque()
+        while self._waiting_calls and self._in_flight < self.max_calls:
+            task, index, call = self._waiting_calls.popleft()
+            if self._in_flight_by_key[task.key] >= self.account_concurrency:
+                deferred.append((task, index, call))
+                continue
+
+            self._in_flight += 1
+            self._in_flight_by_key[task.key] += 1
+            future = executors[call.pool].submit(call)
+            future.add_done_callback(
+                lambda f, task=task, index=index: self._completed.put((task, index, f)))
+        deferred.extend(self._waiting_calls)
+        self._waiting_calls = deferred
+
+    def _wait(self):
+        """
+        Blocks until a call completes or a timer is due, then queues the
+        coroutines that can continue.
+        """
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        else:
+            timeout = None
+
+        completed = []
+        if self._in_flight:
+            try:
+                completed.append(self._completed.get(timeout=timeout))
+                while True:
+                    completed.append(self._completed.get_nowait())
+            except Queue.Empty:
+                pass
+        elif timeout:
+            time.sleep(timeout)
+
+        for task, index, future in completed:
+            self._in_flight -= 1
+            self._in_flight_by_key[task.key] -= 1
+            task.remaining -= 1
+            if index is None:
+                self._ready.append((task, None if future.exception() else future.result(), future.exception()))
+                continue
+
+            task.results[index] = future.exception() or future.result()
+            if not task.remaining:
+                self._ready.append((task, task.results, None))
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            self._ready.append((heapq.heappop(self._timers)[2], None, None))
+
+
+def update_account(account, persist, chunk_size=None):
+    """
+    Coroutine that collects and persists Access Advisor data for an account.
+
+    With the IAM collector every job is generated and polled through the
+    engine, and results are persisted after each polling round. Other
+    collectors are run as blocking calls, one for each chunk of up to
+    chunk_size ARNs.
+
+    :param account: AccountToUpdate
+    :param persist: function taking the app and Access Advisor data, run on
+                    the database thread
+    :param chunk_size: number of ARNs to give each call of a collector other
+                       than the IAM collector, or None for all of them
+    :raises RuntimeError: once everything that could be collected has been
+                          persisted, if any ARN's data could not be
+    """
+    app = account.current_app
+    arns = yield Call(account._get_arns)
+    if not arns:
+        app.logger.warn("Zero ARNs collected for account {}.".format(account.account_number))
+        return
+    arns = list(arns)
+
+    collector = get_collector(account)
+    if not isinstance(collector, IAMCollector):
+        # Chunks of the account are collected concurrently, and whatever
+        # they collected is persisted even if some of them failed.
+        results = {}
+        ret_codes = yield [Call(collector.collect, chunk, results.__setitem__)
+                           for chunk in chunk_arns(arns, chunk_size or len(arns))]
+        if results:
+            yield DBCall(persist, app, results)
+        failed = [ret_code for ret_code in ret_codes if ret_code != 0]
+        if failed:
+            raise RuntimeError('{} collector failed for {} of {} chunks: {}'.format(
+                               collector.name, len(failed), len(ret_codes), failed[0]))
+        return
+
+    client = yield Call(account.iam_client)
+    start = time.time()
+    job_ids = yield [Call(collector.generate_job, client, arn) for arn in arns]
+    for arn, job_id in zip(arns, job_ids):
+        if isinstance(job_id, Exception):
+            app.logger.error('Starting Access Advisor job for {} failed: {}'.format(arn, job_id))
+            collector.failed_arns.add(arn)
+    poller = collector.poller((arn, job_id) for arn, job_id in zip(arns, job_ids)
+                              if job_id and not isinstance(job_id, Exception))
+
+    while poller:
+        yield Sleep(poller.wait_time())
+        due = poller.due()
+        checks = yield [Call(collector.check_job, client, arn, job_id) for arn, job_id in due]
+
+        results = {}
+        for (arn, _), check in zip(due, checks):
+            if isinstance(check, Exception):
+                app.logger.error('Checking Access Advisor job for {} failed: {}'.format(arn, check))
+                collector.failed_arns.add(arn)
+                poller.checked(arn, True)
+                continue
+
+            done, services = check
+            poller.checked(arn, done)
+            if done and services is not None:
+                results[arn] = services
+
+        # Persist each round's results as they arrive rather than holding
+        # the whole account until the end.
+        if results:
+            yield DBCall(persist, app, results)
+
+    # Includes persisting between polling rounds, which is also timed on its own.
+    metrics.METRICS.observe('collect', account.account_number, time.time() - start)
+    log_job_times(app, account.account_number, poller.job_seconds)
+    if collector.return_code(len(arns)) != 0:
+        raise RuntimeError('iam collector failed for {} of {} ARNs'.format(len(collector.failed_arns), len(arns)))
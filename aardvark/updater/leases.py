@@ -0,0 +1,206 @@
+"""
+Work queue shared by update nodes through leases in the database.
+
+Several hosts or containers can work through one run without overlapping:
+each claims the run's tasks (accounts, or chunks of accounts) from the
+checkpoint's task table, holding a lease on each task it claims for
+UPDATE_LEASE_SECONDS. A node renews the leases it holds while it works on
+them, so a lease only expires when its node has died, after which the task
+can be claimed by any other node.
+
+On Postgres claims use SELECT ... FOR UPDATE SKIP LOCKED, so nodes never
+wait on each other's claims. Elsewhere (SQLite for local testing) a claim
+is an UPDATE conditional on the task still being claimable, and a node that
+loses the race tries the next task.
+
+The queue has the same interface as AccountQueue. Task status is otherwise
+kept by the checkpoint, so chunks put back on the queue are already in the
+task table and nothing more needs doing for them.
+"""
+import datetime
+import json
+import os
+import random
+import socket
+import threading
+
+from sqlalchemy import and_, or_
+
+from aardvark import db
+from aardvark.updater.checkpoint import FAILED, IN_FLIGHT, PENDING
+from aardvark.updater.workqueue import DEFAULT_BACKOFF_BASE, DEFAULT_BACKOFF_MAX, DEFAULT_MAX_ATTEMPTS
+
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_POLL_INTERVAL = 5  # seconds between looks for work when none is claimable
+CLAIM_CANDIDATES = 10
+
+
+class LeaseQueue(object):
+    def __init__(self, app, checkpoint, owner=None, lease_seconds=None, poll_interval=None):
+        self.app = app
+        self.checkpoint = checkpoint
+        self.owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds or app.config.get('UPDATE_LEASE_SECONDS') or DEFAULT_LEASE_SECONDS
+        self.poll_interval = poll_interval or app.config.get('UPDATE_LEASE_POLL_INTERVAL') or DEFAULT_POLL_INTERVAL
+        self.max_attempts = app.config.get('UPDATE_MAX_ATTEMPTS') or DEFAULT_MAX_ATTEMPTS
+        self.backoff_base = app.config.get('UPDATE_BACKOFF_BASE', DEFAULT_BACKOFF_BASE)
+        self.backoff_max = app.config.get('UPDATE_BACKOFF_MAX', DEFAULT_BACKOFF_MAX)
+        self.failed = []
+        self._closed = threading.Event()
+
+        heartbeat = threading.Thread(target=self._heartbeat)
+        heartbeat.daemon = True
+        heartbeat.start()
+
+    def put(self, item, attempt=0, delay=0):
+        """
+        Does nothing: the checkpoint has already added the item's task.
+        """
+
+    def get(self):
+        """
+        Blocks until a task can be claimed.
+
+        :return: the claimed item and the number of previous attempts at it,
+                 or (None, None) once the run has no work left or the queue
+                 has been closed
+        """
+        while not self._closed.is_set():
+            claimed = self._claim()
+            if claimed:
+                return claimed
+            if not self._remaining():
+                return None, None
+            self._closed.wait(self.poll_interval)
+        return None, None
+
+    def retry(self, item, attempt, error):
+        """
+        Releases a failed item's lease so it can be claimed again after a
+        backoff, or records it as failed once it has used all its attempts.
+
+        :return: True if the item will be retried
+        """
+        attempt += 1
+        if attempt >= self.max_attempts:
+            self.failed.append((item, attempt, error))
+            return False
+
+        from aardvark.model import UpdateTask
+
+        account_number, _, _, chunk = item
+        not_before = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.backoff(attempt))
+        with self.app.app_context():
+            UpdateTask.query.filter(UpdateTask.run_id == self.checkpoint.run_id,
+                                    UpdateTask.account_number == account_number,
+                                    UpdateTask.chunk == (chunk or '')).update(
+                dict(lease_owner=None, lease_expires=None, not_before=not_before), synchronize_session=False)
+            db.session.commit()
+        return True
+
+    def depth(self):
+        """
+        :return: number of the run's tasks left, on every node
+        """
+        return self._remaining()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def task_done(self):
+        pass
+
+    def join(self):
+        """
+        Blocks until no task in the run is pending or in flight on any node.
+        """
+        while self._remaining():
+            self._closed.wait(self.poll_interval)
+
+    def close(self):
+        self._closed.set()
+
+    def _claim(self):
+        """
+        Claims the next claimable task, leasing it to this node.
+
+        :return: (item, previous attempts) or None if nothing is claimable
+        """
+        from aardvark.model import UpdateTask, skip_locked_supported
+
+        with self.app.app_context():
+            while True:
+                now = datetime.datetime.utcnow()
+                query = UpdateTask.query.filter(self._claimable(now)).order_by(UpdateTask.id)
+                if skip_locked_supported():
+                    candidates = query.limit(1).with_for_update(skip_locked=True).all()
+                else:
+                    candidates = query.limit(CLAIM_CANDIDATES).all()
+                if not candidates:
+                    db.session.commit()
+                    return None
+
+                for task in candidates:
+                    if task.status == IN_FLIGHT and task.attempts >= self.max_attempts:
+                        # The nodes that tried this task died working on it.
+                        self._expire(task, now)
+                        continue
+
+                    lease = dict(status=IN_FLIGHT, lease_owner=self.owner,
+                                 lease_expires=now + datetime.timedelta(seconds=self.lease_seconds))
+                    claimed = UpdateTask.query.filter(UpdateTask.id == task.id, self._claimable(now)).update(
+                        lease, synchronize_session=False)
+                    db.session.commit()
+                    if claimed:
+                        item = (task.account_number, self.checkpoint.role_name, json.loads(task.arns),
+                                task.chunk or None)
+                        return item, task.attempts
+                # Every candidate was claimed by another node first; look again.
+
+    def _expire(self, task, now):
+        from aardvark.model import UpdateTask
+
+        error = 'lease expired after {} attempts'.format(task.attempts)
+        UpdateTask.query.filter(UpdateTask.id == task.id, self._claimable(now)).update(
+            dict(status=FAILED, error=error, updated=now), synchronize_session=False)
+        db.session.commit()
+        self.app.logger.error('Giving up on account {} chunk {}: {}'.format(task.account_number, task.chunk, error))
+
+    def _claimable(self, now):
+        from aardvark.model import UpdateTask
+
+        return and_(UpdateTask.run_id == self.checkpoint.run_id,
+                    or_(and_(UpdateTask.status == PENDING,
+                             or_(UpdateTask.not_before.is_(None), UpdateTask.not_before <= now)),
+                        and_(UpdateTask.status == IN_FLIGHT, UpdateTask.lease_expires < now)))
+
+    def _remaining(self):
+        """
+        :return: number of the run's tasks that are pending or in flight
+        """
+        from aardvark.model import UpdateTask
+
+        with self.app.app_context():
+            count = UpdateTask.query.filter(UpdateTask.run_id == self.checkpoint.run_id,
+                                            UpdateTask.status.in_([PENDING, IN_FLIGHT])).count()
+            db.session.commit()
+        return count
+
+    def _heartbeat(self):
+        """
+        Renews the leases this node holds until the queue is closed.
+        """
+        from aardvark.model import UpdateTask
+
+        while not self._closed.wait(self.lease_seconds / 3.0):
+            try:
+                with self.app.app_context():
+                    expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_seconds)
+                    UpdateTask.query.filter(UpdateTask.run_id == self.checkpoint.run_id,
+                                            UpdateTask.lease_owner == self.owner,
+                                            UpdateTask.status == IN_FLIGHT).update(
+                        dict(lease_expires=expires), synchronize_session=False)
+                    db.session.commit()
+            except Exception as e:
+                self.app.logger.error('Failed to renew leases: {}'.format(e))
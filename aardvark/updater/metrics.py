@@ -0,0 +1,318 @@
+"""
+Collector metrics, in the Prometheus text exposition format.
+
+The updater records how long each phase of collection takes:
+
+- `enumerate`: listing an account's roles, users, policies and groups
+- `assume_role`: assuming into an account through STS
+- `signin`: exchanging credentials for a federation signin token
+- `collect`: generating and retrieving Access Advisor data
+- `persist`: writing Access Advisor data to the database
+
+Each phase has a histogram of the times taken, and a running total of the
+seconds spent per account. Persisting is timed per batch, which may cover
+several accounts, so its seconds are shared out between accounts by their
+number of ARNs in the batch. Counters track ARNs persisted (in total and
+per account), retries, permanent failures and throttled IAM calls, and
+gauges report ARNs per second and the depth of the work queues.
+
+With METRICS_PORT set, metrics are served at /metrics on METRICS_HOST
+(127.0.0.1 by default) while the updater runs. With METRICS_FILE set, they
+are written to that file at the end of each run, e.g. for the node
+exporter's textfile collector.
+
+Metrics are kept per process. Update worker processes hand theirs to the
+parent with each result, see `drain()` and `merge()`.
+"""
+import BaseHTTPServer
+import collections
+import contextlib
+import os
+import SocketServer
+import tempfile
+import threading
+import time
+
+
+PREFIX = 'aardvark_'
+PHASES = ('enumerate', 'assume_role', 'signin', 'collect', 'persist')
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)  # seconds
+DEFAULT_HOST = '127.0.0.1'
+
+COUNTERS = {
+    'arns_persisted': 'ARNs whose Access Advisor data was persisted.',
+    'retries': 'Accounts or chunks of accounts queued again after failing.',
+    'failures': 'Accounts or chunks of accounts that failed for good.',
+    'throttles': 'IAM calls that were throttled.',
+}
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Gauge functions, keyed by name: (help, function)
+        self._gauges = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Clears everything recorded and starts timing a new run.
+        """
+        with self._lock:
+            self.started = time.time()
+            self.finished = None
+            self._phases = dict((phase, Histogram()) for phase in PHASES)
+            # Seconds keyed by (account number, phase)
+            self._account_seconds = collections.Counter()
+            self._account_arns = collections.Counter()
+            self._counters = collections.Counter()
+
+    def observe(self, phase, account_number, seconds):
+        with self._lock:
+            self._phases[phase].observe(seconds)
+            if account_number:
+                self._account_seconds[(account_number, phase)] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, phase, account_number):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, account_number, time.time() - start)
+
+    def persisted(self, arns, seconds):
+        """
+        Records a batch of ARNs persisted in `seconds`.
+        """
+        accounts = collections.Counter(arn.split(':')[4] for arn in arns)
+        with self._lock:
+            self._phases['persist'].observe(seconds)
+            self._counters['arns_persisted'] += len(arns)
+            for account_number, count in accounts.items():
+                self._account_seconds[(account_number, 'persist')] += seconds * count / len(arns)
+                self._account_arns[account_number] += count
+
+    def inc(self, name, value=1):
+        if name not in COUNTERS:
+            raise ValueError('Unknown counter {}'.format(name))
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name, help, fn):
+        """
+        Reports the value returned by a function whenever metrics are
+        rendered. Registering a name again replaces its function.
+        """
+        with self._lock:
+            self._gauges[name] = (help, fn)
+
+    def phases(self):
+        """
+        :return: (phase, (times observed, total seconds)) for each phase
+        """
+        with self._lock:
+            return [(phase, (self._phases[phase].count, self._phases[phase].sum)) for phase in PHASES]
+
+    def finish(self):
+        """
+        Stops the run's clock, so ARNs per second covers just the run.
+        """
+        with self._lock:
+            self.finished = time.time()
+
+    def drain(self):
+        """
+        :return: everything recorded so far, as plain data for `merge()`,
+                 and clears it
+        """
+        with self._lock:
+            data = dict(phases=dict((phase, (histogram.counts, histogram.sum, histogram.count))
+                                    for phase, histogram in self._phases.items() if histogram.count),
+                        account_seconds=dict(self._account_seconds),
+                        account_arns=dict(self._account_arns),
+                        counters=dict(self._counters))
+            self._phases = dict((phase, Histogram()) for phase in PHASES)
+            self._account_seconds = collections.Counter()
+            self._account_arns = collections.Counter()
+            self._counters = collections.Counter()
+        return data
+
+    def merge(self, data):
+        """
+        Adds metrics drained from another process.
+        """
+        with self._lock:
+            for phase, (counts, total, count) in data['phases'].items():
+                self._phases[phase].merge(counts, total, count)
+            self._account_seconds.update(data['account_seconds'])
+            self._account_arns.update(data['account_arns'])
+            self._counters.update(data['counters'])
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+            lines = []
+            _header(lines, 'phase_seconds', 'histogram', 'Seconds taken by each phase of collection.')
+            for phase in PHASES:
+                histogram = self._phases[phase]
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    lines.append(_sample('phase_seconds_bucket', count, phase=phase, le=_number(bound)))
+                lines.append(_sample('phase_seconds_bucket', histogram.count, phase=phase, le='+Inf'))
+                lines.append(_sample('phase_seconds_sum', histogram.sum, phase=phase))
+                lines.append(_sample('phase_seconds_count', histogram.count, phase=phase))
+
+            _header(lines, 'account_phase_seconds_total', 'counter', 'Seconds spent on each account by phase.')
+            for (account_number, phase), seconds in sorted(self._account_seconds.items()):
+                lines.append(_sample('account_phase_seconds_total', seconds, account=account_number, phase=phase))
+
+            _header(lines, 'account_arns_persisted_total', 'counter', 'ARNs persisted for each account.')
+            for account_number, count in sorted(self._account_arns.items()):
+                lines.append(_sample('account_arns_persisted_total', count, account=account_number))
+
+            for name, help in sorted(COUNTERS.items()):
+                _header(lines, name + '_total', 'counter', help)
+                lines.append(_sample(name + '_total', self._counters[name]))
+
+            elapsed = (self.finished or time.time()) - self.started
+            _header(lines, 'arns_per_second', 'gauge', 'ARNs persisted per second since the run started.')
+            lines.append(_sample('arns_per_second', self._counters['arns_persisted'] / elapsed if elapsed else 0))
+
+        for name, (help, fn) in gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            _header(lines, name, 'gauge', help)
+            lines.append(_sample(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics for this process
+METRICS = Metrics()
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start(app):
+    """
+    Starts recording a run, serving metrics at METRICS_PORT if it is set.
+    """
+    global _server
+    METRICS.reset()
+    port = app.config.get('METRICS_PORT')
+    if not port:
+        return
+
+    with _server_lock:
+        if _server:
+            return
+        try:
+            _server = _Server((app.config.get('METRICS_HOST') or DEFAULT_HOST, port), _Handler)
+        except (IOError, OSError) as e:
+            app.logger.warn('Failed to serve metrics on port {}: {}'.format(port, e))
+            return
+    thread = threading.Thread(target=_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    app.logger.info('Serving metrics at http://{}:{}/metrics'.format(*_server.server_address))
+
+
+def finish(app):
+    """
+    Stops the run's clock, and writes the metrics to METRICS_FILE if it is
+    set, replacing the file in one step so readers never see part of it.
+    """
+    METRICS.finish()
+    path = app.config.get('METRICS_FILE')
+    if not path:
+        return
+    try:
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(handle, 'w') as metrics_file:
+            metrics_file.write(METRICS.render())
+        os.rename(temp_path, path)
+    except (IOError, OSError) as e:
+        app.logger.warn('Failed to write metrics to {}: {}'.format(path, e))
+
+
+def stop():
+    global _server
+    with _server_lock:
+        if _server:
+            _server.shutdown()
+            _server.server_close()
+            _server = None
+
+
+def timed(phase, account_number):
+    return METRICS.timed(phase, account_number)
+
+
+def gauge(name, help, fn):
+    METRICS.gauge(name, help, fn)
+
+
+def inc(name, value=1):
+    METRICS.inc(name, value)
+
+
+def persisted(arns, seconds):
+    METRICS.persisted(arns, seconds)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _header(lines, name, metric_type, help):
+    lines.append('# HELP {}{} {}'.format(PREFIX, name, help))
+    lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+
+
+def _sample(name, value, **labels):
+    label_text = ','.join('{}="{}"'.format(label, labels[label]) for label in sorted(labels))
+    return '{}{}{} {}'.format(PREFIX, name, '{' + label_text + '}' if label_text else '', _number(value))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
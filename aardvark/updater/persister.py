@@ -0,0 +1,155 @@
+"""
+Persists Access Advisor data as collectors stream it in.
+
+Collectors hand each ARN's services to `put()`, which queues them for a
+single writer thread. The writer gathers what is queued into a batch until
+it holds PERSIST_BATCH_SIZE ARNs or PERSIST_BATCH_INTERVAL seconds have
+passed since the batch was started, then persists and commits the batch in
+one go. Database writes overlap with the collectors' waits on AWS, and
+because there is only one writer nothing needs to lock around persistence.
+
+The queue is bounded by PERSIST_QUEUE_SIZE: if the database falls behind,
+`put()` blocks until the writer catches up rather than letting memory grow.
+
+`call()` queues a function for the writer to call once everything queued
+before it has been persisted, so work can be marked done only when its data
+is safely in the database.
+
+A batch that fails to persist is tried once more before its data is given
+up on. Failures are recorded in `failed` against the work items the data
+came from, so one chunk's failure doesn't fail the rest of its account.
+"""
+import Queue
+import threading
+import time
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_INTERVAL = 1  # seconds
+DEFAULT_QUEUE_SIZE = 1000
+PERSIST_ATTEMPTS = 2
+
+
+class Persister(threading.Thread):
+    def __init__(self, app, persist):
+        """
+        :param persist: function taking the app and a dictionary of Access
+                        Advisor data keyed by ARN
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.app = app
+        self.persist = persist
+        self.batch_size = app.config.get('PERSIST_BATCH_SIZE') or DEFAULT_BATCH_SIZE
+        self.batch_interval = app.config.get('PERSIST_BATCH_INTERVAL', DEFAULT_BATCH_INTERVAL)
+        self.count = 0
+        self.batches = 0
+        self.error = None
+        # (account number, chunk) of work items with data that failed to
+        # persist, with the last error
+        self.failed = {}
+        self._queue = Queue.Queue(maxsize=app.config.get('PERSIST_QUEUE_SIZE') or DEFAULT_QUEUE_SIZE)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, arn, services, key=None):
+        """
+        :param key: (account number, chunk) of the work item the data came
+                    from, by default the ARN's whole account
+        """
+        self._queue.put((arn, services, key or (arn.split(':')[4], None)))
+
+    def call(self, fn):
+        """
+        Has the writer call fn once everything already queued is persisted.
+        """
+        self._queue.put((None, fn, None))
+
+    def clear_failed(self, account_number):
+        """
+        Forgets the failures recorded for an account's work items.
+        """
+        for key in list(self.failed):
+            if key[0] == account_number:
+                self.failed.pop(key, None)
+
+    def depth(self):
+        """
+        :return: number of records waiting to be persisted
+        """
+        return self._queue.qsize()
+
+    def close(self):
+        """
+        Waits for everything queued to be persisted. Failures are recorded in
+        `error` and `failed` rather than raised.
+        """
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        done = False
+        while not done:
+            batch, keys, callbacks, done = self._next_batch()
+            if batch:
+                self._persist(batch, keys)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    self.app.logger.error('Persister callback failed: {}'.format(e))
+
+    def _next_batch(self):
+        """
+        :return: the next batch of data keyed by ARN, the work items it came
+                 from, functions to call once it is persisted, and whether
+                 the queue has been closed
+        """
+        batch = {}
+        keys = set()
+        record = self._queue.get()
+        deadline = time.time() + self.batch_interval
+        while record is not None:
+            arn, services, key = record
+            if arn is None:
+                # Don't keep a callback waiting on data queued after it.
+                return batch, keys, [services], False
+            batch[arn] = services
+            keys.add(key)
+            if len(batch) >= self.batch_size:
+                return batch, keys, [], False
+
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    record = self._queue.get(timeout=timeout)
+                else:
+                    record = self._queue.get_nowait()
+            except Queue.Empty:
+                return batch, keys, [], False
+        return batch, keys, [], True
+
+    def _persist(self, batch, keys):
+        for attempt in range(PERSIST_ATTEMPTS):
+            try:
+                self.persist(self.app, batch)
+                break
+            except Exception as e:
+                self.app.logger.warn('Failed to persist Access Advisor data for {} arns (attempt {}): {}'.format(
+                                     len(batch), attempt + 1, e))
+        else:
+            # Keep going with later batches, so one bad batch doesn't leave
+            # collectors blocked on a full queue.
+            self.app.logger.error('Giving up on Access Advisor data for {} arns: {}'.format(len(batch), e))
+            self.error = self.error or e
+            for key in keys:
+                self.failed[key] = e
+            return
+
+        self.count += len(batch)
+        self.batches += 1
@@ -0,0 +1,193 @@
+"""
+Pool of long-lived PhantomJS workers.
+
+Starting PhantomJS and loading the console costs every account a fixed
+overhead, so rather than running a PhantomJS process per account, each
+worker runs `awsconsole.js` once and is handed one account after another
+as lines of JSON on its stdin. Workers log into each account afresh with
+its own signin token, and are replaced when they die, time out, or have
+handled PHANTOM_MAX_JOBS accounts.
+
+There is one pool per process, of up to PHANTOM_POOL_SIZE workers (the
+number of update threads by default), started as they are needed.
+"""
+import atexit
+import json
+import os
+import Queue
+import tempfile
+import threading
+import time
+
+import subprocess32
+
+
+CONSOLE_JS = os.path.join(os.path.dirname(__file__), 'awsconsole.js')
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_JOBS = 50
+PHANTOM_TIMEOUT = 1200  # 20 mins
+PHANTOM_TAIL_INTERVAL = 0.5  # seconds
+CLOSE_TIMEOUT = 10  # seconds
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PhantomWorker(object):
+    def __init__(self, app):
+        self.app = app
+        self.jobs = 0
+        self.process = subprocess32.Popen(
+            [app.config.get('PHANTOMJS'), CONSOLE_JS],
+            stdin=subprocess32.PIPE, stdout=subprocess32.PIPE, stderr=subprocess32.STDOUT)
+
+        # Keep draining output so the worker never blocks on a full pipe.
+        output = threading.Thread(target=self._log_output)
+        output.daemon = True
+        output.start()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, job, emit, job_seconds=None, timeout=PHANTOM_TIMEOUT):
+        """
+        Has the worker collect an account, emitting each ARN's services as
+        they arrive.
+
+        :param job: dictionary with the signin token, ARNs and polling
+                    schedule for awsconsole.js
+        :param job_seconds: optional dictionary to record the seconds each
+                            ARN's Access Advisor job took in
+        :return: exit code for the account, 1 if it timed out
+        """
+        self.jobs += 1
+        job = dict(job)
+        with tempfile.NamedTemporaryFile() as output:
+            job['output'] = output.name
+            try:
+                self.process.stdin.write(json.dumps(job) + '\n')
+                self.process.stdin.flush()
+            except IOError as e:
+                self.app.logger.error('PhantomJS worker is gone: {}'.format(e))
+                self.kill()
+                return 1
+
+            deadline = time.time() + timeout
+            with open(output.name) as results:
+                while True:
+                    code = _emit_lines(results, emit, job_seconds)
+                    if code is not None:
+                        return code
+
+                    if not self.alive():
+                        self.app.logger.error('PhantomJS exited: {}'.format(self.process.returncode))
+                        return self.process.returncode or 1
+
+                    if time.time() > deadline:
+                        self.app.logger.error('PhantomJS timed out')
+                        self.kill()
+                        return 1  # return code 1 for timeout
+
+                    time.sleep(PHANTOM_TAIL_INTERVAL)
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        """
+        Lets the worker exit once it has finished, killing it if it doesn't.
+        """
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=CLOSE_TIMEOUT)
+        except (IOError, subprocess32.TimeoutExpired):
+            self.kill()
+
+    def _log_output(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self.app.logger.debug('Phantom Output: {}'.format(line.rstrip()))
+
+
+class PhantomPool(object):
+    def __init__(self, app, size=None, max_jobs=None):
+        self.app = app
+        self.size = size or app.config.get('PHANTOM_POOL_SIZE') or app.config.get('NUM_THREADS') or DEFAULT_POOL_SIZE
+        self.max_jobs = max_jobs or app.config.get('PHANTOM_MAX_JOBS') or DEFAULT_MAX_JOBS
+        self._idle = Queue.Queue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def run(self, job, emit, job_seconds=None):
+        """
+        Collects an account on a worker from the pool.
+
+        :return: exit code for the account
+        """
+        worker = self._checkout()
+        try:
+            return worker.run(job, emit, job_seconds)
+        finally:
+            self._checkin(worker)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    worker = self._idle.get_nowait()
+                except Queue.Empty:
+                    return PhantomWorker(self.app)
+                if worker.alive():
+                    return worker
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, worker):
+        if worker.alive() and worker.jobs < self.max_jobs:
+            self._idle.put(worker)
+        elif worker.alive():
+            worker.close()
+        self._slots.release()
+
+
+def get_pool(app):
+    """
+    :return: this process's pool of PhantomJS workers
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PhantomPool(app)
+            atexit.register(_pool.close)
+        return _pool
+
+
+def _emit_lines(results, emit, job_seconds=None):
+    """
+    Emits each complete line of JSON available in a file that is still
+    being written to, leaving the position at the start of any partial line.
+
+    :return: the exit code once the end of the job has been read, else None
+    """
+    while True:
+        position = results.tell()
+        line = results.readline()
+        if not line.endswith('\n'):
+            results.seek(position)
+            return None
+
+        record = json.loads(line)
+        if record.get('done'):
+            return record['code']
+        if job_seconds is not None and record.get('seconds') is not None:
+            job_seconds[record['arn']] = record['seconds']
+        emit(record['arn'], record['services'])
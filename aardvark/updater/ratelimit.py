@@ -0,0 +1,164 @@
+"""
+Rate limiting and adaptive concurrency for IAM calls.
+
+IAM throttles per account, so rather than tuning thread counts by hand every
+Access Advisor call goes through the limiter for its account:
+
+- A token bucket per account (IAM_ACCOUNT_RATE_LIMIT calls per second) and
+  one shared by every account (IAM_RATE_LIMIT calls per second) bound the
+  request rate.
+- The number of calls in flight per account adapts AIMD style: it grows by
+  about one for every window of successful calls, up to
+  IAM_MAX_CONCURRENCY, and halves whenever IAM throttles a call.
+
+Throttled calls are retried with exponential backoff and full jitter up to
+IAM_THROTTLE_RETRIES times before the error is raised.
+"""
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from aardvark.updater import metrics
+
+
+DEFAULT_RATE_LIMIT = 20  # calls per second across all accounts
+DEFAULT_ACCOUNT_RATE_LIMIT = 10  # calls per second per account
+DEFAULT_MAX_CONCURRENCY = 20  # calls in flight per account
+INITIAL_CONCURRENCY = 4
+DECREASE_FACTOR = 0.5
+DEFAULT_THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF_BASE = 1  # seconds
+THROTTLE_BACKOFF_MAX = 20  # seconds
+
+THROTTLING_ERRORS = frozenset(['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                               'TooManyRequestsException'])
+
+# Limiters keyed by account number, and the bucket they share
+LIMITERS = {}
+_global_bucket = None
+_lock = threading.Lock()
+
+
+def is_throttling(error):
+    """
+    :return: whether an exception is IAM throttling a call
+    """
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second
+        :param burst: most tokens the bucket holds, defaulting to one second's worth
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Bounds calls in flight, increasing the bound additively while calls
+    succeed and decreasing it multiplicatively when they are throttled.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, maximum=DEFAULT_MAX_CONCURRENCY, minimum=1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+        self._decreased = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until a call may start.
+
+        :return: a ticket to pass to `release()`
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self._decreased
+
+    def release(self, ticket, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if not throttled:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif ticket == self._decreased:
+                # Only the first throttle among calls started before the last
+                # decrease counts, so one burst doesn't collapse the limit.
+                self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+                self._decreased += 1
+            self._condition.notify_all()
+
+
+class Limiter(object):
+    def __init__(self, buckets, concurrency, throttle_retries=DEFAULT_THROTTLE_RETRIES):
+        self.buckets = buckets
+        self.concurrency = concurrency
+        self.throttle_retries = throttle_retries
+        self.throttles = 0
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Makes a call once the rate and concurrency limits allow, retrying it
+        if it is throttled.
+        """
+        attempt = 0
+        while True:
+            ticket = self.concurrency.acquire()
+            throttled = False
+            try:
+                for bucket in self.buckets:
+                    bucket.acquire()
+                return fn(*args, **kwargs)
+            except ClientError as e:
+                throttled = is_throttling(e)
+                if not throttled or attempt >= self.throttle_retries:
+                    raise
+            finally:
+                self.concurrency.release(ticket, throttled)
+
+            self.throttles += 1
+            metrics.inc('throttles')
+            attempt += 1
+            time.sleep(random.uniform(0, min(THROTTLE_BACKOFF_MAX, THROTTLE_BACKOFF_BASE * 2 ** attempt)))
+
+
+def limiter(app, account_number):
+    """
+    :return: the shared limiter for an account's IAM calls
+    """
+    global _global_bucket
+    with _lock:
+        if _global_bucket is None:
+            _global_bucket = TokenBucket(app.config.get('IAM_RATE_LIMIT') or DEFAULT_RATE_LIMIT)
+        if account_number not in LIMITERS:
+            LIMITERS[account_number] = Limiter(
+                [TokenBucket(app.config.get('IAM_ACCOUNT_RATE_LIMIT') or DEFAULT_ACCOUNT_RATE_LIMIT), _global_bucket],
+                AdaptiveConcurrency(maximum=app.config.get('IAM_MAX_CONCURRENCY') or DEFAULT_MAX_CONCURRENCY),
+                throttle_retries=app.config.get('IAM_THROTTLE_RETRIES', DEFAULT_THROTTLE_RETRIES))
+        return LIMITERS[account_number]
@@ -0,0 +1,255 @@
+"""
+Schedules account updates for the long-running `aardvark scheduler` daemon.
+
+Rather than updating every account in one burst a day, each account is
+updated on its own cadence: SCHEDULER_CADENCE hours by default, or the
+hours given for it in SCHEDULER_CADENCES. Each account also has a fixed
+phase within its cadence, derived from its account number, so updates are
+spread evenly across the day instead of following whenever the daemon
+happened to start. Due times get up to SCHEDULER_JITTER (a fraction of the
+cadence) of random jitter on top.
+
+When several accounts are due at once, the stalest relative to its cadence
+goes first, weighted up for larger accounts since they take longest.
+
+An account is rescheduled once its update, and every chunk it was split
+into, has finished. Accounts that failed are tried again after
+SCHEDULER_RETRY hours if that is sooner than their next slot.
+
+The scheduler can re-resolve its accounts every SCHEDULER_RESOLVE_INTERVAL
+seconds, so accounts added to or removed from SWAG are picked up without a
+restart.
+"""
+import datetime
+import hashlib
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+
+
+DEFAULT_CADENCE = 24  # hours
+DEFAULT_JITTER = 0.05  # fraction of the cadence
+DEFAULT_RETRY = 1  # hours
+MAX_SLEEP = 60  # seconds
+DEFAULT_RESOLVE_INTERVAL = 600  # seconds
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class Scheduler(object):
+    """
+    Feeds due accounts to an update queue. It takes the place of the run
+    checkpoint for update threads, so it hears when each item finishes.
+    """
+
+    def __init__(self, app, accounts, role_name, account_queue, persister=None):
+        """
+        :param persister: the update threads' Persister, whose failures are
+                          forgotten as each account is rescheduled
+        """
+        self.app = app
+        self.role_name = role_name
+        self.account_queue = account_queue
+        self.persister = persister
+        self.cadence_hours = app.config.get('SCHEDULER_CADENCE') or DEFAULT_CADENCE
+        self.cadences = app.config.get('SCHEDULER_CADENCES') or {}
+        self.jitter = app.config.get('SCHEDULER_JITTER', DEFAULT_JITTER)
+        self.retry_hours = app.config.get('SCHEDULER_RETRY') or DEFAULT_RETRY
+        self.resolve_interval = app.config.get('SCHEDULER_RESOLVE_INTERVAL') or DEFAULT_RESOLVE_INTERVAL
+
+        # (due time, sequence, account number)
+        self._heap = []
+        self._seq = itertools.count()
+        # Items still to finish for each account in flight, and whether any failed
+        self._outstanding = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._rescheduled = threading.Condition(self._lock)
+        self._stopped = False
+        self._accounts = set()
+
+        self.sync_accounts(accounts)
+
+    def sync_accounts(self, accounts):
+        """
+        Schedules accounts that are new, and stops scheduling accounts that
+        are no longer listed.
+        """
+        accounts = set(accounts)
+        with self._lock:
+            added = accounts - self._accounts
+            removed = self._accounts - accounts
+            self._accounts = accounts
+            # An account removed and listed again before its update finished,
+            # or before its heap entry came due, is still scheduled.
+            added -= set(self._outstanding)
+            added -= set(account_number for _, _, account_number in self._heap)
+        if removed:
+            self.app.logger.info('No longer scheduling {} account(s)'.format(len(removed)))
+        if not added:
+            return
+
+        last_updated = self._oldest_updates()
+        now = time.time()
+        for account_number in sorted(added):
+            self._schedule(account_number, self.first_due(account_number, last_updated.get(account_number), now))
+
+    def cadence(self, account_number):
+        """
+        :return: seconds between updates of an account
+        """
+        return self.cadences.get(account_number, self.cadence_hours) * 3600.0
+
+    def phase(self, account_number):
+        """
+        :return: seconds into each cadence at which the account is due
+        """
+        return int(hashlib.md5(account_number).hexdigest(), 16) % int(self.cadence(account_number))
+
+    def next_slot(self, account_number, after):
+        """
+        :return: the account's first due time at or after a time, with jitter
+        """
+        cadence = self.cadence(account_number)
+        phase = self.phase(account_number)
+        slot = phase + math.ceil((after - phase) / cadence) * cadence
+        return slot + random.uniform(-self.jitter, self.jitter) * cadence
+
+    def first_due(self, account_number, last_updated, now):
+        """
+        Accounts without data, or with data older than their cadence, are
+        due now. Others are due at their first slot at least half a cadence
+        after their last update, which moves them onto their phase.
+
+        :param last_updated: epoch seconds of the account's oldest data, or None
+        """
+        if last_updated is None or last_updated + self.cadence(account_number) <= now:
+            return now
+        return max(now, self.next_slot(account_number, last_updated + self.cadence(account_number) / 2))
+
+    def priority(self, account_number, last_updated, arn_count, now):
+        """
+        :return: how urgently a due account should be updated, higher first
+        """
+        if last_updated is None:
+            staleness = float('inf')
+        else:
+            staleness = (now - last_updated) / self.cadence(account_number)
+        return staleness * (1 + math.log10(1 + (arn_count or 0)))
+
+    def run(self, resolve=None):
+        """
+        Queues accounts as they come due until `stop()` is called.
+
+        :param resolve: optional function returning the accounts to schedule
+        """
+        resolved = time.time()
+        while True:
+            if resolve and time.time() - resolved >= self.resolve_interval:
+                self.sync_accounts(resolve())
+                resolved = time.time()
+
+            due = self._pop_due()
+            if due:
+                self._queue_due(due)
+
+            with self._lock:
+                if self._stopped:
+                    return
+                wait = self._heap[0][0] - time.time() if self._heap else MAX_SLEEP
+                if wait > 0:
+                    self._rescheduled.wait(min(MAX_SLEEP, wait))
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._rescheduled.notify_all()
+
+    # Update threads report on items through the checkpoint interface.
+
+    def started(self, item, attempt):
+        pass
+
+    def retrying(self, item, error):
+        pass
+
+    def split(self, item, chunks):
+        with self._lock:
+            self._outstanding[item[0]] += len(chunks) - 1
+
+    def finished(self, item):
+        self._item_done(item[0], failed=False)
+
+    def failed(self, item, error):
+        self._item_done(item[0], failed=True)
+
+    def _item_done(self, account_number, failed):
+        with self._lock:
+            if failed:
+                self._failed.add(account_number)
+            self._outstanding[account_number] -= 1
+            if self._outstanding[account_number] > 0:
+                return
+            del self._outstanding[account_number]
+            failed = account_number in self._failed
+            self._failed.discard(account_number)
+            if self.persister:
+                self.persister.clear_failed(account_number)
+
+        now = time.time()
+        due = self.next_slot(account_number, now + self.cadence(account_number) / 2)
+        if failed:
+            due = min(due, now + self.retry_hours * 3600)
+        self._schedule(account_number, due)
+        self.app.logger.info('Next update of account {} in {:.1f} hours'.format(account_number, (due - now) / 3600))
+
+    def _schedule(self, account_number, due):
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._seq), account_number))
+            self._rescheduled.notify_all()
+
+    def _pop_due(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                account_number = heapq.heappop(self._heap)[2]
+                if account_number in self._accounts:
+                    # Outstanding from here on, so sync_accounts() won't schedule it again.
+                    self._outstanding[account_number] = 1
+                    due.append(account_number)
+        return due
+
+    def _queue_due(self, due):
+        from aardvark.model import AWSIAMObject
+
+        # One aggregate query for every account due this tick
+        with self.app.app_context():
+            stats = AWSIAMObject.update_stats_by_account()
+        now = time.time()
+
+        def priority(account_number):
+            oldest, arn_count = stats.get(account_number, (None, None))
+            return self.priority(account_number, _epoch(oldest) if oldest else None, arn_count, now)
+
+        due.sort(key=priority, reverse=True)
+
+        self.app.logger.info('{} account(s) due for update'.format(len(due)))
+        for account_number in due:
+            self.account_queue.put((account_number, self.role_name, ['all'], None))
+
+    def _oldest_updates(self):
+        """
+        :return: dictionary of epoch seconds of each account's oldest data
+        """
+        from aardvark.model import AWSIAMObject
+
+        with self.app.app_context():
+            oldest = AWSIAMObject.oldest_update_by_account()
+        return dict((account_number, _epoch(last_updated)) for account_number, last_updated in oldest.items())
+
+
+def _epoch(utc):
+    return (utc - EPOCH).total_seconds()
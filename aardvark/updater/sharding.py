@@ -0,0 +1,76 @@
+"""
+Splits large accounts into chunks of ARNs.
+
+A collector working through every ARN of a large account can take longer
+than it is allowed (a PhantomJS run is killed after 20 minutes), and when
+it fails the whole account is retried from scratch. Chunks are queued as
+items of their own, so they run in parallel across workers and a failed
+chunk is retried on its own.
+
+ARN_CHUNK_SIZE fixes the number of ARNs per chunk. Without it the size is
+chosen from how long collection has taken per ARN so far, aiming for
+chunks that take ARN_CHUNK_SECONDS each. That is only done for the
+phantomjs collector: the iam collector has no time limit and runs an
+account's jobs concurrently anyway, so unless ARN_CHUNK_SIZE is set its
+accounts aren't split.
+"""
+import threading
+
+
+DEFAULT_CHUNK_SECONDS = 300
+INITIAL_CHUNK_SIZE = 100
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 1000
+# Weight given to the latest observation of seconds per ARN
+SMOOTHING = 0.3
+
+
+class ChunkSizer(object):
+    def __init__(self, chunk_size=None, chunk_seconds=DEFAULT_CHUNK_SECONDS, adaptive=True):
+        self.chunk_size = chunk_size
+        self.chunk_seconds = chunk_seconds
+        self.adaptive = adaptive
+        self.seconds_per_arn = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(chunk_size=config.get('ARN_CHUNK_SIZE'),
+                   chunk_seconds=config.get('ARN_CHUNK_SECONDS') or DEFAULT_CHUNK_SECONDS,
+                   adaptive=config.get('COLLECTOR') == 'phantomjs')
+
+    def size(self):
+        """
+        :return: the number of ARNs to put in a chunk, or None if accounts
+                 aren't to be split
+        """
+        if self.chunk_size:
+            return self.chunk_size
+        if not self.adaptive:
+            return None
+
+        with self._lock:
+            if not self.seconds_per_arn:
+                return INITIAL_CHUNK_SIZE
+            size = int(self.chunk_seconds / self.seconds_per_arn)
+        return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size))
+
+    def record(self, arn_count, seconds):
+        """
+        Records how long it took to collect arn_count ARNs.
+        """
+        if not arn_count:
+            return
+        with self._lock:
+            observed = float(seconds) / arn_count
+            if self.seconds_per_arn is None:
+                self.seconds_per_arn = observed
+            else:
+                self.seconds_per_arn += SMOOTHING * (observed - self.seconds_per_arn)
+
+
+def chunk_arns(arns, size):
+    """
+    :return: list of lists of ARNs, each no longer than size
+    """
+    return [arns[start:start + size] for start in range(0, len(arns), size)]
@@ -0,0 +1,126 @@
+"""
+Work queue of accounts to update.
+
+Workers block in `get()` until an item is due, and `join()` blocks until
+every item has been marked done. Items that fail are retried with
+exponential backoff and full jitter until they run out of attempts, after
+which they are recorded in `failed` rather than retried forever.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_BASE = 30  # seconds
+DEFAULT_BACKOFF_MAX = 600  # seconds
+JOIN_POLL_INTERVAL = 1  # seconds, keeps join() responsive to KeyboardInterrupt
+
+
+class AccountQueue(object):
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_max=DEFAULT_BACKOFF_MAX):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failed = []
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._unfinished = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._all_tasks_done = threading.Condition(self._lock)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_attempts=config.get('UPDATE_MAX_ATTEMPTS') or DEFAULT_MAX_ATTEMPTS,
+                   backoff_base=config.get('UPDATE_BACKOFF_BASE', DEFAULT_BACKOFF_BASE),
+                   backoff_max=config.get('UPDATE_BACKOFF_MAX', DEFAULT_BACKOFF_MAX))
+
+    def put(self, item, attempt=0, delay=0):
+        """
+        Adds an item, to be handed out no sooner than `delay` seconds from now.
+        """
+        with self._lock:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._seq), attempt, item))
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def get(self):
+        """
+        Blocks until an item is due.
+
+        :return: the item and the number of previous attempts at it, or
+                 (None, None) once the queue has been closed
+        """
+        with self._lock:
+            while not self._closed:
+                if not self._heap:
+                    self._not_empty.wait()
+                    continue
+
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._not_empty.wait(wait)
+                    continue
+
+                _, _, attempt, item = heapq.heappop(self._heap)
+                return item, attempt
+
+            return None, None
+
+    def retry(self, item, attempt, error):
+        """
+        Puts a failed item back with backoff, or records it as failed for
+        good once it has used all of its attempts. Call before `task_done()`
+        for the failed attempt so `join()` can't return in between.
+
+        :return: True if the item will be retried
+        """
+        attempt += 1
+        if attempt >= self.max_attempts:
+            with self._lock:
+                self.failed.append((item, attempt, error))
+            return False
+
+        self.put(item, attempt, self.backoff(attempt))
+        return True
+
+    def depth(self):
+        """
+        :return: number of items waiting to be handed out
+        """
+        with self._lock:
+            return len(self._heap)
+
+    def backoff(self, attempt):
+        """
+        Exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def task_done(self):
+        with self._lock:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._all_tasks_done.notify_all()
+
+    def join(self):
+        """
+        Blocks until every item put on the queue has been marked done.
+        """
+        with self._lock:
+            while self._unfinished > 0:
+                self._all_tasks_done.wait(JOIN_POLL_INTERVAL)
+
+    def close(self):
+        """
+        Releases workers blocked in `get()`.
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
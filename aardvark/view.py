@@ -1,20 +1,30 @@
 import better_exceptions  # noqa
-import datetime
+import base64
+import binascii
+import itertools
 import json
+import time
 
-from flask import abort, jsonify
+from flask import abort, jsonify, json as flask_json
+from flask import request, Response, stream_with_context
 from flask import Blueprint
 from flask_restful import Api, Resource, reqparse
 from flask import Flask
 import sqlalchemy as sa
+from werkzeug.http import is_resource_modified
 
-from aardvark.model import AWSIAMObject
+from aardvark import db
+from aardvark.model import AWSIAMObject, AdvisorData, DataGeneration
 
 
 mod = Blueprint('advisor', __name__)
 api = Api(mod)
 app = Flask(__name__)
 
+DEFAULT_USAGE_DAYS = 90
+STREAM_BATCH_SIZE = 1000  # rows fetched from the database at a time when streaming
+STREAM_FORMATS = ('ndjson', 'json-stream')
+
 
 class RoleSearch(Resource):
     """
@@ -24,36 +34,146 @@ class RoleSearch(Resource):
         super(RoleSearch, self).__init__()
         self.reqparse = reqparse.RequestParser()
 
-    def combine(self, aa):
-        del aa['count']
-        del aa['page']
-        del aa['total']
+    def combine(self, filters, usage_days):
+        """
+        Combines the Access Advisor data of every ARN matching the filters,
+        per service, in the database: the most recent lastAuthenticated (with
+        the entity and lastUpdated of the ARN it came from) and the sum of
+        totalAuthenticatedEntities.
+        """
+        last_authenticated = sa.func.coalesce(AdvisorData.lastAuthenticated, 0)
+        combined = db.session.query(
+            AdvisorData.serviceNamespace.label('serviceNamespace'),
+            sa.func.max(last_authenticated).label('lastAuthenticated'),
+            sa.func.sum(AdvisorData.totalAuthenticatedEntities).label('totalAuthenticatedEntities')) \
+            .join(AWSIAMObject, AWSIAMObject.id == AdvisorData.item_id) \
+            .filter(*filters) \
+            .group_by(AdvisorData.serviceNamespace) \
+            .subquery()
+
+        # Each service's most recently authenticated row, alongside its totals
+        query = db.session.query(
+            AdvisorData.serviceNamespace, AdvisorData.serviceName, AdvisorData.lastAuthenticated,
+            AdvisorData.lastAuthenticatedEntity, AWSIAMObject.lastUpdated, combined.c.totalAuthenticatedEntities) \
+            .join(AWSIAMObject, AWSIAMObject.id == AdvisorData.item_id) \
+            .join(combined, sa.and_(combined.c.serviceNamespace == AdvisorData.serviceNamespace,
+                                    combined.c.lastAuthenticated == last_authenticated)) \
+            .filter(*filters)
 
+        used_since = (time.time() - usage_days * 24 * 60 * 60) * 1000
+        used_key = 'USED_LAST_{}_DAYS'.format(usage_days)
         usage = dict()
-        for arn, services in aa.items():
-            for service in services:
-                namespace = service.get('serviceNamespace')
-                last_authenticated = service.get('lastAuthenticated')
-                if namespace not in usage:
-                    usage[namespace] = service
-                else:
-                    count_entities = usage[namespace]['totalAuthenticatedEntities'] + service['totalAuthenticatedEntities']
-                    if last_authenticated > usage[namespace]['lastAuthenticated']:
-                        usage[namespace] = service
-                    usage[namespace]['totalAuthenticatedEntities'] = count_entities
-
-        for namespace, service in usage.items():
-            last_authenticated = service['lastAuthenticated']
-            dt_last_authenticated = datetime.datetime.fromtimestamp(last_authenticated / 1e3)
-            dt_starting = datetime.datetime.utcnow() - datetime.timedelta(days=90)
-            usage[namespace]['USED_LAST_90_DAYS'] = dt_last_authenticated > dt_starting
+        for row in query:
+            if row.serviceNamespace in usage:
+                # Several ARNs last authenticated at the same time
+                continue
+            usage[row.serviceNamespace] = {
+                'serviceNamespace': row.serviceNamespace,
+                'serviceName': row.serviceName,
+                'lastAuthenticated': row.lastAuthenticated,
+                'lastAuthenticatedEntity': row.lastAuthenticatedEntity,
+                'totalAuthenticatedEntities': row.totalAuthenticatedEntities,
+                'lastUpdated': row.lastUpdated,
+                used_key: (row.lastAuthenticated or 0) > used_since,
+            }
 
         return jsonify(usage)
 
-    # undocumented convenience pass-through so we can query directly from browser
+    def after_cursor(self, query, cursor, count):
+        """
+        Keyset pagination: seeks past the last id of the previous page rather
+        than counting through an offset.
+
+        :return: up to `count` rows after the cursor, and the cursor for the
+                 next page, or None if there are no more rows
+        """
+        try:
+            last_id = _decode_cursor(cursor)
+        except ValueError:
+            abort(400, "Error: Invalid cursor.")
+
+        try:
+            rows = query.filter(AWSIAMObject.id > last_id).limit(count + 1).all()
+        except Exception as e:
+            abort(400, str(e))
+
+        if len(rows) > count:
+            return rows[:count], _encode_cursor(rows[count - 1].id)
+        return rows, None
+
+    def stream(self, filters, cursor, response_format):
+        """
+        Streams every ARN matching the filters, after the cursor if one is
+        given, one ARN at a time from a server-side cursor, so memory use
+        doesn't grow with the number of results.
+
+        As ndjson each line is an object with the ARN and its data. As
+        json-stream the response is one object of data keyed by ARN, like a
+        page but without its page, total, count and next_cursor.
+        """
+        try:
+            last_id = _decode_cursor(cursor)
+        except ValueError:
+            abort(400, "Error: Invalid cursor.")
+
+        query = db.session.query(
+            AWSIAMObject.id, AWSIAMObject.arn, AWSIAMObject.lastUpdated, AdvisorData.lastAuthenticated,
+            AdvisorData.serviceName, AdvisorData.serviceNamespace, AdvisorData.lastAuthenticatedEntity,
+            AdvisorData.totalAuthenticatedEntities) \
+            .outerjoin(AdvisorData, AdvisorData.item_id == AWSIAMObject.id) \
+            .filter(AWSIAMObject.id > last_id) \
+            .filter(*filters) \
+            .order_by(AWSIAMObject.id) \
+            .yield_per(STREAM_BATCH_SIZE)
+        try:
+            # Run the query now, so errors such as a bad regex are still a 400
+            rows = iter(query)
+        except Exception as e:
+            abort(400, str(e))
+
+        def records():
+            for _, item_rows in itertools.groupby(rows, key=lambda row: row.id):
+                item_rows = list(item_rows)
+                yield item_rows[0].arn, [_service_values(row, row.lastUpdated) for row in item_rows
+                                         if row.serviceNamespace is not None]
+
+        def ndjson():
+            for arn, item_values in records():
+                yield flask_json.dumps(dict(arn=arn, usage=item_values)) + '\n'
+
+        def json_stream():
+            yield '{'
+            for index, (arn, item_values) in enumerate(records()):
+                yield '{}{}: {}'.format(',' if index else '', flask_json.dumps(arn), flask_json.dumps(item_values))
+            yield '}\n'
+
+        if response_format == 'ndjson':
+            return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+        return Response(stream_with_context(json_stream()), mimetype='application/json')
+
+    # undocumented convenience pass-through so we can query directly from browser,
+    # which also answers conditional requests
     @app.route('/advisors')
     def get(self):
-        return(self.post())
+        # Bad arguments are a 400 whether or not the data has changed.
+        args = self.parse_args()
+
+        # Combined results flag recently used services, which changes with
+        # time as well as with the data, so they aren't cached.
+        generation = None
+        if args['combine'].lower() != 'true':
+            generation = DataGeneration.current()
+        if not generation:
+            return(self.search(args))
+
+        etag = str(generation.generation)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=generation.updated):
+            response = Response(status=304)
+        else:
+            response = self.search(args)
+        response.set_etag(etag)
+        response.last_modified = generation.updated
+        return response
 
     @app.route('/advisors')
     def post(self):
@@ -76,10 +196,39 @@ class RoleSearch(Resource):
             type: integer
             description: specifies how many results should be return per page
             required: false
+          - name: cursor
+            in: query
+            type: string
+            description: |
+                return the results after a next_cursor from an earlier
+                response, in place of page. Pass an empty cursor to start
+                from the first result.
+            required: false
+          - name: total
+            in: query
+            type: boolean
+            description: count the total results when paging by cursor [Default False]
+            required: false
+          - name: format
+            in: query
+            type: string
+            description: |
+                ndjson or json-stream to stream every result, rather than
+                return a page of them [Default json]
+            required: false
           - name: combine
             in: query
             type: boolean
-            description: combine access advisor data for all results [Default False]
+            description: |
+                combine access advisor data for all results, per service,
+                rather than returning a page of them [Default False]
+            required: false
+          - name: usage_days
+            in: query
+            type: integer
+            description: |
+                when combining, flag services used in this many days as
+                USED_LAST_<usage_days>_DAYS [Default 90]
             required: false
           - name: query
             in: body
@@ -136,9 +285,20 @@ class RoleSearch(Resource):
           400:
             description: Bad request - error message in body
         """
+        return self.search(self.parse_args())
+
+    def parse_args(self):
+        """
+        :return: the request's arguments, having aborted with a 400 if any
+                 are invalid
+        """
         self.reqparse.add_argument('page', type=int, default=1)
         self.reqparse.add_argument('count', type=int, default=30)
+        self.reqparse.add_argument('cursor', type=str, default=None)
+        self.reqparse.add_argument('total', type=str, default='false')
+        self.reqparse.add_argument('format', type=str, default='json')
         self.reqparse.add_argument('combine', type=str, default='false')
+        self.reqparse.add_argument('usage_days', type=int, default=DEFAULT_USAGE_DAYS)
         self.reqparse.add_argument('phrase', default=None)
         self.reqparse.add_argument('regex', default=None)
         self.reqparse.add_argument('arn', default=None, action='append')
@@ -147,56 +307,102 @@ class RoleSearch(Resource):
         except Exception as e:
             abort(400, str(e))
 
+        if args['count'] < 1:
+            abort(400, "Error: count must be at least 1.")
+        return args
+
+    def search(self, args):
         page = args.pop('page')
         count = args.pop('count')
+        cursor = args.pop('cursor')
+        with_total = args.pop('total', 'false')
+        with_total = with_total.lower() == 'true'
+        response_format = args.pop('format', 'json')
         combine = args.pop('combine', 'false')
         combine = combine.lower() == 'true'
+        usage_days = args.pop('usage_days')
         phrase = args.pop('phrase', '')
         arns = args.pop('arn', [])
         regex = args.pop('regex', '')
         items = None
 
-        # default unfiltered query
-        query = AWSIAMObject.query
+        # default unfiltered query, of just the columns we return
+        base_query = db.session.query(AWSIAMObject.id, AWSIAMObject.arn, AWSIAMObject.lastUpdated) \
+            .order_by(AWSIAMObject.id)
+        query = base_query
 
-        try:
-            if phrase:
-                query = query.filter(AWSIAMObject.arn.ilike('%' + phrase + '%'))
+        filters = []
+        if phrase:
+            filters.append(AWSIAMObject.arn.ilike('%' + phrase + '%'))
 
-            if arns:
-                query = query.filter(
-                    sa.func.lower(AWSIAMObject.arn).in_([arn.lower() for arn in arns]))
+        if arns:
+            filters.append(sa.func.lower(AWSIAMObject.arn).in_([arn.lower() for arn in arns]))
 
-            if regex:
-                query = query.filter(AWSIAMObject.arn.regexp(regex))
+        if regex:
+            filters.append(AWSIAMObject.arn.regexp(regex))
 
-            items = query.paginate(page, count)
+        try:
+            if combine:
+                return self.combine(filters, usage_days)
+            if response_format in STREAM_FORMATS:
+                return self.stream(filters, cursor, response_format)
+
+            query = query.filter(*filters)
+            if cursor is None:
+                items = query.paginate(page, count)
         except Exception as e:
             abort(400, str(e))
 
-        if not items:
-            items = AWSIAMObject.query.paginate(page, count)
+        if cursor is not None:
+            rows, next_cursor = self.after_cursor(query, cursor, count)
+            values = dict(count=len(rows), next_cursor=next_cursor)
+            if with_total:
+                values['total'] = query.order_by(None).count()
+        else:
+            if not items:
+                items = base_query.paginate(page, count)
+            rows = items.items
+            values = dict(page=items.page, total=items.total, count=len(rows),
+                          next_cursor=_encode_cursor(rows[-1].id) if items.has_next else None)
 
-        values = dict(page=items.page, total=items.total, count=len(items.items))
-        for item in items.items:
+        # One query for the whole page's usage, rather than one per ARN
+        usage = AdvisorData.usage_by_item([item.id for item in rows])
+        for item in rows:
             item_values = []
-            for advisor_data in item.usage:
-                item_values.append(dict(
-                    lastAuthenticated=advisor_data.lastAuthenticated,
-                    serviceName=advisor_data.serviceName,
-                    serviceNamespace=advisor_data.serviceNamespace,
-                    lastAuthenticatedEntity=advisor_data.lastAuthenticatedEntity,
-                    totalAuthenticatedEntities=advisor_data.totalAuthenticatedEntities,
-                    lastUpdated=item.lastUpdated
-                ))
+            for advisor_data in usage.get(item.id, []):
+                item_values.append(_service_values(advisor_data, item.lastUpdated))
             values[item.arn] = item_values
 
-        if combine and items.total > len(items.items):
-            abort(400, "Error: Please specify a count of at least {}.".format(items.total))
-        elif combine:
-            return self.combine(values)
-
         return jsonify(values)
 
 
+def _service_values(advisor_data, last_updated):
+    return dict(
+        lastAuthenticated=advisor_data.lastAuthenticated,
+        serviceName=advisor_data.serviceName,
+        serviceNamespace=advisor_data.serviceNamespace,
+        lastAuthenticatedEntity=advisor_data.lastAuthenticatedEntity,
+        totalAuthenticatedEntities=advisor_data.totalAuthenticatedEntities,
+        lastUpdated=last_updated
+    )
+
+
+def _encode_cursor(item_id):
+    return base64.urlsafe_b64encode(str(item_id))
+
+
+def _decode_cursor(cursor):
+    """
+    :return: the item id a cursor from `_encode_cursor()` carries on after,
+             or 0 for an empty cursor
+    :raise ValueError: if the cursor is not one of ours
+    """
+    if not cursor:
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(cursor))
+    except (TypeError, binascii.Error):
+        raise ValueError('Invalid cursor {}'.format(cursor))
+
+
 api.add_resource(RoleSearch, '/advisors')
@@ -34,6 +34,7 @@ install_requires = [
     'Flask-RESTful==0.3.5',
     'Flask-Script==2.0.5',
     'flasgger==0.6.3',
+    'futures>=3.1.1',
     'gunicorn==19.7.1',
     'psycopg2==2.7.1',
     'pytz==2017.2',
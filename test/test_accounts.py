@@ -0,0 +1,84 @@
+'''Test cases for the cached SWAG account directory.
+
+SWAG is replaced by a fake fetch that serves canned accounts, or fails.
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from aardvark import create_app
+from aardvark import manage
+from aardvark.updater import accounts
+
+
+SWAG_ACCOUNTS = [
+    dict(id='111111111111', name='Prod', schemaVersion='2', aliases=['production']),
+    dict(id='222222222222', name='test', schemaVersion='1', alias=['Testing']),
+    ]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestAccountDirectory(unittest.TestCase):
+    '''Test resolving account names through the cache.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        self.fetches = 0
+        self.swag_up = True
+        self.fetch_accounts = accounts._fetch_accounts
+        accounts._fetch_accounts = self.fake_fetch
+        accounts.clear()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        accounts._fetch_accounts = self.fetch_accounts
+        accounts.clear()
+        shutil.rmtree(self.tmpdir)
+        self.context.pop()
+
+    def fake_fetch(self, app):
+        self.fetches += 1
+        if not self.swag_up:
+            raise RuntimeError('SWAG is down')
+        return SWAG_ACCOUNTS
+
+    def test_prep_accounts(self):
+        self.assertEqual(manage._prep_accounts('all'), ['111111111111', '222222222222'])
+        self.assertEqual(sorted(manage._prep_accounts('prod,TESTING,333333333333,unknown')),
+                         ['111111111111', '222222222222', '333333333333'])
+        self.assertEqual(self.fetches, 1)
+
+    def test_swag_down_without_cache(self):
+        self.swag_up = False
+        self.assertEqual(manage._prep_accounts('all'), [])
+        self.assertEqual(manage._prep_accounts('prod,333333333333'), ['333333333333'])
+
+    def test_serves_stale_while_refreshing(self):
+        self.app.config['ACCOUNT_CACHE_TTL'] = 0
+        directory = accounts.get_directory(self.app)
+        self.swag_up = False
+
+        self.assertIs(accounts.get_directory(self.app), directory)
+        deadline = time.time() + 5
+        while self.fetches < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(accounts.get_directory(self.app).lookup('production'), '111111111111')
+
+    def test_cache_file(self):
+        self.app.config['ACCOUNT_CACHE_FILE'] = os.path.join(self.tmpdir, 'accounts.json')
+        accounts.get_directory(self.app)
+        accounts.clear()
+        self.swag_up = False
+
+        directory = accounts.get_directory(self.app)
+        self.assertEqual(directory.account_ids, ['111111111111', '222222222222'])
+        self.assertEqual(directory.lookup('Testing'), '222222222222')
+        self.assertEqual(self.fetches, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
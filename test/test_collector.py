@@ -0,0 +1,177 @@
+'''Test cases for the Access Advisor collector backends.
+
+The native IAM collector is exercised against a botocore Stubber standing
+in for the IAM endpoint, so no AWS credentials or network access are
+needed.
+'''
+import datetime
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+from dateutil.tz import tzutc
+
+from aardvark import create_app
+from aardvark.updater import collectors, ratelimit
+
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/SecurityMonkey'
+USER_ARN = 'arn:aws:iam::123456789012:user/someone'
+
+LAST_AUTHENTICATED = datetime.datetime(2017, 3, 10, 20, 0, tzinfo=tzutc())
+LAST_AUTHENTICATED_MS = 1489176000000
+
+ROLE_JOB_ID = 'b3f4c0a8-5c8d-4a7e-9b62-2f0d1e6c7a90'
+JOB_CREATED = datetime.datetime(2017, 3, 11, tzinfo=tzutc())
+
+
+class FakeAccount(object):
+    '''Just enough of AccountToUpdate for a collector.'''
+
+    def __init__(self, app, client):
+        self.current_app = app
+        self.account_number = '123456789012'
+        self.client = client
+
+    def iam_client(self):
+        return self.client
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def job_response(status, services=None, **kwargs):
+    '''Build a GetServiceLastAccessedDetails response.'''
+    response = dict(
+        JobStatus=status,
+        JobCreationDate=JOB_CREATED,
+        JobCompletionDate=JOB_CREATED,
+        ServicesLastAccessed=services or []
+        )
+    response.update(kwargs)
+    return response
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestIAMCollector(unittest.TestCase):
+    '''Test the native IAM collector.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['IAM_POLL_INTERVAL'] = 0
+        # One call at a time, so calls reach the stubber in order.
+        self.app.config['IAM_MAX_CONCURRENCY'] = 1
+        ratelimit.LIMITERS.clear()
+        self.client = boto3.client(
+            'iam', region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'
+            )
+        self.stubber = Stubber(self.client)
+        self.collector = collectors.IAMCollector(FakeAccount(self.app, self.client))
+
+    def test_collect(self):
+        self.stubber.add_response(
+            'generate_service_last_accessed_details', {'JobId': ROLE_JOB_ID}, {'Arn': ROLE_ARN})
+        self.stubber.add_response(
+            'get_service_last_accessed_details', job_response('IN_PROGRESS'), {'JobId': ROLE_JOB_ID})
+        self.stubber.add_response(
+            'get_service_last_accessed_details',
+            job_response('COMPLETED', [
+                dict(ServiceName='Amazon S3', ServiceNamespace='s3',
+                     LastAuthenticated=LAST_AUTHENTICATED, LastAuthenticatedEntity=ROLE_ARN,
+                     TotalAuthenticatedEntities=1)
+                ], IsTruncated=True, Marker='next'),
+            {'JobId': ROLE_JOB_ID})
+        self.stubber.add_response(
+            'get_service_last_accessed_details',
+            job_response('COMPLETED', [
+                dict(ServiceName='AWS Lambda', ServiceNamespace='lambda', TotalAuthenticatedEntities=0)
+                ]),
+            {'JobId': ROLE_JOB_ID, 'Marker': 'next'})
+
+        results = {}
+        with self.stubber:
+            ret_code = self.collector.collect([ROLE_ARN], results.__setitem__)
+
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(results, {
+            ROLE_ARN: [
+                dict(lastAuthenticated=LAST_AUTHENTICATED_MS, serviceName='Amazon S3', serviceNamespace='s3',
+                     lastAuthenticatedEntity=ROLE_ARN, totalAuthenticatedEntities=1),
+                dict(lastAuthenticated=0, serviceName='AWS Lambda', serviceNamespace='lambda',
+                     lastAuthenticatedEntity=None, totalAuthenticatedEntities=0),
+                ]
+            })
+
+    def test_collect_skips_failures(self):
+        self.stubber.add_client_error(
+            'generate_service_last_accessed_details', 'ServiceFailure', expected_params={'Arn': USER_ARN})
+        self.stubber.add_response(
+            'generate_service_last_accessed_details', {'JobId': ROLE_JOB_ID}, {'Arn': ROLE_ARN})
+        self.stubber.add_response(
+            'get_service_last_accessed_details', job_response('FAILED'), {'JobId': ROLE_JOB_ID})
+
+        results = {}
+        with self.stubber:
+            ret_code = self.collector.collect([USER_ARN, ROLE_ARN], results.__setitem__)
+
+        self.assertNotEqual(ret_code, 0)
+        self.assertEqual(results, {})
+        self.assertEqual(self.collector.failed_arns, {USER_ARN, ROLE_ARN})
+
+    def test_collect_ignores_deleted(self):
+        self.stubber.add_client_error(
+            'generate_service_last_accessed_details', 'NoSuchEntity', expected_params={'Arn': USER_ARN})
+
+        results = {}
+        with self.stubber:
+            ret_code = self.collector.collect([USER_ARN], results.__setitem__)
+
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(results, {})
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestJobPoller(unittest.TestCase):
+    '''Test the adaptive polling schedule.'''
+
+    def test_intervals(self):
+        poller = collectors.JobPoller([], 1, 10)
+        self.assertEqual([poller.interval(checks) for checks in range(6)], [1, 2, 4, 8, 10, 10])
+
+    def test_due(self):
+        poller = collectors.JobPoller([(ROLE_ARN, 'role-job'), (USER_ARN, 'user-job')], 0, 60)
+        self.assertEqual(poller.wait_time(), 0)
+        self.assertItemsEqual(poller.due(), [(ROLE_ARN, 'role-job'), (USER_ARN, 'user-job')])
+
+        poller.checked(ROLE_ARN, True)
+        poller.first_delay = 30
+        poller.checked(USER_ARN, False)
+        self.assertEqual(poller.due(), [])
+        self.assertGreater(poller.wait_time(), 29)
+        self.assertEqual(len(poller), 1)
+        self.assertEqual(list(poller.job_seconds), [ROLE_ARN])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestGetCollector(unittest.TestCase):
+    '''Test selection of the collector backend from config.'''
+
+    def setUp(self):
+        self.app = create_app()
+
+    def test_default(self):
+        collector = collectors.get_collector(FakeAccount(self.app, None))
+        self.assertIsInstance(collector, collectors.IAMCollector)
+
+    def test_phantomjs(self):
+        self.app.config['COLLECTOR'] = 'phantomjs'
+        collector = collectors.get_collector(FakeAccount(self.app, None))
+        self.assertIsInstance(collector, collectors.PhantomJSCollector)
+
+    def test_unknown(self):
+        self.app.config['COLLECTOR'] = 'carrier-pigeon'
+        with self.assertRaises(ValueError):
+            collectors.get_collector(FakeAccount(self.app, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+'''Test cases for cached credentials, signin tokens and IAM clients.'''
+import datetime
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+from dateutil.tz import tzutc
+
+from aardvark import create_app
+from aardvark.updater import credentials
+
+
+ACCOUNT_NUMBER = '123456789012'
+ROLE_NAME = 'Aardvark'
+ROLE_ARN = 'arn:aws:iam::123456789012:role/Aardvark'
+
+
+class FakeResponse(object):
+    def __init__(self, token):
+        self.token = token
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return dict(SigninToken=self.token)
+
+
+class FakeHTTPSession(object):
+    '''Hands out a new signin token for every request.'''
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append((url, params))
+        return FakeResponse('token-{}'.format(len(self.requests)))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def assume_role_response(expires_in):
+    '''Build an AssumeRole response with credentials expiring after expires_in.'''
+    expiration = datetime.datetime.now(tzutc()) + expires_in
+    return dict(Credentials=dict(
+        AccessKeyId='ASIAEXAMPLEEXAMPLE01', SecretAccessKey='secret', SessionToken='token', Expiration=expiration))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestCredentials(unittest.TestCase):
+    '''Test that credentials and tokens are reused until they expire.'''
+
+    def setUp(self):
+        credentials.CREDENTIALS_CACHE.clear()
+        credentials.SIGNIN_TOKEN_CACHE.clear()
+        credentials.IAM_CLIENT_CACHE.clear()
+        self.app = create_app()
+
+        sts = boto3.client(
+            'sts', region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'
+            )
+        credentials.STS_CLIENTS[None] = sts
+        self.stubber = Stubber(sts)
+
+        self.http_session = FakeHTTPSession()
+        self.original_http_session = credentials.http_session
+        credentials.http_session = lambda app: self.http_session
+
+    def tearDown(self):
+        credentials.STS_CLIENTS.clear()
+        credentials.http_session = self.original_http_session
+
+    def expect_assume_role(self, expires_in):
+        self.stubber.add_response(
+            'assume_role', assume_role_response(expires_in),
+            dict(RoleArn=ROLE_ARN, RoleSessionName=credentials.SESSION_NAME))
+
+    def test_credentials_reused(self):
+        self.expect_assume_role(datetime.timedelta(hours=1))
+        with self.stubber:
+            first = credentials.get_credentials(self.app, ACCOUNT_NUMBER, ROLE_NAME)
+            second = credentials.get_credentials(self.app, ACCOUNT_NUMBER, ROLE_NAME)
+        self.assertIs(first, second)
+        self.stubber.assert_no_pending_responses()
+
+    def test_expiring_credentials_refreshed(self):
+        self.expect_assume_role(datetime.timedelta(minutes=1))
+        self.expect_assume_role(datetime.timedelta(hours=1))
+        with self.stubber:
+            first = credentials.get_credentials(self.app, ACCOUNT_NUMBER, ROLE_NAME)
+            second = credentials.get_credentials(self.app, ACCOUNT_NUMBER, ROLE_NAME)
+        self.assertIsNot(first, second)
+        self.stubber.assert_no_pending_responses()
+
+    def test_signin_token_reused(self):
+        self.expect_assume_role(datetime.timedelta(hours=1))
+        with self.stubber:
+            first = credentials.get_signin_token(self.app, ACCOUNT_NUMBER, ROLE_NAME)
+            second = credentials.get_signin_token(self.app, ACCOUNT_NUMBER, ROLE_NAME)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.http_session.requests), 1)
+        self.assertEqual(self.http_session.requests[0][1]['Action'], 'getSigninToken')
+
+    def test_iam_client_reused(self):
+        self.expect_assume_role(datetime.timedelta(hours=1))
+        with self.stubber:
+            first = credentials.iam_client(self.app, ACCOUNT_NUMBER, ROLE_NAME, 'us-east-1')
+            second = credentials.iam_client(self.app, ACCOUNT_NUMBER, ROLE_NAME, 'us-east-1')
+        self.assertIs(first, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
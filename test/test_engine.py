@@ -0,0 +1,158 @@
+'''Test cases for the event loop collection engine.'''
+import datetime
+import threading
+import time
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+from aardvark import create_app
+from aardvark.updater import engine
+
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/SecurityMonkey'
+ROLE_JOB_ID = 'b3f4c0a8-5c8d-4a7e-9b62-2f0d1e6c7a90'
+
+
+class FakeAccount(object):
+    '''Just enough of AccountToUpdate for the update_account coroutine.'''
+
+    def __init__(self, app, client):
+        self.current_app = app
+        self.account_number = '123456789012'
+        self.client = client
+
+    def _get_arns(self):
+        return [ROLE_ARN]
+
+    def iam_client(self):
+        return self.client
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestEngine(unittest.TestCase):
+    '''Test the engine's loop with plain coroutines.'''
+
+    def setUp(self):
+        self.app = create_app()
+
+    def test_call_sleep_and_gather(self):
+        seen = []
+
+        def coro(key):
+            value = yield engine.Call(lambda: key * 2)
+            yield engine.Sleep(0.01)
+            values = yield [engine.Call(lambda: value + 1), engine.DBCall(lambda: value + 2)]
+            seen.append((key, values))
+
+        failed = engine.Engine(self.app).run((key, coro(key)) for key in range(3))
+
+        self.assertEqual(failed, {})
+        self.assertItemsEqual(seen, [(0, [1, 2]), (1, [3, 4]), (2, [5, 6])])
+
+    def test_exceptions(self):
+        caught = []
+
+        def explode():
+            raise ValueError('boom')
+
+        def gathers():
+            results = yield [engine.Call(explode), engine.Call(lambda: 1)]
+            caught.append(results)
+
+        def catches():
+            try:
+                yield engine.Call(explode)
+            except ValueError as e:
+                caught.append(str(e))
+
+        def fails():
+            yield engine.Call(explode)
+
+        failed = engine.Engine(self.app).run([('gathers', gathers()), ('catches', catches()), ('fails', fails())])
+
+        self.assertEqual(failed.keys(), ['fails'])
+        self.assertIn('boom', caught)
+        gathered = [c for c in caught if isinstance(c, list)][0]
+        self.assertIsInstance(gathered[0], ValueError)
+        self.assertEqual(gathered[1], 1)
+
+    def test_account_concurrency(self):
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'max': 0}
+
+        def work():
+            with lock:
+                in_flight['now'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['now'])
+            time.sleep(0.01)
+            with lock:
+                in_flight['now'] -= 1
+
+        def coro():
+            yield [engine.Call(work) for _ in range(10)]
+
+        engine.Engine(self.app, max_calls=10, account_concurrency=2).run([('account', coro())])
+
+        self.assertEqual(in_flight['max'], 2)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestUpdateAccount(unittest.TestCase):
+    '''Test the account update coroutine with the IAM collector.'''
+
+    def test_update_account(self):
+        app = create_app()
+        app.config['IAM_POLL_INTERVAL'] = 0
+        client = boto3.client(
+            'iam', region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'
+            )
+        stubber = Stubber(client)
+        stubber.add_response(
+            'generate_service_last_accessed_details', {'JobId': ROLE_JOB_ID}, {'Arn': ROLE_ARN})
+        stubber.add_response(
+            'get_service_last_accessed_details',
+            dict(JobStatus='COMPLETED', JobCreationDate=datetime.datetime(2017, 3, 11),
+                 JobCompletionDate=datetime.datetime(2017, 3, 11),
+                 ServicesLastAccessed=[dict(ServiceName='Amazon S3', ServiceNamespace='s3')]),
+            {'JobId': ROLE_JOB_ID})
+
+        persisted = []
+        with stubber:
+            failed = engine.Engine(app).run([
+                ('123456789012', engine.update_account(
+                    FakeAccount(app, client), lambda app, data: persisted.append(data)))
+                ])
+
+        self.assertEqual(failed, {})
+        self.assertEqual(persisted, [{ROLE_ARN: [dict(
+            lastAuthenticated=0, serviceName='Amazon S3', serviceNamespace='s3',
+            lastAuthenticatedEntity=None, totalAuthenticatedEntities=0)]}])
+
+    def test_update_account_failures(self):
+        app = create_app()
+        app.config['IAM_POLL_INTERVAL'] = 0
+        client = boto3.client(
+            'iam', region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'
+            )
+        stubber = Stubber(client)
+        stubber.add_client_error(
+            'generate_service_last_accessed_details', 'ServiceFailure', expected_params={'Arn': ROLE_ARN})
+
+        persisted = []
+        with stubber:
+            failed = engine.Engine(app).run([
+                ('123456789012', engine.update_account(
+                    FakeAccount(app, client), lambda app, data: persisted.append(data)))
+                ])
+
+        self.assertEqual(failed.keys(), ['123456789012'])
+        self.assertIsInstance(failed['123456789012'], RuntimeError)
+        self.assertEqual(persisted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+'''Test cases for the local stand-in for AWS used by bench_collect.'''
+import time
+import unittest
+
+import boto3
+from botocore.exceptions import ClientError
+
+from aardvark.fakeaws import FakeAWS
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestFakeAWS(unittest.TestCase):
+    '''Test the fake through real boto3 clients.'''
+
+    def setUp(self):
+        self.fake = FakeAWS(num_accounts=2, roles=150, job_seconds=0.1).start()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def client(self, service, access_key_id):
+        return boto3.session.Session().client(service, endpoint_url=self.fake.url, region_name='us-east-1',
+                                              aws_access_key_id=access_key_id, aws_secret_access_key='fake',
+                                              aws_session_token='fake')
+
+    def iam_client(self, account_number):
+        sts = self.client('sts', 'fake')
+        credentials = sts.assume_role(RoleArn='arn:aws:iam::{}:role/Aardvark'.format(account_number),
+                                      RoleSessionName='aardvark')['Credentials']
+        return self.client('iam', credentials['AccessKeyId'])
+
+    def test_list_roles(self):
+        iam = self.iam_client('100000000001')
+        roles = [role['Arn'] for page in iam.get_paginator('list_roles').paginate() for role in page['Roles']]
+        self.assertEqual(roles, self.fake.arns('100000000001', 'role'))
+        self.assertEqual(self.fake.requests['ListRoles'], 2)
+
+    def test_access_advisor_job(self):
+        iam = self.iam_client('100000000000')
+        arn = self.fake.arns('100000000000', 'user')[0]
+        job_id = iam.generate_service_last_accessed_details(Arn=arn)['JobId']
+        self.assertEqual(iam.get_service_last_accessed_details(JobId=job_id)['JobStatus'], 'IN_PROGRESS')
+
+        time.sleep(0.2)
+        details = iam.get_service_last_accessed_details(JobId=job_id)
+        self.assertEqual(details['JobStatus'], 'COMPLETED')
+        self.assertEqual([service['ServiceNamespace'] for service in details['ServicesLastAccessed']],
+                         ['s3', 'ec2', 'iam', 'sts', 'sqs'])
+        self.assertEqual(details['ServicesLastAccessed'][0]['LastAuthenticatedEntity'], arn)
+
+    def test_throttling(self):
+        self.fake.throttle_rate = 1
+        iam = self.iam_client('100000000000')
+        with self.assertRaises(ClientError) as raised:
+            iam.generate_service_last_accessed_details(Arn=self.fake.arns('100000000000', 'role')[0])
+        self.assertEqual(raised.exception.response['Error']['Code'], 'Throttling')
+        self.assertGreater(self.fake.throttled, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
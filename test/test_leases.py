@@ -0,0 +1,102 @@
+'''Test cases for the lease queue shared by update nodes.
+
+These run against the default in-memory SQLite database, so claims take
+the optimistic UPDATE path rather than SKIP LOCKED.
+'''
+import datetime
+import unittest
+
+from aardvark import create_app, db
+from aardvark.model import UpdateTask
+from aardvark.updater import checkpoint
+from aardvark.updater.leases import LeaseQueue
+
+
+ACCOUNTS = ['111111111111', '222222222222']
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestLeaseQueue(unittest.TestCase):
+    '''Test claiming, retrying and expiring leased tasks.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['UPDATE_BACKOFF_BASE'] = 0
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.run, _ = checkpoint.Checkpoint.start(self.app, ACCOUNTS, 'Aardvark', ['all'], leased=True)
+        self.queues = [LeaseQueue(self.app, self.run, owner='node{}'.format(index), poll_interval=0.01)
+                       for index in range(2)]
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def task(self, account_number):
+        db.session.commit()
+        return UpdateTask.query.filter_by(account_number=account_number).one()
+
+    def test_claims_dont_overlap(self):
+        first, second = self.queues
+        self.assertEqual(first.get(), (('111111111111', 'Aardvark', ['all'], None), 0))
+        self.assertEqual(second.get(), (('222222222222', 'Aardvark', ['all'], None), 0))
+        self.assertEqual(self.task('111111111111').lease_owner, 'node0')
+        self.assertEqual(self.task('222222222222').lease_owner, 'node1')
+
+    def test_done_when_nothing_remains(self):
+        queue = self.queues[0]
+        for _ in ACCOUNTS:
+            item, attempt = queue.get()
+            self.run.started(item, attempt)
+            self.run.finished(item)
+        self.assertEqual(queue.get(), (None, None))
+        queue.join()
+
+    def test_retry(self):
+        queue = self.queues[0]
+        item, attempt = queue.get()
+        self.run.started(item, attempt)
+        self.assertTrue(queue.retry(item, attempt, RuntimeError('boom')))
+        self.run.retrying(item, 'boom')
+
+        self.assertIsNone(self.task(item[0]).lease_owner)
+        claimed = [queue.get(), queue.get()]
+        self.assertIn((item, 1), claimed)
+
+    def test_expired_lease(self):
+        first, second = self.queues
+        item, attempt = first.get()
+        self.run.started(item, attempt)
+        UpdateTask.query.filter_by(account_number=item[0]).update(
+            dict(lease_expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+
+        self.assertEqual(second.get(), (item, 1))
+        self.assertEqual(self.task(item[0]).lease_owner, 'node1')
+
+    def test_expired_lease_out_of_attempts(self):
+        first, second = self.queues
+        item, _ = first.get()
+        UpdateTask.query.filter_by(account_number=item[0]).update(
+            dict(attempts=3, lease_expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+
+        self.assertEqual(second.get()[0][0], '222222222222')
+        self.assertEqual(self.task(item[0]).status, checkpoint.FAILED)
+
+    def test_join(self):
+        self.assertEqual(checkpoint.Checkpoint.join(self.app).run_id, self.run.run_id)
+
+    def test_join_refused_without_leases(self):
+        # The node running this works from its own in-memory queue.
+        checkpoint.Checkpoint.start(self.app, ACCOUNTS, 'Aardvark', ['all'])
+        with self.assertRaises(RuntimeError):
+            checkpoint.Checkpoint.join(self.app)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''Test cases for collector metrics.'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from aardvark import create_app
+from aardvark.updater import metrics
+
+
+ROLE_ARN = 'arn:aws:iam::{}:role/role{}'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestMetrics(unittest.TestCase):
+    '''Test recording, merging and rendering of metrics.'''
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_histogram(self):
+        self.metrics.observe('collect', '123456789012', 0.3)
+        self.metrics.observe('collect', '123456789012', 4)
+        text = self.metrics.render()
+
+        self.assertIn('aardvark_phase_seconds_bucket{le="0.25",phase="collect"} 0', text)
+        self.assertIn('aardvark_phase_seconds_bucket{le="0.5",phase="collect"} 1', text)
+        self.assertIn('aardvark_phase_seconds_bucket{le="+Inf",phase="collect"} 2', text)
+        self.assertIn('aardvark_phase_seconds_count{phase="collect"} 2', text)
+        self.assertIn('aardvark_account_phase_seconds_total{account="123456789012",phase="collect"} 4.3', text)
+
+    def test_persisted_shared_by_account(self):
+        arns = [ROLE_ARN.format('111111111111', 0)] + [ROLE_ARN.format('222222222222', index) for index in range(3)]
+        self.metrics.persisted(arns, 2.0)
+        text = self.metrics.render()
+
+        self.assertIn('aardvark_arns_persisted_total 4', text)
+        self.assertIn('aardvark_account_phase_seconds_total{account="111111111111",phase="persist"} 0.5', text)
+        self.assertIn('aardvark_account_phase_seconds_total{account="222222222222",phase="persist"} 1.5', text)
+        self.assertIn('aardvark_account_arns_persisted_total{account="222222222222"} 3', text)
+
+    def test_counters(self):
+        self.metrics.inc('throttles')
+        self.metrics.inc('throttles', 2)
+        self.assertIn('aardvark_throttles_total 3', self.metrics.render())
+        self.assertRaises(ValueError, self.metrics.inc, 'unknown')
+
+    def test_gauges(self):
+        self.metrics.gauge('queue_depth', 'Queued.', lambda: 7)
+        self.metrics.gauge('broken', 'Fails.', lambda: 1 / 0)
+        text = self.metrics.render()
+
+        self.assertIn('# TYPE aardvark_queue_depth gauge', text)
+        self.assertIn('aardvark_queue_depth 7', text)
+        self.assertNotIn('aardvark_broken', text)
+
+    def test_drain_and_merge(self):
+        worker = metrics.Metrics()
+        worker.observe('enumerate', '123456789012', 1.0)
+        worker.inc('retries')
+        self.metrics.merge(worker.drain())
+        self.metrics.merge(worker.drain())
+
+        self.assertEqual(dict(self.metrics.phases())['enumerate'], (1, 1.0))
+        self.assertIn('aardvark_retries_total 1', self.metrics.render())
+        self.assertEqual(dict(worker.phases())['enumerate'], (0, 0.0))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestMetricsFile(unittest.TestCase):
+    '''Test writing metrics at the end of a run.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.directory = tempfile.mkdtemp()
+        self.app.config['METRICS_FILE'] = os.path.join(self.directory, 'aardvark.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_finish_writes_file(self):
+        metrics.start(self.app)
+        metrics.inc('failures')
+        metrics.finish(self.app)
+
+        with open(self.app.config['METRICS_FILE']) as metrics_file:
+            self.assertIn('aardvark_failures_total 1', metrics_file.read())
+        self.assertEqual(os.listdir(self.directory), ['aardvark.prom'])
@@ -0,0 +1,193 @@
+'''Test cases for the database models and persistence helpers.
+
+These run against the default in-memory SQLite database.
+'''
+import collections
+import datetime
+import unittest
+
+from aardvark import create_app, db
+from aardvark import manage
+from aardvark.model import AWSIAMObject, AdvisorData, DataGeneration, UpdateRun, UpdateTask
+from aardvark.updater import AccountToUpdate, checkpoint
+
+
+NOW = datetime.datetime.utcnow()
+
+FRESH_ARN = 'arn:aws:iam::111111111111:role/fresh'
+STALE_ARN = 'arn:aws:iam::111111111111:role/stale'
+STALER_ARN = 'arn:aws:iam::222222222222:role/staler'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class ModelTestBase(unittest.TestCase):
+    '''Creates the tables in a fresh app for each test.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def add_arns(self, last_updated_by_arn):
+        for arn, last_updated in last_updated_by_arn.items():
+            db.session.add(AWSIAMObject(arn=arn, lastUpdated=last_updated))
+        db.session.commit()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestStaleness(ModelTestBase):
+    '''Test selection of stale accounts and ARNs.'''
+
+    def setUp(self):
+        super(TestStaleness, self).setUp()
+        self.add_arns({
+            FRESH_ARN: NOW - datetime.timedelta(hours=1),
+            STALE_ARN: NOW - datetime.timedelta(hours=30),
+            STALER_ARN: NOW - datetime.timedelta(hours=50),
+            })
+
+    def test_last_updated_by_arn(self):
+        self.assertItemsEqual(AWSIAMObject.last_updated_by_arn('111111111111').keys(), [FRESH_ARN, STALE_ARN])
+
+    def test_oldest_update_by_account(self):
+        oldest = AWSIAMObject.oldest_update_by_account()
+        self.assertEqual(oldest['111111111111'], NOW - datetime.timedelta(hours=30))
+        self.assertEqual(oldest['222222222222'], NOW - datetime.timedelta(hours=50))
+
+    def test_update_stats_by_account(self):
+        stats = AWSIAMObject.update_stats_by_account()
+        self.assertEqual(stats, {
+            '111111111111': (NOW - datetime.timedelta(hours=30), 2),
+            '222222222222': (NOW - datetime.timedelta(hours=50), 1),
+            })
+        self.assertEqual(AWSIAMObject.arn_count_by_account(), {'111111111111': 2, '222222222222': 1})
+
+    def test_stale_accounts(self):
+        accounts = ['111111111111', '222222222222', '333333333333']
+        self.assertEqual(manage._stale_accounts(self.app, accounts, 24),
+                         ['333333333333', '222222222222', '111111111111'])
+        self.assertEqual(manage._stale_accounts(self.app, accounts, 40), ['333333333333', '222222222222'])
+
+    def test_stale_arns(self):
+        new_arn = 'arn:aws:iam::111111111111:role/new'
+        account = AccountToUpdate(self.app, '111111111111', 'Aardvark', ['all'])
+        self.assertEqual(account._stale_arns({FRESH_ARN, STALE_ARN, new_arn}, 24), [new_arn, STALE_ARN])
+
+    def test_not_updated_since(self):
+        new_arn = 'arn:aws:iam::111111111111:role/new'
+        account = AccountToUpdate(self.app, '111111111111', 'Aardvark', ['all'])
+        self.assertEqual(account._not_updated_since({FRESH_ARN, STALE_ARN, new_arn}, NOW - datetime.timedelta(hours=2)),
+                         {STALE_ARN, new_arn})
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def service(namespace, last_authenticated):
+    '''Build one service of Access Advisor data.'''
+    return dict(lastAuthenticated=last_authenticated, serviceName=namespace.upper(), serviceNamespace=namespace,
+                lastAuthenticatedEntity=None, totalAuthenticatedEntities=1)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestPersist(ModelTestBase):
+    '''Test bulk persistence of Access Advisor data.'''
+
+    def usage(self):
+        return dict(((item.item.arn, item.serviceNamespace), item.lastAuthenticated)
+                    for item in AdvisorData.query)
+
+    def test_insert(self):
+        manage.persist_aa_data(self.app, {
+            FRESH_ARN: [service('s3', 100), service('ec2', 0)],
+            STALE_ARN: [service('s3', 200)],
+            })
+        self.assertEqual(self.usage(), {
+            (FRESH_ARN, 's3'): 100, (FRESH_ARN, 'ec2'): 0, (STALE_ARN, 's3'): 200})
+
+    def test_update_only_newer(self):
+        self.add_arns({FRESH_ARN: NOW - datetime.timedelta(hours=30)})
+        manage.persist_aa_data(self.app, {FRESH_ARN: [service('s3', 100), service('ec2', 100)]})
+        manage.persist_aa_data(self.app, {FRESH_ARN: [service('s3', 200), service('ec2', 50)]})
+
+        self.assertEqual(self.usage(), {(FRESH_ARN, 's3'): 200, (FRESH_ARN, 'ec2'): 100})
+        self.assertEqual(AWSIAMObject.query.count(), 1)
+        self.assertGreater(AWSIAMObject.query.one().lastUpdated, NOW - datetime.timedelta(hours=1))
+
+    def test_rows_in_one_transaction(self):
+        # The last ARN's data is missing a field, so nothing is persisted.
+        with self.assertRaises(KeyError):
+            manage._persist_aa_data_rows(collections.OrderedDict([
+                (FRESH_ARN, [service('s3', 100)]),
+                (STALE_ARN, [dict(serviceNamespace='s3')]),
+                ]))
+        db.session.rollback()
+
+        self.assertEqual(AWSIAMObject.query.count(), 0)
+        self.assertIsNone(DataGeneration.current())
+
+    def test_delete_arns(self):
+        manage.persist_aa_data(self.app, {
+            FRESH_ARN: [service('s3', 100), service('ec2', 0)],
+            STALE_ARN: [service('s3', 200)],
+            })
+        AWSIAMObject.delete_arns({FRESH_ARN, STALER_ARN})
+
+        self.assertEqual(self.usage(), {(STALE_ARN, 's3'): 200})
+        self.assertEqual([item.arn for item in AWSIAMObject.query], [STALE_ARN])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestCheckpoint(ModelTestBase):
+    '''Test recording and resuming update runs.'''
+
+    def statuses(self):
+        return dict(((task.account_number, task.chunk), task.status) for task in UpdateTask.query)
+
+    def test_start(self):
+        run, items = checkpoint.Checkpoint.start(self.app, ['111111111111', '222222222222'], 'Aardvark', ['all'])
+        self.assertEqual(items, [(('111111111111', 'Aardvark', ['all'], None), 0),
+                                 (('222222222222', 'Aardvark', ['all'], None), 0)])
+        self.assertEqual(self.statuses(), {('111111111111', ''): checkpoint.PENDING,
+                                           ('222222222222', ''): checkpoint.PENDING})
+
+        run.started(items[0][0], 0)
+        run.finished(items[0][0])
+        self.assertEqual(UpdateTask.query.filter_by(account_number='111111111111').one().attempts, 1)
+        self.assertEqual(self.statuses()[('111111111111', '')], checkpoint.DONE)
+
+    def test_resume(self):
+        run, items = checkpoint.Checkpoint.start(
+            self.app, ['111111111111', '222222222222', '333333333333'], 'Aardvark', ['all'])
+        (first, _), (second, _), (third, _) = items
+        run.started(first, 0)
+        run.split(first, [('111111111111', 'Aardvark', [FRESH_ARN], '1/2'),
+                          ('111111111111', 'Aardvark', [STALE_ARN], '2/2')])
+        run.started(('111111111111', 'Aardvark', [FRESH_ARN], '1/2'), 0)
+        run.finished(('111111111111', 'Aardvark', [FRESH_ARN], '1/2'))
+        run.started(('111111111111', 'Aardvark', [STALE_ARN], '2/2'), 0)
+        run.started(second, 1)
+        run.failed(third, 'boom')
+
+        resumed, items = checkpoint.Checkpoint.resume(self.app)
+        self.assertEqual(resumed.run_id, run.run_id)
+        self.assertEqual(resumed.started_at, run.started_at)
+        self.assertItemsEqual(items, [(('111111111111', 'Aardvark', [STALE_ARN], '2/2'), 1),
+                                      (second, 2),
+                                      (third, 0)])
+        self.assertEqual(self.statuses()[('111111111111', '')], checkpoint.SPLIT)
+        self.assertEqual(self.statuses()[('222222222222', '')], checkpoint.PENDING)
+
+    def test_close(self):
+        run, _ = checkpoint.Checkpoint.start(self.app, ['111111111111'], 'Aardvark', ['all'])
+        run.close()
+        self.assertIsNotNone(UpdateRun.query.one().finished)
+        self.assertEqual(checkpoint.Checkpoint.resume(self.app), (None, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+'''Test cases for the streaming Persister.'''
+import time
+import unittest
+
+from aardvark import create_app
+from aardvark.updater.persister import Persister
+
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/role{}'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestPersister(unittest.TestCase):
+    '''Test batching and error handling of the writer thread.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['PERSIST_BATCH_SIZE'] = 3
+        self.app.config['PERSIST_QUEUE_SIZE'] = 2
+        self.batches = []
+
+    def persist(self, app, batch):
+        self.batches.append(batch)
+
+    def test_batches(self):
+        with Persister(self.app, self.persist) as persister:
+            for index in range(10):
+                persister.put(ROLE_ARN.format(index), [])
+
+        self.assertEqual(persister.count, 10)
+        self.assertTrue(all(len(batch) <= 3 for batch in self.batches))
+        persisted = {}
+        for batch in self.batches:
+            persisted.update(batch)
+        self.assertEqual(sorted(persisted), sorted(ROLE_ARN.format(index) for index in range(10)))
+
+    def test_batch_interval(self):
+        self.app.config['PERSIST_BATCH_SIZE'] = 100
+        self.app.config['PERSIST_BATCH_INTERVAL'] = 0.05
+        with Persister(self.app, self.persist) as persister:
+            persister.put(ROLE_ARN.format(0), [])
+            time.sleep(0.2)
+            self.assertEqual(len(self.batches), 1)
+            persister.put(ROLE_ARN.format(1), [])
+
+        self.assertEqual(persister.batches, 2)
+
+    def test_errors_recorded(self):
+        def fails(app, batch):
+            if ROLE_ARN.format(0) in batch:
+                raise ValueError('boom')
+            self.persist(app, batch)
+
+        self.app.config['PERSIST_BATCH_SIZE'] = 1
+        # The queue is smaller than this, so put() would block forever if the
+        # writer stopped draining after the error.
+        with Persister(self.app, fails) as persister:
+            for index in range(10):
+                persister.put(ROLE_ARN.format(index), [])
+
+        self.assertIsInstance(persister.error, ValueError)
+        self.assertEqual(persister.failed.keys(), [('123456789012', None)])
+        self.assertEqual(persister.count, 9)
+
+    def test_errors_by_item(self):
+        def fails(app, batch):
+            if ROLE_ARN.format(0) in batch:
+                raise ValueError('boom')
+            self.persist(app, batch)
+
+        self.app.config['PERSIST_BATCH_SIZE'] = 1
+        with Persister(self.app, fails) as persister:
+            persister.put(ROLE_ARN.format(0), [], ('123456789012', '1/2'))
+            persister.put(ROLE_ARN.format(1), [], ('123456789012', '2/2'))
+
+        self.assertEqual(persister.failed.keys(), [('123456789012', '1/2')])
+        persister.clear_failed('123456789012')
+        self.assertEqual(persister.failed, {})
+
+    def test_retry(self):
+        attempts = []
+
+        def fails_once(app, batch):
+            attempts.append(batch)
+            if len(attempts) == 1:
+                raise ValueError('boom')
+            self.persist(app, batch)
+
+        with Persister(self.app, fails_once) as persister:
+            persister.put(ROLE_ARN.format(0), [])
+
+        self.assertEqual(len(attempts), 2)
+        self.assertIsNone(persister.error)
+        self.assertEqual(persister.failed, {})
+        self.assertEqual(persister.count, 1)
+
+    def test_call_after_persisted(self):
+        self.app.config['PERSIST_BATCH_SIZE'] = 100
+        self.app.config['PERSIST_BATCH_INTERVAL'] = 10
+        calls = []
+        with Persister(self.app, self.persist) as persister:
+            persister.put(ROLE_ARN.format(0), [])
+            persister.call(lambda: calls.append(len(self.batches)))
+            persister.put(ROLE_ARN.format(1), [])
+
+        # The callback didn't wait for the batch interval, or for data
+        # queued after it.
+        self.assertEqual(calls, [1])
+        self.assertEqual(persister.batches, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+'''Test cases for the pool of long-lived PhantomJS workers.
+
+PhantomJS is replaced by a small script that speaks the same protocol:
+jobs as lines of JSON on stdin, results as lines of JSON in the job's
+output file.
+'''
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+from aardvark import create_app
+from aardvark.updater import phantompool
+
+
+FAKE_PHANTOMJS = '''#!{python}
+import json, os, sys, time
+for line in iter(sys.stdin.readline, ''):
+    job = json.loads(line)
+    with open(job['output'], 'a') as output:
+        for arn in job['arns']:
+            if arn == 'hang':
+                time.sleep(60)
+            output.write(json.dumps(dict(arn=arn, seconds=1.5, services=[dict(pid=os.getpid())])) + '\\n')
+            output.flush()
+        output.write(json.dumps(dict(done=True, code=0)) + '\\n')
+'''
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/role{}'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestPhantomPool(unittest.TestCase):
+    '''Test that workers are reused across accounts and replaced when stuck.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        phantomjs = os.path.join(self.directory, 'phantomjs')
+        with open(phantomjs, 'w') as f:
+            f.write(FAKE_PHANTOMJS.format(python=sys.executable))
+        os.chmod(phantomjs, os.stat(phantomjs).st_mode | stat.S_IEXEC)
+
+        self.app = create_app()
+        self.app.config['PHANTOMJS'] = phantomjs
+        self.pool = phantompool.PhantomPool(self.app, size=1, max_jobs=3)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.directory)
+
+    def run_job(self, arns, **kwargs):
+        results = {}
+        self.job_seconds = {}
+        worker = self.pool._checkout()
+        try:
+            code = worker.run(dict(token='token', arns=arns), results.__setitem__, self.job_seconds, **kwargs)
+        finally:
+            self.pool._checkin(worker)
+        return code, results
+
+    def pids(self, results):
+        return set(services[0]['pid'] for services in results.values())
+
+    def test_reused(self):
+        code, first = self.run_job([ROLE_ARN.format(0), ROLE_ARN.format(1)])
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(first), [ROLE_ARN.format(0), ROLE_ARN.format(1)])
+        self.assertEqual(self.job_seconds, {ROLE_ARN.format(0): 1.5, ROLE_ARN.format(1): 1.5})
+
+        code, second = self.run_job([ROLE_ARN.format(2)])
+        self.assertEqual(code, 0)
+        self.assertEqual(self.pids(first), self.pids(second))
+
+        # Retired after max_jobs accounts.
+        self.run_job([ROLE_ARN.format(3)])
+        code, fourth = self.run_job([ROLE_ARN.format(4)])
+        self.assertNotEqual(self.pids(first), self.pids(fourth))
+
+    def test_timeout(self):
+        code, results = self.run_job([ROLE_ARN.format(0), 'hang'], timeout=1)
+        self.assertEqual(code, 1)
+        self.assertEqual(list(results), [ROLE_ARN.format(0)])
+
+        code, results = self.run_job([ROLE_ARN.format(1)])
+        self.assertEqual(code, 0)
+        self.assertEqual(list(results), [ROLE_ARN.format(1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+'''Test cases for process and thread mode updates.
+
+Worker processes can't share an in-memory database, so these update a
+scratch SQLite file from FakeAWS, as bench_collect does.
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from aardvark import create_app, db
+from aardvark import manage
+from aardvark.fakeaws import FakeAWS
+from aardvark.model import AWSIAMObject, UpdateTask
+from aardvark.updater import checkpoint
+from aardvark.updater.leases import LeaseQueue
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class ProcessTestBase(unittest.TestCase):
+    '''Serves fake accounts and creates a scratch database for each test.'''
+
+    num_accounts = 2
+
+    def setUp(self):
+        self.fake = FakeAWS(num_accounts=self.num_accounts, roles=5, job_seconds=0.2).start()
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(name, 'fake')
+
+        self.config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db')),
+            'IAM_ENDPOINT_URL': self.fake.url,
+            'STS_ENDPOINT_URL': self.fake.url,
+            'FEDERATION_URL': self.fake.url + '/federation',
+            'COLLECTOR': 'iam',
+            'UPDATE_BACKOFF_BASE': 0,
+        }
+        self.app = create_app()
+        self.app.config.update(self.config)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.run, self.items = checkpoint.Checkpoint.start(self.app, self.fake.account_numbers, 'Aardvark', ['all'])
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.fake.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def tasks(self):
+        db.session.commit()
+        return UpdateTask.query.filter(UpdateTask.run_id == self.run.run_id).all()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestProcessLeases(ProcessTestBase):
+    '''Test that a process mode node leaves work for other nodes.'''
+
+    num_accounts = 4
+
+    def test_claims_bounded_by_workers(self):
+        queue = LeaseQueue(self.app, self.run, owner='node0', poll_interval=0.05)
+
+        def update():
+            with self.app.app_context():
+                manage._update_processes(self.app, queue, self.run, 1, self.config)
+
+        node = threading.Thread(target=update)
+        node.start()
+        deadline = time.time() + 10
+        while not any(task.lease_owner == 'node0' for task in self.tasks()) and time.time() < deadline:
+            time.sleep(0.01)
+
+        other = LeaseQueue(self.app, self.run, owner='node1', poll_interval=0.05)
+        item, attempt = other.get()
+        self.assertIsNotNone(item)
+        self.assertLessEqual(len([task for task in self.tasks() if task.lease_owner == 'node0' and
+                                  task.status == checkpoint.IN_FLIGHT]), 1)
+        self.run.started(item, attempt)
+        self.run.finished(item)
+        other.close()
+
+        node.join()
+        queue.close()
+        self.assertTrue(all(task.status == checkpoint.DONE for task in self.tasks()))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestProcessUpdate(ProcessTestBase):
+    '''Test updating accounts from FakeAWS in worker processes.'''
+
+    def update(self):
+        account_queue = manage._account_queue(self.app, self.items, self.run, False)
+        manage._update_processes(self.app, account_queue, self.run, 2, self.config)
+        return account_queue
+
+    def test_update(self):
+        account_queue = self.update()
+        self.assertEqual(account_queue.failed, [])
+        self.assertTrue(all(task.status == checkpoint.DONE for task in self.tasks()))
+        self.assertItemsEqual(AWSIAMObject.arn_count_by_account().keys(), self.fake.account_numbers)
+
+    def test_lost_result(self):
+        # Jobs take longer than this, so no worker returns a result in time.
+        self.app.config['UPDATE_PROCESS_TIMEOUT'] = 0.05
+        self.app.config['UPDATE_MAX_ATTEMPTS'] = 2
+        account_queue = self.update()
+        self.assertItemsEqual([item[0] for item, _, _ in account_queue.failed], self.fake.account_numbers)
+        self.assertTrue(all(task.status == checkpoint.FAILED for task in self.tasks()))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestThreadUpdate(ProcessTestBase):
+    '''Test updating accounts from FakeAWS in threads feeding one writer.'''
+
+    def test_update(self):
+        account_queue = manage._account_queue(self.app, self.items, self.run, False)
+        manage._update_threads(self.app, account_queue, self.run, 2)
+
+        self.assertEqual(account_queue.failed, [])
+        self.assertTrue(all(task.status == checkpoint.DONE for task in self.tasks()))
+        self.assertItemsEqual(AWSIAMObject.arn_count_by_account().keys(), self.fake.account_numbers)
+
+
+if __name__ == '__main__':
+    unittest.main()
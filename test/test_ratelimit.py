@@ -0,0 +1,90 @@
+'''Test cases for rate limiting and adaptive concurrency of IAM calls.'''
+import time
+import unittest
+
+from botocore.exceptions import ClientError
+
+from aardvark.updater import ratelimit
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'GenerateServiceLastAccessedDetails')
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestTokenBucket(unittest.TestCase):
+    '''Test that the bucket holds calls to its rate.'''
+
+    def test_rate(self):
+        bucket = ratelimit.TokenBucket(50, burst=1)
+        start = time.time()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestAdaptiveConcurrency(unittest.TestCase):
+    '''Test additive increase and multiplicative decrease.'''
+
+    def test_increase(self):
+        concurrency = ratelimit.AdaptiveConcurrency(initial=2, maximum=3)
+        for _ in range(10):
+            concurrency.release(concurrency.acquire())
+        self.assertEqual(concurrency.limit, 3)
+
+    def test_decrease_once_per_burst(self):
+        concurrency = ratelimit.AdaptiveConcurrency(initial=8, maximum=8)
+        tickets = [concurrency.acquire() for _ in range(4)]
+        for ticket in tickets:
+            concurrency.release(ticket, throttled=True)
+        self.assertEqual(concurrency.limit, 4)
+
+        concurrency.release(concurrency.acquire(), throttled=True)
+        self.assertEqual(concurrency.limit, 2)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestLimiter(unittest.TestCase):
+    '''Test retrying of throttled calls.'''
+
+    def setUp(self):
+        self.original_backoff = ratelimit.THROTTLE_BACKOFF_MAX
+        ratelimit.THROTTLE_BACKOFF_MAX = 0
+        self.limiter = ratelimit.Limiter([ratelimit.TokenBucket(1000)], ratelimit.AdaptiveConcurrency(),
+                                         throttle_retries=2)
+
+    def tearDown(self):
+        ratelimit.THROTTLE_BACKOFF_MAX = self.original_backoff
+
+    def test_retries_throttling(self):
+        errors = [client_error('Throttling'), client_error('Throttling')]
+
+        def call():
+            if errors:
+                raise errors.pop()
+            return 'done'
+
+        self.assertEqual(self.limiter.call(call), 'done')
+        self.assertEqual(self.limiter.throttles, 2)
+        self.assertLess(self.limiter.concurrency.limit, ratelimit.INITIAL_CONCURRENCY)
+
+    def test_gives_up(self):
+        def call():
+            raise client_error('Throttling')
+
+        with self.assertRaises(ClientError):
+            self.limiter.call(call)
+        self.assertEqual(self.limiter.throttles, 2)
+
+    def test_other_errors_raised(self):
+        def call():
+            raise client_error('NoSuchEntity')
+
+        with self.assertRaises(ClientError):
+            self.limiter.call(call)
+        self.assertEqual(self.limiter.throttles, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
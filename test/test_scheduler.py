@@ -0,0 +1,123 @@
+'''Test cases for the account update scheduler.'''
+import datetime
+import time
+import unittest
+
+from aardvark import create_app, db
+from aardvark.model import AWSIAMObject
+from aardvark.updater.scheduler import Scheduler
+from aardvark.updater.workqueue import AccountQueue
+
+
+HOUR = 3600
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestScheduler(unittest.TestCase):
+    '''Test cadences, phases and priorities of scheduled accounts.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['SCHEDULER_JITTER'] = 0
+        self.app.config['SCHEDULER_CADENCES'] = {'222222222222': 6}
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.queue = AccountQueue()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def scheduler(self, accounts):
+        return Scheduler(self.app, accounts, 'Aardvark', self.queue)
+
+    def test_cadence(self):
+        scheduler = self.scheduler([])
+        self.assertEqual(scheduler.cadence('111111111111'), 24 * HOUR)
+        self.assertEqual(scheduler.cadence('222222222222'), 6 * HOUR)
+
+    def test_next_slot(self):
+        scheduler = self.scheduler([])
+        now = time.time()
+        slot = scheduler.next_slot('111111111111', now)
+        self.assertTrue(now <= slot < now + 24 * HOUR)
+        self.assertEqual((slot - scheduler.phase('111111111111')) % (24 * HOUR), 0)
+        self.assertEqual(scheduler.next_slot('111111111111', slot + 1), slot + 24 * HOUR)
+
+    def test_first_due(self):
+        scheduler = self.scheduler([])
+        now = time.time()
+        self.assertEqual(scheduler.first_due('111111111111', None, now), now)
+        self.assertEqual(scheduler.first_due('111111111111', now - 25 * HOUR, now), now)
+
+        due = scheduler.first_due('111111111111', now - HOUR, now)
+        self.assertTrue(now + 11 * HOUR <= due <= now + 35 * HOUR)
+
+    def test_priority(self):
+        scheduler = self.scheduler([])
+        now = time.time()
+        self.assertGreater(scheduler.priority('111111111111', None, 0, now),
+                           scheduler.priority('111111111111', now - 48 * HOUR, 1000, now))
+        # Staleness is relative to the account's cadence.
+        self.assertGreater(scheduler.priority('222222222222', now - 12 * HOUR, 10, now),
+                           scheduler.priority('111111111111', now - 24 * HOUR, 10, now))
+        # Larger accounts go first.
+        self.assertGreater(scheduler.priority('111111111111', now - 24 * HOUR, 1000, now),
+                           scheduler.priority('111111111111', now - 24 * HOUR, 10, now))
+
+    def test_queues_due_accounts_by_priority(self):
+        updated = datetime.datetime.utcnow() - datetime.timedelta(hours=30)
+        db.session.add(AWSIAMObject(arn='arn:aws:iam::111111111111:role/stale', lastUpdated=updated))
+        db.session.add(AWSIAMObject(arn='arn:aws:iam::333333333333:role/fresh',
+                                    lastUpdated=datetime.datetime.utcnow()))
+        db.session.commit()
+
+        scheduler = self.scheduler(['111111111111', '222222222222', '333333333333'])
+        scheduler._queue_due(scheduler._pop_due())
+        self.assertEqual([self.queue.get()[0][0] for _ in range(2)], ['222222222222', '111111111111'])
+
+    def test_sync_accounts(self):
+        scheduler = self.scheduler(['111111111111', '222222222222'])
+        scheduler.sync_accounts(['222222222222', '333333333333'])
+        self.assertEqual(sorted(scheduler._pop_due()), ['222222222222', '333333333333'])
+
+    def test_readded_during_update(self):
+        scheduler = self.scheduler(['111111111111'])
+        scheduler._queue_due(scheduler._pop_due())
+        item, _ = self.queue.get()
+
+        scheduler.sync_accounts([])
+        scheduler.sync_accounts(['111111111111'])
+        self.assertEqual(scheduler._heap, [])
+
+        scheduler.finished(item)
+        self.assertEqual([account_number for _, _, account_number in scheduler._heap], ['111111111111'])
+        self.assertEqual(scheduler._outstanding, {})
+
+    def test_readded_while_scheduled(self):
+        scheduler = self.scheduler(['111111111111'])
+        scheduler.sync_accounts([])
+        scheduler.sync_accounts(['111111111111'])
+        self.assertEqual(scheduler._pop_due(), ['111111111111'])
+
+    def test_reschedules_after_chunks(self):
+        scheduler = self.scheduler(['111111111111'])
+        scheduler._queue_due(scheduler._pop_due())
+        item, _ = self.queue.get()
+        chunks = [('111111111111', 'Aardvark', ['arn1'], '1/2'), ('111111111111', 'Aardvark', ['arn2'], '2/2')]
+
+        scheduler.split(item, chunks)
+        scheduler.finished(chunks[0])
+        self.assertEqual(scheduler._heap, [])
+
+        before = time.time()
+        scheduler.failed(chunks[1], RuntimeError('boom'))
+        due, _, account_number = scheduler._heap[0]
+        self.assertEqual(account_number, '111111111111')
+        self.assertTrue(before < due <= time.time() + HOUR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+'''Test cases for splitting accounts into chunks of ARNs.'''
+import unittest
+
+from aardvark.updater import sharding
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestChunkSizer(unittest.TestCase):
+    '''Test fixed and adaptive chunk sizes.'''
+
+    def test_fixed(self):
+        sizer = sharding.ChunkSizer.from_config(dict(ARN_CHUNK_SIZE=25))
+        sizer.record(10, 1000)
+        self.assertEqual(sizer.size(), 25)
+
+    def test_not_split_for_iam(self):
+        sizer = sharding.ChunkSizer.from_config(dict(COLLECTOR='iam'))
+        sizer.record(100, 200)
+        self.assertIsNone(sizer.size())
+
+    def test_adaptive(self):
+        sizer = sharding.ChunkSizer.from_config(dict(COLLECTOR='phantomjs', ARN_CHUNK_SECONDS=300))
+        self.assertEqual(sizer.size(), sharding.INITIAL_CHUNK_SIZE)
+
+        sizer.record(100, 200)
+        self.assertEqual(sizer.size(), 150)
+
+        # Slower chunks shrink the size, smoothed against earlier ones.
+        sizer.record(100, 1200)
+        self.assertEqual(sizer.size(), 60)
+
+    def test_adaptive_bounds(self):
+        sizer = sharding.ChunkSizer()
+        sizer.record(1, 10000)
+        self.assertEqual(sizer.size(), sharding.MIN_CHUNK_SIZE)
+
+        sizer = sharding.ChunkSizer()
+        sizer.record(1000, 1)
+        self.assertEqual(sizer.size(), sharding.MAX_CHUNK_SIZE)
+
+    def test_chunk_arns(self):
+        arns = [str(i) for i in range(7)]
+        self.assertEqual(sharding.chunk_arns(arns, 3), [['0', '1', '2'], ['3', '4', '5'], ['6']])
+        self.assertEqual(sharding.chunk_arns([], 3), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
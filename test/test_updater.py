@@ -0,0 +1,118 @@
+'''Test cases for AccountToUpdate.
+
+IAM is replaced by a fake client that serves canned listings, and the
+database is the default in-memory SQLite database.
+'''
+import datetime
+import unittest
+
+from aardvark import create_app, db
+from aardvark import updater
+from aardvark.model import AWSIAMObject
+
+
+ACCOUNT_NUMBER = '123456789012'
+ROLE_ARNS = ['arn:aws:iam::123456789012:role/b', 'arn:aws:iam::123456789012:role/a']
+USER_ARN = 'arn:aws:iam::123456789012:user/someone'
+POLICY_ARN = 'arn:aws:iam::123456789012:policy/local'
+GROUP_ARN = 'arn:aws:iam::123456789012:group/admins'
+DELETED_ARN = 'arn:aws:iam::123456789012:role/deleted'
+
+ALL_ARNS = sorted(ROLE_ARNS + [USER_ARN, POLICY_ARN, GROUP_ARN])
+
+
+class FakePaginator(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages)
+
+
+class FakeIAMClient(object):
+    '''Serves canned IAM listings and counts the calls made.'''
+
+    def __init__(self):
+        self.calls = 0
+
+    def list_roles(self, **kwargs):
+        self.calls += 1
+        if 'Marker' not in kwargs:
+            return dict(Roles=[dict(Arn=ROLE_ARNS[0])], IsTruncated=True, Marker='next')
+        return dict(Roles=[dict(Arn=ROLE_ARNS[1])], IsTruncated=False)
+
+    def list_users(self, **kwargs):
+        self.calls += 1
+        return dict(Users=[dict(Arn=USER_ARN)], IsTruncated=False)
+
+    def get_paginator(self, operation):
+        self.calls += 1
+        if operation == 'list_policies':
+            return FakePaginator([dict(Policies=[dict(Arn=POLICY_ARN)])])
+        return FakePaginator([dict(Groups=[dict(Arn=GROUP_ARN)])])
+
+
+class FakeAccountToUpdate(updater.AccountToUpdate):
+    def __init__(self, app, arns, client):
+        super(FakeAccountToUpdate, self).__init__(app, ACCOUNT_NUMBER, 'Aardvark', arns)
+        self.client = client
+
+    def iam_client(self):
+        return self.client
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestGetArns(unittest.TestCase):
+    '''Test ARN enumeration, caching and pruning.'''
+
+    def setUp(self):
+        updater.ARN_CACHE.clear()
+        self.app = create_app()
+        self.client = FakeIAMClient()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_all(self):
+        arns = FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        self.assertEqual(arns, ALL_ARNS)
+
+    def test_filtered(self):
+        arns = FakeAccountToUpdate(self.app, [USER_ARN, DELETED_ARN], self.client)._get_arns()
+        self.assertEqual(arns, [USER_ARN])
+
+    def test_cached(self):
+        FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        calls = self.client.calls
+
+        arns = FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        self.assertEqual(arns, ALL_ARNS)
+        self.assertEqual(self.client.calls, calls)
+
+        self.app.config['ARN_CACHE_TTL'] = 0
+        updater.ARN_CACHE.clear()
+        FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        self.assertEqual(self.client.calls, calls * 3)
+
+    def test_prune(self):
+        db.session.add(AWSIAMObject(arn=DELETED_ARN, lastUpdated=datetime.datetime.utcnow()))
+        db.session.add(AWSIAMObject(arn=USER_ARN, lastUpdated=datetime.datetime.utcnow()))
+        db.session.commit()
+
+        FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        self.assertEqual(AWSIAMObject.query.count(), 2)
+
+        updater.ARN_CACHE.clear()
+        self.app.config['PRUNE_DELETED_ARNS'] = True
+        FakeAccountToUpdate(self.app, ['all'], self.client)._get_arns()
+        self.assertEqual([item.arn for item in AWSIAMObject.query], [USER_ARN])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+'''Test cases for the advisors API.
+
+These run against the default in-memory SQLite database.
+'''
+import datetime
+import json
+import unittest
+
+from sqlalchemy import event
+
+from aardvark import create_app, db
+from aardvark import manage
+from aardvark.model import AWSIAMObject, AdvisorData, DataGeneration
+
+
+NOW = datetime.datetime.utcnow()
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/role{}'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class ViewTestBase(unittest.TestCase):
+    '''Creates the tables, with some Access Advisor data, for each test.'''
+
+    def setUp(self):
+        self.app = create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        for index in range(10):
+            item = AWSIAMObject(arn=ROLE_ARN.format(index), lastUpdated=NOW)
+            db.session.add(item)
+            db.session.flush()
+            for namespace in ('s3', 'ec2'):
+                db.session.add(AdvisorData(item_id=item.id, lastAuthenticated=1489176000000 + index,
+                                           serviceName=namespace, serviceNamespace=namespace,
+                                           lastAuthenticatedEntity=ROLE_ARN.format(index),
+                                           totalAuthenticatedEntities=1))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def advisors(self, query=''):
+        response = self.client.post('/api/1/advisors' + query)
+        return response.status_code, json.loads(response.data)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestAdvisors(ViewTestBase):
+    '''Test searching and paging through Access Advisor data.'''
+
+    def count_queries(self, query):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            status, values = self.advisors(query)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(status, 200)
+        return len(statements), values
+
+    def test_page(self):
+        status, values = self.advisors('?count=4&page=2')
+        self.assertEqual(status, 200)
+        self.assertEqual((values['page'], values['total'], values['count']), (2, 10, 4))
+        self.assertItemsEqual([key for key in values if key.startswith('arn:')],
+                              [ROLE_ARN.format(index) for index in range(4, 8)])
+        self.assertItemsEqual([service['serviceNamespace'] for service in values[ROLE_ARN.format(4)]], ['s3', 'ec2'])
+
+    def test_filters(self):
+        status, values = self.advisors('?phrase=role3')
+        self.assertEqual(status, 200)
+        self.assertEqual(values['total'], 1)
+        self.assertIn(ROLE_ARN.format(3), values)
+
+    def test_queries_per_page(self):
+        # The page, the total and the page's usage, however many ARNs are on the page.
+        small, _ = self.count_queries('?count=2&page=2')
+        large, values = self.count_queries('?count=8&page=1')
+        self.assertEqual(values['count'], 8)
+        self.assertEqual(small, 3)
+        self.assertEqual(large, 3)
+
+    def test_cursor(self):
+        arns = []
+        cursor = ''
+        while cursor is not None:
+            status, values = self.advisors('?count=4&cursor=' + cursor)
+            self.assertEqual(status, 200)
+            self.assertNotIn('total', values)
+            arns.extend(key for key in values if key.startswith('arn:'))
+            cursor = values['next_cursor']
+        self.assertItemsEqual(arns, [ROLE_ARN.format(index) for index in range(10)])
+        self.assertEqual(len(arns), 10)
+
+    def test_cursor_total(self):
+        status, values = self.advisors('?count=4&cursor=&total=true&phrase=role')
+        self.assertEqual((values['count'], values['total']), (4, 10))
+
+    def test_page_cursor(self):
+        # A page's cursor carries on from the end of the page.
+        status, values = self.advisors('?count=3&page=2')
+        status, values = self.advisors('?count=3&cursor=' + values['next_cursor'])
+        self.assertItemsEqual([key for key in values if key.startswith('arn:')],
+                              [ROLE_ARN.format(index) for index in range(6, 9)])
+
+        status, values = self.advisors('?count=10')
+        self.assertIsNone(values['next_cursor'])
+
+    def test_invalid_cursor(self):
+        response = self.client.post('/api/1/advisors?cursor=bm90IGFuIGlk')
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_count(self):
+        for query in ('?count=0', '?count=-1&cursor='):
+            response = self.client.post('/api/1/advisors' + query)
+            self.assertEqual(response.status_code, 400)
+
+    def test_combine(self):
+        # Combines every matching ARN, not just a page of them.
+        status, values = self.advisors('?combine=true&count=2')
+        self.assertEqual(status, 200)
+        self.assertItemsEqual(values.keys(), ['s3', 'ec2'])
+        self.assertEqual(values['s3']['totalAuthenticatedEntities'], 10)
+        self.assertEqual(values['s3']['lastAuthenticated'], 1489176000009)
+        self.assertEqual(values['s3']['lastAuthenticatedEntity'], ROLE_ARN.format(9))
+        self.assertFalse(values['s3']['USED_LAST_90_DAYS'])
+
+    def test_combine_filtered(self):
+        status, values = self.advisors('?combine=true&phrase=role3&usage_days=36500')
+        self.assertEqual(status, 200)
+        self.assertEqual(values['ec2']['totalAuthenticatedEntities'], 1)
+        self.assertEqual(values['ec2']['lastAuthenticatedEntity'], ROLE_ARN.format(3))
+        self.assertTrue(values['ec2']['USED_LAST_36500_DAYS'])
+
+    def test_ndjson(self):
+        response = self.client.post('/api/1/advisors?format=ndjson&phrase=role')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([record['arn'] for record in records], [ROLE_ARN.format(index) for index in range(10)])
+        self.assertItemsEqual([service['serviceNamespace'] for service in records[0]['usage']], ['s3', 'ec2'])
+
+    def test_json_stream(self):
+        db.session.add(AWSIAMObject(arn=ROLE_ARN.format('unused'), lastUpdated=NOW))
+        db.session.commit()
+
+        response = self.client.post('/api/1/advisors?format=json-stream')
+        self.assertEqual(response.status_code, 200)
+        values = json.loads(response.data)
+        self.assertEqual(len(values), 11)
+        self.assertEqual(values[ROLE_ARN.format('unused')], [])
+        self.assertEqual(len(values[ROLE_ARN.format(9)]), 2)
+
+    def test_stream_from_cursor(self):
+        status, values = self.advisors('?count=8')
+        response = self.client.post('/api/1/advisors?format=ndjson&cursor=' + values['next_cursor'])
+        self.assertEqual([json.loads(line)['arn'] for line in response.data.splitlines()],
+                         [ROLE_ARN.format(8), ROLE_ARN.format(9)])
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestConditionalRequests(ViewTestBase):
+    '''Test ETag and Last-Modified handling based on the data generation.'''
+
+    def persist(self):
+        manage.persist_aa_data(self.app, {ROLE_ARN.format(0): [dict(
+            lastAuthenticated=1489176000100, serviceName='s3', serviceNamespace='s3',
+            lastAuthenticatedEntity=ROLE_ARN.format(0), totalAuthenticatedEntities=1)]})
+
+    def test_no_generation(self):
+        response = self.client.get('/api/1/advisors')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('ETag'))
+
+    def test_persist_bumps_generation(self):
+        self.persist()
+        first = DataGeneration.current().generation
+        self.persist()
+        self.assertEqual(DataGeneration.current().generation, first + 1)
+
+    def test_if_none_match(self):
+        self.persist()
+        response = self.client.get('/api/1/advisors?count=5')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = self.client.get('/api/1/advisors?count=5', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self.persist()
+        response = self.client.get('/api/1/advisors?count=5', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_if_modified_since(self):
+        self.persist()
+        response = self.client.get('/api/1/advisors')
+        last_modified = response.headers['Last-Modified']
+
+        response = self.client.get('/api/1/advisors', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_bad_arguments(self):
+        self.persist()
+        etag = self.client.get('/api/1/advisors').headers['ETag']
+        response = self.client.get('/api/1/advisors?count=0', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 400)
+
+    def test_combine_not_cached(self):
+        self.persist()
+        response = self.client.get('/api/1/advisors?combine=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('ETag'))
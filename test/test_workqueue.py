@@ -0,0 +1,78 @@
+'''Test cases for the account work queue.'''
+import threading
+import time
+import unittest
+
+from aardvark.updater.workqueue import AccountQueue
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class TestAccountQueue(unittest.TestCase):
+    '''Test blocking gets, retries and join().'''
+
+    def run_workers(self, queue, work, num_workers=3):
+        '''Run work() on every item with worker threads until the queue is done.'''
+
+        def worker():
+            while True:
+                item, attempt = queue.get()
+                if item is None:
+                    return
+                try:
+                    work(item, attempt)
+                except Exception as e:
+                    queue.retry(item, attempt, e)
+                finally:
+                    queue.task_done()
+
+        threads = [threading.Thread(target=worker) for _ in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        queue.join()
+        queue.close()
+        for thread in threads:
+            thread.join()
+
+    def test_all_items_processed(self):
+        queue = AccountQueue()
+        for account in range(20):
+            queue.put(account)
+
+        done = []
+        self.run_workers(queue, lambda item, attempt: done.append(item))
+
+        self.assertItemsEqual(done, range(20))
+        self.assertEqual(queue.failed, [])
+
+    def test_bounded_retries(self):
+        queue = AccountQueue(max_attempts=3, backoff_base=0.01, backoff_max=0.02)
+        queue.put('flaky')
+        queue.put('broken')
+
+        attempts = []
+
+        def work(item, attempt):
+            attempts.append((item, attempt))
+            if item == 'broken' or attempt == 0:
+                raise RuntimeError(item)
+
+        self.run_workers(queue, work)
+
+        self.assertItemsEqual(attempts, [('flaky', 0), ('flaky', 1), ('broken', 0), ('broken', 1), ('broken', 2)])
+        self.assertEqual([(item, tries) for item, tries, _ in queue.failed], [('broken', 3)])
+
+    def test_get_waits_until_due(self):
+        queue = AccountQueue()
+        queue.put('later', delay=0.1)
+        start = time.time()
+        self.assertEqual(queue.get(), ('later', 0))
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_backoff_is_capped(self):
+        queue = AccountQueue(backoff_base=1, backoff_max=5)
+        for attempt in range(1, 10):
+            self.assertTrue(0 <= queue.backoff(attempt) <= min(5, 2 ** (attempt - 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()